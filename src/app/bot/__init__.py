@@ -1,5 +1,21 @@
+from vkbottle import Bot
+
+from app.metrics import HandlerMetricsMiddleware
+
 from .admin import admin_labeler
 from .broadcast import broadcast_labeler
 from .common import common_labeler
 
-__all__ = ("admin_labeler", "broadcast_labeler", "common_labeler")
+
+def setup_bot(bot: Bot) -> None:
+    # The webhook and the Long Poll runner dispatch through the same rules,
+    # loaded once even when a process imports both
+    if HandlerMetricsMiddleware in bot.labeler.message_view.middlewares:
+        return
+    bot.labeler.load(admin_labeler)
+    bot.labeler.load(common_labeler)
+    bot.labeler.load(broadcast_labeler)
+    bot.labeler.message_view.register_middleware(HandlerMetricsMiddleware)
+
+
+__all__ = ("admin_labeler", "broadcast_labeler", "common_labeler", "setup_bot")
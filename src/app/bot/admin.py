@@ -2,8 +2,13 @@ from vkbottle.bot import BotLabeler
 from vkbottle.user import Message
 
 from app.bot import messages
-from app.db import add_group, change_group_course, get_course_by_group_id
-from app.utils import get_group_id, group_is_added, handle_course
+from app.db import (
+    CourseChange,
+    add_group_if_absent,
+    set_group_course,
+    unit_of_work,
+)
+from app.utils import get_group_id, handle_course
 
 admin_labeler = BotLabeler()
 admin_labeler.vbml_ignore_case = True
@@ -11,20 +16,20 @@ admin_labeler.vbml_ignore_case = True
 
 @admin_labeler.message(text="Изменить курс <course>")
 async def change_course(message: Message, course: str) -> None:
-    if not await handle_course(message, course, check=True):
+    if not await handle_course(message, course):
         return
 
-    group_id = get_group_id(message)
-    if not await group_is_added(group_id):
+    # A single conditional UPDATE both checks and changes the course,
+    # answered once the command's one session has committed
+    async with unit_of_work():
+        outcome = await set_group_course(get_group_id(message), int(course))
+    if outcome is CourseChange.MISSING:
         await message.answer("Вашей беседы ещё нет в списке")
         return
-
-    if int(course) == await get_course_by_group_id(group_id):
+    if outcome is CourseChange.UNCHANGED:
         await message.answer("Группе уже присвоен %s курс" % course)
         return
 
-    await change_group_course(group_id, int(course))
-
     await message.answer(messages.EDITED_SUCCESSFULLY % {"course": course})
 
 
@@ -33,12 +38,11 @@ async def add(message: Message, course: str) -> None:
     if not await handle_course(message, course):
         return
 
-    group_id = get_group_id(message)
-    if await group_is_added(group_id):
+    async with unit_of_work():
+        added = await add_group_if_absent(get_group_id(message), int(course))
+    if not added:
         await message.answer("Ваша беседа уже есть в списке")
         return
 
-    await add_group(group_id, int(course))
-
     await message.answer(messages.ADDED_SUCCESSFULLY % {"course": course})
     await message.answer(messages.WELCOME % {"course": course})
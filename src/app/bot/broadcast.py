@@ -5,7 +5,9 @@ from vkbottle.bot import BotLabeler
 from vkbottle.user import Message
 
 import settings
-from app.broadcast import broadcast
+from app.broadcast import broadcast, enqueue_broadcast, get_broadcast_key
+from app.media import MAX_ATTACHMENTS, get_media_attachments
+from app.store import store
 
 logger = logging.getLogger(__name__)
 
@@ -28,14 +30,25 @@ def get_results(broadcast_result):
     return "\n".join(results)
 
 
+def get_report(broadcast_result) -> str:
+    results = get_results(broadcast_result)
+    if "+" in results and "-" not in results:
+        text_answer = "Рассылка успешно отправлена!"
+    elif "+" in results:
+        text_answer = "Рассылка отправлена не полностью."
+    else:
+        text_answer = "Не удалось отправить рассылку."
+    return f"{text_answer}\n\n{results}"
+
+
 def get_text(message: Message, text: str | None) -> str | None:
     if message.fwd_messages:
-        logger.info(f"Found forward message: {message.fwd_messages[0].text}")
+        logger.info("Found forward message: %s", message.fwd_messages[0].text)
         return "\n\n".join(
             fwd_message.text for fwd_message in message.fwd_messages
         )
     if message.reply_message:
-        logger.info(f"Found reply message: {message.reply_message.text}")
+        logger.info("Found reply message: %s", message.reply_message.text)
         return str(message.reply_message.text)
     logger.info("Did not found forward message")
     return text
@@ -44,7 +57,7 @@ def get_text(message: Message, text: str | None) -> str | None:
 def get_attachments(message: Message) -> str | None:
     attachments = message.get_wall_attachment()
     if attachments:
-        logger.info(f"Found attachments: {attachments[0]}")
+        logger.info("Found attachments: %s", attachments[0])
         return f"wall{attachments[0].owner_id}_{attachments[0].id}"
     return None
 
@@ -66,24 +79,52 @@ async def sharing_text(message: Message) -> None:
 
     _text = get_text(message, text)
     _attachment = get_attachments(message)
+    attachments = [_attachment] if _attachment else []
+    media, failed = await get_media_attachments(message)
+    attachments.extend(media)
+
+    # Without its media the broadcast is not sent at all
+    if failed:
+        await message.answer(
+            f"Не удалось загрузить вложения: {failed}. Рассылка не отправлена"
+        )
+        return
+
+    if len(attachments) > MAX_ATTACHMENTS:
+        await message.answer(
+            f"Слишком много вложений: {len(attachments)}, "
+            f"можно не больше {MAX_ATTACHMENTS}"
+        )
+        return
 
-    if not _text and not _attachment:
+    if not _text and not attachments:
         await message.answer("Нечего пересылать")
         return
 
-    broadcast_result = await broadcast(
-        courses,
-        text=_text,
-        attachment=[_attachment] if _attachment else None,
-    )
+    if settings.BROADCAST_QUEUE:
+        job_id = await enqueue_broadcast(
+            courses,
+            text=_text,
+            attachment=attachments or None,
+            peer_id=message.peer_id,
+        )
+        if job_id is None:
+            await message.answer("Не удалось отправить рассылку.")
+        else:
+            await message.answer(f"Рассылка #{job_id} поставлена в очередь")
+        return
 
-    if "+" in get_results(broadcast_result) and "-" not in get_results(
-        broadcast_result
-    ):
-        text_answer = "Рассылка успешно отправлена!"
-    elif "+" in get_results(broadcast_result):
-        text_answer = "Рассылка отправлена не полностью."
-    else:
-        text_answer = "Не удалось отправить рассылку."
+    # Another worker may already be sending it, for a retried event
+    # or the same command sent twice
+    key = get_broadcast_key(courses, _text, attachments or None)
+    with store.lock(key, settings.BROADCAST_LOCK_TTL) as acquired:
+        if not acquired:
+            await message.answer("Эта рассылка уже отправляется")
+            return
+        broadcast_result = await broadcast(
+            courses,
+            text=_text,
+            attachment=attachments or None,
+        )
 
-    await message.answer(f"{text_answer}\n\n{get_results(broadcast_result)}")
+    await message.answer(get_report(broadcast_result))
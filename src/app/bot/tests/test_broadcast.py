@@ -3,6 +3,8 @@ from pytest_lazy_fixtures import lf
 from vkbottle.user import Message
 
 from app.bot.broadcast import sharing_text
+from app.broadcast import get_broadcast_key
+from app.store import store
 
 
 @pytest.fixture()
@@ -19,6 +21,7 @@ def message_simple(mocker, attachment):
     msg.answer = mocker.AsyncMock(return_value=1)
     msg.from_id = 1
     msg.get_wall_attachment.return_value = [attachment]
+    msg.attachments = []
     msg.fwd_messages = []
     msg.reply_message = None
     msg.text = "рассылка: 123 text"
@@ -29,6 +32,7 @@ def message_simple(mocker, attachment):
 def message_with_reply(mocker, message_simple):
     reply = mocker.Mock()
     reply.text = "text"
+    reply.attachments = []
     message_simple.reply_message = reply
     return message_simple
 
@@ -37,6 +41,7 @@ def message_with_reply(mocker, message_simple):
 def message_with_fwd(mocker, message_simple):
     reply = mocker.Mock()
     reply.text = "text"
+    reply.attachments = []
     message_simple.fwd_messages = [reply]
     return message_simple
 
@@ -139,6 +144,23 @@ async def test_sharing_text(
     broadcast_mock.assert_awaited()
 
 
+@pytest.mark.asyncio
+async def test_sharing_text_locked(message_simple, mocker):
+    mocker.patch("app.bot.broadcast.settings.ADMINS", [1])
+    broadcast_mock = mocker.patch(
+        "app.bot.broadcast.broadcast", new_callable=mocker.AsyncMock
+    )
+    key = get_broadcast_key("123", "text", ["wall1_1"])
+
+    with store.lock(key, 10):
+        await sharing_text(message_simple)
+
+    broadcast_mock.assert_not_awaited()
+    message_simple.answer.assert_called_once_with(
+        "Эта рассылка уже отправляется"
+    )
+
+
 @pytest.mark.asyncio
 async def test_sharing_text_forbidden(mocker):
     message = mocker.Mock()
@@ -150,3 +172,31 @@ async def test_sharing_text_forbidden(mocker):
 
     result = await sharing_text(message)
     assert result is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "job_id, expected_result",
+    [
+        (7, "Рассылка #7 поставлена в очередь"),
+        (None, "Не удалось отправить рассылку."),
+    ],
+)
+async def test_sharing_text_queue(
+    message_simple, mocker, job_id, expected_result
+):
+    message_simple.peer_id = 42
+    mocker.patch("app.bot.broadcast.settings.ADMINS", [1])
+    mocker.patch("app.bot.broadcast.settings.BROADCAST_QUEUE", True)
+    enqueue_broadcast_mock = mocker.patch(
+        "app.bot.broadcast.enqueue_broadcast",
+        new_callable=mocker.AsyncMock,
+        return_value=job_id,
+    )
+
+    await sharing_text(message_simple)
+
+    enqueue_broadcast_mock.assert_awaited_once_with(
+        "123", text="text", attachment=["wall1_1"], peer_id=42
+    )
+    message_simple.answer.assert_called_once_with(expected_result)
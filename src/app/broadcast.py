@@ -1,59 +1,448 @@
 import asyncio
+import hashlib
+import json
 import logging
-from typing import Coroutine
+import random
+import secrets
+import time
+from collections import Counter
+from contextvars import ContextVar
+from itertools import chain, islice
+from typing import Any, Callable, Coroutine, Iterable
 
 import aiohttp
 from vkbottle import VKAPIError
 
 import settings
-from app.db import delete_group, get_group_ids_by_course
+from app.db import (
+    create_broadcast_job,
+    delete_groups,
+    finish_broadcast_job,
+    get_group_registry,
+    record_deliveries,
+)
 from app.exceptions import DBError
+from app.metrics import (
+    BROADCAST_BATCHES_IN_FLIGHT,
+    BROADCAST_MESSAGES,
+    BROADCAST_RETRIES,
+    BROADCASTS_IN_FLIGHT,
+)
 from app.vk import bot
 
 logger = logging.getLogger(__name__)
 
+# Too many requests, flood control, internal server error,
+# and None for network errors and timeouts. A retry repeats
+# the random_id of the first try, see get_random_id
+RETRYABLE_ERRORS = (6, 9, 10, None)
+
+
+class BroadcastState:
+    # Per-broadcast details the send functions report besides success
+    def __init__(self, job_id: int | None = None) -> None:
+        self.job_id = job_id
+        # Seeds the random_id of every send, an untracked broadcast
+        # gets its own
+        self.send_key = secrets.token_hex(8) if job_id is None else job_id
+        self.error_codes: dict[int, int | None] = {}
+        self.dead_groups: set[int] = set()
+        self.retry_budget = settings.BROADCAST_RETRY_BUDGET
+        # Final outcomes, after the retries
+        self.total = 0
+        self.failures: dict[int, int | None] = {}
+        # Outcomes not written to the job's deliveries yet
+        self.deliveries: list[tuple[int, bool, int | None, float]] = []
+        self.flushed_at = time.monotonic()
+
+
+broadcast_state: ContextVar[BroadcastState | None] = ContextVar(
+    "broadcast_state", default=None
+)
+
+
+def set_error(
+    group: int,
+    error_code: int | None,
+    log: Callable[[Any], None],
+    error: Any,
+) -> None:
+    # A broadcast collects the errors of its sends for one summary
+    # record, a send outside of a broadcast logs its own
+    state = broadcast_state.get()
+    if state is None:
+        log(error)
+        return
+    state.error_codes[group] = error_code
+
+
+def log_failures(state: BroadcastState) -> None:
+    if not state.failures:
+        return
+    errors = Counter(
+        "network" if code is None else str(code)
+        for code in state.failures.values()
+    )
+    logger.warning(
+        "Broadcast %s failed for %d of %d groups, errors: %s",
+        state.job_id,
+        len(state.failures),
+        state.total,
+        ", ".join(f"{code} x{count}" for code, count in errors.items()),
+        extra={
+            "job_id": state.job_id,
+            "failed": len(state.failures),
+            "groups": state.total,
+            "errors": dict(errors),
+            "failed_groups": sorted(state.failures)[:20],
+        },
+    )
+
+
+async def prune_groups(state: BroadcastState) -> None:
+    group_ids = sorted(state.dead_groups)
+    state.dead_groups.clear()
+    try:
+        await delete_groups(group_ids)
+    except DBError as error:
+        # They fail with error 7 again and are collected next time
+        logger.error(error)
+
+
+async def drop_group(group: int) -> None:
+    state = broadcast_state.get()
+    if state is None:
+        await delete_groups([group])
+        return
+    state.dead_groups.add(group)
+    if len(state.dead_groups) >= settings.PRUNE_BATCH_SIZE:
+        await prune_groups(state)
+
+
+def get_random_id(peer_ids: Iterable[int]) -> int:
+    # VK drops a send that repeats the random_id of a recent one to the
+    # same peers, so retrying a send that timed out after it reached VK
+    # does not deliver it twice. Zero turns the check off
+    state = broadcast_state.get()
+    if state is None:
+        return 0
+    content = f"{state.send_key}:{','.join(map(str, peer_ids))}"
+    digest = hashlib.sha256(content.encode()).digest()
+    return int.from_bytes(digest[:4], "big") & 0x7FFFFFFF or 1
+
 
 async def group_broadcast(
     group: int, text: str | None, attachment: list | None
 ) -> bool:
+    peer_id = settings.GROUP_ID_COEFFICIENT + group
     try:
         await bot.api.messages.send(
-            peer_id=(settings.GROUP_ID_COEFFICIENT + group),
+            peer_id=peer_id,
             message=text,
             attachment=attachment,
-            random_id=0,
+            random_id=get_random_id([peer_id]),
         )
     except VKAPIError[7] as exception:
-        logger.warning(exception)
-        await delete_group(group)
+        set_error(group, exception.code, logger.warning, exception)
+        await drop_group(group)
     except VKAPIError as exception:
-        logger.error(exception)
-    except aiohttp.ClientConnectorError as exception:
-        logger.exception(exception)
+        set_error(group, exception.code, logger.error, exception)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as exception:
+        set_error(group, None, logger.exception, exception)
     else:
         return True
     return False
 
 
+def get_send_params(
+    peer_ids: list[int], text: str | None, attachment: list | None
+) -> dict:
+    params: dict = {"random_id": get_random_id(peer_ids)}
+    if text is not None:
+        params["message"] = text
+    if attachment:
+        params["attachment"] = ",".join(attachment)
+    return params
+
+
+def batch_failed(
+    groups: list[int],
+    error_code: int | None,
+    log: Callable[[Any], None],
+    error: Any,
+) -> list[bool]:
+    # Logged once for the batch outside of a broadcast
+    state = broadcast_state.get()
+    if state is None:
+        log(error)
+    else:
+        state.error_codes.update(dict.fromkeys(groups, error_code))
+    return [False] * len(groups)
+
+
+def get_execute_code(
+    groups: list[int], text: str | None, attachment: list | None
+) -> str:
+    calls = []
+    for group in groups:
+        peer_id = settings.GROUP_ID_COEFFICIENT + group
+        params = {
+            "peer_id": peer_id,
+            **get_send_params([peer_id], text, attachment),
+        }
+        calls.append(
+            f"API.messages.send({json.dumps(params, ensure_ascii=False)})"
+        )
+    # vkbottle checks every item of a list response for an "error" key,
+    # which fails on the ids and false values messages.send returns
+    return 'return {"sent": [' + ",".join(calls) + "]};"
+
+
+async def execute_broadcast(
+    groups: list[int], text: str | None, attachment: list | None
+) -> list[bool]:
+    try:
+        response = await bot.api.request(
+            "execute", {"code": get_execute_code(groups, text, attachment)}
+        )
+    except VKAPIError as exception:
+        return batch_failed(groups, exception.code, logger.error, exception)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as exception:
+        return batch_failed(groups, None, logger.exception, exception)
+
+    # Failed calls return false, their errors are listed in call order
+    errors = iter(response.get("execute_errors") or [])
+    sent = (response.get("response") or {}).get("sent") or []
+    result: list[bool] = []
+    for index, group in enumerate(groups):
+        if index < len(sent) and sent[index]:
+            result.append(True)
+            continue
+        error: dict = next(errors, {})
+        if error.get("error_code") == 7:
+            set_error(group, 7, logger.warning, error)
+            await drop_group(group)
+        else:
+            set_error(group, error.get("error_code"), logger.error, error)
+        result.append(False)
+    return result
+
+
+async def peers_broadcast(
+    groups: list[int], text: str | None, attachment: list | None
+) -> list[bool]:
+    peer_ids = [settings.GROUP_ID_COEFFICIENT + group for group in groups]
+    try:
+        response = await bot.api.request(
+            "messages.send",
+            {
+                "peer_ids": ",".join(map(str, peer_ids)),
+                **get_send_params(peer_ids, text, attachment),
+            },
+        )
+    except VKAPIError as exception:
+        return batch_failed(groups, exception.code, logger.error, exception)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as exception:
+        return batch_failed(groups, None, logger.exception, exception)
+
+    statuses = {item["peer_id"]: item for item in response["response"]}
+    result: list[bool] = []
+    for group, peer_id in zip(groups, peer_ids):
+        status = statuses.get(peer_id)
+        if status is not None and "error" not in status:
+            result.append(True)
+            continue
+        error = (status or {}).get("error", {})
+        if error.get("code") == 7:
+            set_error(group, 7, logger.warning, error)
+            await drop_group(group)
+        else:
+            set_error(group, error.get("code"), logger.error, error)
+        result.append(False)
+    return result
+
+
+async def batch_broadcast(
+    groups: list[int], text: str | None, attachment: list | None
+) -> list[bool]:
+    if settings.BROADCAST_MODE == "execute":
+        return await execute_broadcast(groups, text, attachment)
+    if settings.BROADCAST_MODE == "peer_ids":
+        return await peers_broadcast(groups, text, attachment)
+    return [await group_broadcast(group, text, attachment) for group in groups]
+
+
+def get_batches(ids: Iterable[int]) -> list[list[int]]:
+    size = 1
+    if settings.BROADCAST_MODE == "execute":
+        size = settings.EXECUTE_BATCH_SIZE
+    elif settings.BROADCAST_MODE == "peer_ids":
+        size = settings.PEER_IDS_BATCH_SIZE
+    iterator = iter(ids)
+    return list(iter(lambda: list(islice(iterator, size)), []))
+
+
+async def flush_deliveries(state: BroadcastState) -> None:
+    deliveries = state.deliveries
+    state.deliveries = []
+    state.flushed_at = time.monotonic()
+    if state.job_id is None or not deliveries:
+        return
+    try:
+        await record_deliveries(state.job_id, deliveries)
+    except DBError as error:
+        logger.error(error)
+
+
+async def record_batch(
+    groups: list[int], sent: list[bool], latency_ms: float
+) -> None:
+    state = broadcast_state.get()
+    if state is None or not groups:
+        return
+    state.total += len(groups)
+    state.failures.update(
+        (group, state.error_codes.get(group))
+        for group, ok in zip(groups, sent)
+        if not ok
+    )
+    if state.job_id is None:
+        return
+    state.deliveries.extend(
+        (group, ok, None if ok else state.error_codes.get(group), latency_ms)
+        for group, ok in zip(groups, sent)
+    )
+    # Written in bulk off the send path, often enough for the progress
+    # stream, and at the end of the broadcast
+    if (
+        len(state.deliveries) >= settings.DELIVERY_FLUSH_SIZE
+        or time.monotonic() - state.flushed_at >= settings.PROGRESS_INTERVAL
+    ):
+        await flush_deliveries(state)
+
+
+def get_retries(groups: list[int], sent: list[bool], attempt: int) -> set[int]:
+    # Retries are taken from the budget of the running broadcast
+    state = broadcast_state.get()
+    if state is None or attempt >= settings.BROADCAST_RETRY_ATTEMPTS:
+        return set()
+    retries = [
+        group
+        for group, ok in zip(groups, sent)
+        if not ok
+        and group in state.error_codes
+        and state.error_codes[group] in RETRYABLE_ERRORS
+    ][: max(state.retry_budget, 0)]
+    state.retry_budget -= len(retries)
+    return set(retries)
+
+
+def get_backoff(attempt: int) -> float:
+    # Exponential backoff with full jitter
+    delay = min(
+        settings.BROADCAST_RETRY_BACKOFF_MAX,
+        settings.BROADCAST_RETRY_BACKOFF * 2**attempt,
+    )
+    return random.uniform(0, delay)  # nosec
+
+
+async def groups_broadcast(
+    ids: Iterable[int], text: str | None, attachment: list | None
+) -> list[bool]:
+    semaphore = asyncio.Semaphore(settings.BROADCAST_CONCURRENCY)
+
+    async def send(batch: list[int], attempt: int = 0) -> list[bool]:
+        async with semaphore:
+            started = time.monotonic()
+            with BROADCAST_BATCHES_IN_FLIGHT.track_inprogress():
+                sent = await batch_broadcast(batch, text, attachment)
+            latency_ms = (time.monotonic() - started) * 1000
+        retries = get_retries(batch, sent, attempt)
+        done = [
+            (group, ok)
+            for group, ok in zip(batch, sent)
+            if group not in retries
+        ]
+        BROADCAST_MESSAGES.labels("sent").inc(sum(ok for _, ok in done))
+        BROADCAST_MESSAGES.labels("failed").inc(sum(not ok for _, ok in done))
+        await record_batch(
+            [group for group, _ in done], [ok for _, ok in done], latency_ms
+        )
+        if not retries:
+            return sent
+        # The backoff is waited out of the semaphore,
+        # healthy batches keep going meanwhile
+        BROADCAST_RETRIES.inc(len(retries))
+        await asyncio.sleep(get_backoff(attempt))
+        retry_batches = get_batches(
+            group for group in batch if group in retries
+        )
+        results = await asyncio.gather(
+            *(send(retry, attempt + 1) for retry in retry_batches)
+        )
+        retried = dict(
+            zip(
+                chain.from_iterable(retry_batches),
+                chain.from_iterable(results),
+            )
+        )
+        return [retried.get(group, ok) for group, ok in zip(batch, sent)]
+
+    result = await asyncio.gather(*map(send, get_batches(ids)))
+    return list(chain.from_iterable(result))
+
+
 async def course_broadcast(
     course: int, text: str | None, attachment: list | None
 ) -> tuple[int, tuple[bool]]:
     try:
-        ids = await get_group_ids_by_course(course)
+        registry = await get_group_registry()
     except DBError as error:
         logger.error(error)
         return course, (False,)
 
+    ids = registry.get_group_ids(course)
+
     if not ids:
         return course, (False,)
 
-    result: list[bool] = []
-    for group in ids:
-        res = await group_broadcast(group, text, attachment)
-        result.append(res)
+    result = await groups_broadcast(ids, text, attachment)
     return course, tuple(result)  # type: ignore[return-value]
 
 
+async def create_job(
+    courses: str,
+    text: str | None,
+    attachment: list | None,
+    peer_id: int | None,
+    queued: bool,
+) -> int | None:
+    try:
+        registry = await get_group_registry()
+        groups = [
+            (group, int(course))
+            for course in sorted(set(courses))
+            for group in registry.get_group_ids(int(course))
+        ]
+        if not groups:
+            return None
+        job_id: int = await create_broadcast_job(
+            courses, text, attachment, peer_id, groups, queued
+        )
+        return job_id
+    except DBError as error:
+        logger.error(error)
+        return None
+
+
+def get_broadcast_key(
+    courses: str, text: str | None, attachment: list | None
+) -> str:
+    # Same courses, text and attachments make the same broadcast
+    content = json.dumps(["".join(sorted(set(courses))), text, attachment])
+    return f"broadcast:{hashlib.sha256(content.encode()).hexdigest()}"
+
+
 async def broadcast(
     courses: str,
     text: str | None = None,
@@ -62,8 +451,36 @@ async def broadcast(
     if not courses.isnumeric():
         logger.error("Courses is not numeric")
         return None
+    # Without a job row the broadcast still goes out, only untracked
+    job_id = await create_job(courses, text, attachment, None, False)
     coroutines: list[Coroutine] = []
     for course in sorted(set(courses)):
         coroutines.append(course_broadcast(int(course), text, attachment))
-    done = await asyncio.gather(*coroutines)
+    state = BroadcastState(job_id)
+    token = broadcast_state.set(state)
+    try:
+        with BROADCASTS_IN_FLIGHT.track_inprogress():
+            done = await asyncio.gather(*coroutines)
+    finally:
+        broadcast_state.reset(token)
+        await flush_deliveries(state)
+        await prune_groups(state)
+        log_failures(state)
+    if job_id is not None:
+        try:
+            await finish_broadcast_job(job_id)
+        except DBError as error:
+            logger.error(error)
     return tuple(done)  # type: ignore[return-value]
+
+
+async def enqueue_broadcast(
+    courses: str,
+    text: str | None = None,
+    attachment: list | None = None,
+    peer_id: int | None = None,
+) -> int | None:
+    if not courses.isnumeric():
+        logger.error("Courses is not numeric")
+        return None
+    return await create_job(courses, text, attachment, peer_id, True)
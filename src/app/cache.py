@@ -0,0 +1,106 @@
+import time
+from typing import Iterable
+
+import settings
+from app.store import SharedStore, store
+
+VERSION_KEY = "groups:version"
+
+
+class GroupRegistry:
+    # In-process copy of student_groups indexed by id and by course.
+    # A copy expires after its TTL or once another process bumps the
+    # registry version in the shared store. The version is read at most
+    # once per check_interval, not on every lookup.
+
+    def __init__(
+        self,
+        shared_store: SharedStore,
+        ttl: float,
+        check_interval: float = 0.0,
+    ) -> None:
+        self.store = shared_store
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self._courses: dict[int, int] = {}
+        self._groups: dict[int, set[int]] = {}
+        self._loaded_at: float | None = None
+        self._checked_at = 0.0
+        self._version: int | None = None
+
+    def __contains__(self, group_id: int) -> bool:
+        return group_id in self._courses
+
+    def __len__(self) -> int:
+        return len(self._courses)
+
+    def get_version(self) -> int | None:
+        version: int | None = self.store.get(VERSION_KEY)
+        return version
+
+    def is_stale(self) -> bool:
+        if self._loaded_at is None:
+            return True
+        now = time.monotonic()
+        if now - self._loaded_at > self.ttl:
+            return True
+        if now - self._checked_at < self.check_interval:
+            return False
+        self._checked_at = now
+        return self.get_version() != self._version
+
+    def load(
+        self, groups: Iterable[tuple[int, int]], version: int | None
+    ) -> None:
+        self._courses = {}
+        self._groups = {}
+        for group_id, course in groups:
+            self._set(group_id, course)
+        self._loaded_at = self._checked_at = time.monotonic()
+        self._version = version
+
+    def clear(self) -> None:
+        self._courses = {}
+        self._groups = {}
+        self._loaded_at = None
+        self._version = None
+
+    def get_course(self, group_id: int) -> int | None:
+        return self._courses.get(group_id)
+
+    def get_group_ids(self, course: int) -> list[int]:
+        return sorted(self._groups.get(course, ()))
+
+    def _set(self, group_id: int, course: int) -> None:
+        self._remove(group_id)
+        self._courses[group_id] = course
+        self._groups.setdefault(course, set()).add(group_id)
+
+    def _remove(self, group_id: int) -> None:
+        course = self._courses.pop(group_id, None)
+        if course is not None:
+            self._groups[course].discard(group_id)
+
+    def _bump(self) -> None:
+        version = self.store.update(VERSION_KEY, lambda v: (v or 0) + 1)
+        # Another process wrote since our load, so our copy is behind
+        if version != (self._version or 0) + 1:
+            self._loaded_at = None
+        self._version = version
+
+    def put(self, group_id: int, course: int) -> None:
+        self._set(group_id, course)
+        self._bump()
+
+    def discard(self, group_id: int) -> None:
+        self.discard_many((group_id,))
+
+    def discard_many(self, group_ids: Iterable[int]) -> None:
+        for group_id in group_ids:
+            self._remove(group_id)
+        self._bump()
+
+
+group_registry = GroupRegistry(
+    store, settings.GROUP_CACHE_TTL, settings.GROUP_CACHE_CHECK_INTERVAL
+)
@@ -1,44 +1,221 @@
 import logging
-from functools import wraps
-from typing import Iterable
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from enum import Enum
+from functools import partial, wraps
+from typing import Any, AsyncIterator, Callable, Iterable, cast
 
-from sqlalchemy import Column, Integer
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    Text,
+    event,
+    func,
+    or_,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
 from sqlalchemy.exc import DBAPIError
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession,
+    create_async_engine,
+)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.sql.expression import delete, insert, select, update
+from sqlalchemy.sql.expression import bindparam, delete, insert, select, update
 
+import settings
+from app.cache import GroupRegistry, group_registry
 from app.exceptions import DBError
-from settings import DB_PATH
+from app.metrics import DB_ERRORS, DB_SECONDS, track
+
+
+def get_profile(url: str, profile: str) -> str:
+    if profile != "auto":
+        return profile
+    database = make_url(url)
+    backend = database.get_backend_name()
+    if backend == "postgresql":
+        return "postgres"
+    if backend == "sqlite" and database.database not in (None, ":memory:"):
+        return "sqlite"
+    return "default"
+
+
+def get_engine_options(profile: str) -> dict[str, Any]:
+    if profile == "postgres":
+        return {
+            "pool_size": settings.DB_POOL_SIZE,
+            "max_overflow": settings.DB_MAX_OVERFLOW,
+            "pool_timeout": settings.DB_POOL_TIMEOUT,
+            "pool_recycle": settings.DB_POOL_RECYCLE,
+            "pool_pre_ping": settings.DB_POOL_PRE_PING,
+            "connect_args": {
+                "prepared_statement_cache_size": (
+                    settings.DB_STATEMENT_CACHE_SIZE
+                ),
+                # Our queries are too short to pay off JIT compilation
+                "server_settings": {"jit": "off"},
+            },
+        }
+    if profile == "sqlite":
+        # A local file does not drop connections
+        return {"pool_pre_ping": False}
+    return {"pool_pre_ping": True}
+
+
+def set_sqlite_pragmas(dbapi_connection: Any, _: Any) -> None:
+    # Readers do not wait for the writer, a commit is not synced
+    # to disk until a checkpoint, reads skip the page cache copy
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA mmap_size={int(settings.SQLITE_MMAP_SIZE)}")
+    cursor.close()
+
+
+def make_engine(url: str, profile: str) -> AsyncEngine:
+    profile = get_profile(url, profile)
+    engine = create_async_engine(
+        url, echo=settings.DB_ECHO, **get_engine_options(profile)
+    )
+    if profile == "sqlite":
+        event.listen(engine.sync_engine, "connect", set_sqlite_pragmas)
+    return engine
+
 
 Base = declarative_base()
-engine = create_async_engine(DB_PATH, echo=True, pool_pre_ping=True)
+engine = make_engine(settings.DB_PATH, settings.DB_PROFILE)
 SessionLocal = sessionmaker(
-    autocommit=False, autoflush=False, bind=engine, class_=AsyncSession
+    autocommit=False,
+    autoflush=False,
+    expire_on_commit=False,
+    bind=engine,
+    class_=AsyncSession,
 )
 
 
+class CourseChange(Enum):
+    CHANGED = "changed"
+    UNCHANGED = "unchanged"
+    MISSING = "missing"
+
+
 class StudentGroup(Base):  # type: ignore[valid-type,misc]
     __tablename__ = "student_groups"
+    # Covers per-course id lookups without touching the table
+    __table_args__ = (Index("ix_student_groups_course_id", "course", "id"),)
 
     id = Column(Integer, primary_key=True)
     course = Column(Integer, nullable=False)
 
 
+class BroadcastJob(Base):  # type: ignore[valid-type,misc]
+    __tablename__ = "broadcast_jobs"
+
+    id = Column(Integer, primary_key=True)
+    courses = Column(String, nullable=False)
+    text = Column(Text, nullable=True)
+    attachment = Column(String, nullable=True)
+    peer_id = Column(BigInteger, nullable=True)
+    status = Column(String, nullable=False, default="pending")
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+
+class BroadcastDelivery(Base):  # type: ignore[valid-type,misc]
+    __tablename__ = "broadcast_deliveries"
+    __table_args__ = (
+        Index("ix_broadcast_deliveries_status_id", "status", "id"),
+        # Deliveries are updated by (job_id, group_id) as batches finish
+        Index("ix_broadcast_deliveries_job_id_group_id", "job_id", "group_id"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    job_id = Column(
+        Integer,
+        ForeignKey("broadcast_jobs.id", ondelete="CASCADE"),
+        nullable=False,
+    )
+    group_id = Column(Integer, nullable=False)
+    course = Column(Integer, nullable=False)
+    status = Column(String, nullable=False, default="pending")
+    attempts = Column(Integer, nullable=False, default=0)
+    lease_until = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, nullable=True)
+    error_code = Column(Integer, nullable=True)
+    latency_ms = Column(Float, nullable=True)
+
+
+current_session: ContextVar[AsyncSession | None] = ContextVar(
+    "current_session", default=None
+)
+
+
+@asynccontextmanager
+async def unit_of_work() -> AsyncIterator[AsyncSession]:
+    # One session for every db helper called inside the block,
+    # committed once when the block exits without an error
+    session = current_session.get()
+    if session is not None:
+        yield session
+        return
+    async with cast(AsyncSession, SessionLocal()) as session:
+        token = current_session.set(session)
+        try:
+            yield session
+            await session.commit()
+        except DBAPIError as err:
+            logging.error("Database error")
+            raise DBError() from err
+        finally:
+            current_session.reset(token)
+    for callback in session.info.get("on_commit", ()):
+        callback()
+
+
+async def commit(session: AsyncSession) -> None:
+    if session is not current_session.get():
+        await session.commit()
+
+
+def on_commit(session: AsyncSession, callback: Callable[[], None]) -> None:
+    # Caches follow the database only once the changes are committed
+    if session is current_session.get():
+        session.info.setdefault("on_commit", []).append(callback)
+    else:
+        callback()
+
+
 def db_connect(func):
     @wraps(func)
     async def wrapper(*args, **kwargs):
-        async with SessionLocal() as session:
-            try:
-                return await func(*args, session=session, **kwargs)
-            except DBAPIError as err:
-                logging.error("Database error")
-                raise DBError() from err
-            except Exception as err:
-                logging.critical("Unexpected error")
-                raise DBError() from err
+        session = current_session.get()
+        try:
+            with track(seconds, "db"):
+                if session is not None:
+                    return await func(*args, session=session, **kwargs)
+                async with SessionLocal() as session:
+                    return await func(*args, session=session, **kwargs)
+        except DBAPIError as err:
+            errors.inc()
+            logging.error("Database error")
+            raise DBError() from err
+        except Exception as err:
+            errors.inc()
+            logging.critical("Unexpected error")
+            raise DBError() from err
 
+    seconds = DB_SECONDS.labels(wrapper.__name__)
+    errors = DB_ERRORS.labels(wrapper.__name__)
     return wrapper
 
 
@@ -47,17 +224,36 @@ async def delete_group(group_id: int, *, session: AsyncSession) -> None:
     await session.execute(
         delete(StudentGroup).where(StudentGroup.id == group_id)  # type: ignore
     )
-    await session.commit()
+    await commit(session)
+    on_commit(session, partial(group_registry.discard, group_id))
+
+
+@db_connect
+async def delete_groups(
+    group_ids: Iterable[int], *, session: AsyncSession
+) -> None:
+    group_ids = list(group_ids)
+    if not group_ids:
+        return
+    await session.execute(
+        delete(StudentGroup).where(  # type: ignore
+            StudentGroup.id.in_(group_ids)
+        )
+    )
+    await commit(session)
+    on_commit(session, partial(group_registry.discard_many, group_ids))
 
 
 @db_connect
 async def get_group_ids_by_course(
     course: int, *, session: AsyncSession
 ) -> Iterable[int]:
-    group_ids = await session.execute(
-        select(StudentGroup).where(StudentGroup.course == course)
+    group_ids = await session.scalars(
+        select(StudentGroup.id)
+        .where(StudentGroup.course == course)
+        .order_by(StudentGroup.id)
     )
-    return [group_id[0].id for group_id in group_ids]
+    return list(group_ids)
 
 
 @db_connect
@@ -72,8 +268,25 @@ async def get_course_by_group_id(
 
 @db_connect
 async def get_groups_ids(*, session: AsyncSession) -> Iterable[int]:
-    group_ids = (await session.execute(select(StudentGroup))).all()
-    return [group_id[0].id for group_id in group_ids]
+    group_ids = await session.scalars(
+        select(StudentGroup.id).order_by(StudentGroup.id)
+    )
+    return list(group_ids)
+
+
+@db_connect
+async def get_groups(*, session: AsyncSession) -> list[tuple[int, int]]:
+    groups = await session.execute(
+        select(StudentGroup.id, StudentGroup.course)
+    )
+    return [(group.id, group.course) for group in groups]
+
+
+async def get_group_registry() -> GroupRegistry:
+    if group_registry.is_stale():
+        version = group_registry.get_version()
+        group_registry.load(await get_groups(), version)
+    return group_registry
 
 
 @db_connect
@@ -89,7 +302,8 @@ async def add_group(
             }
         ],
     )
-    await session.commit()
+    await commit(session)
+    on_commit(session, partial(group_registry.put, group_id, course))
 
 
 @db_connect
@@ -101,4 +315,265 @@ async def change_group_course(
         .where(StudentGroup.id == group_id)
         .values(course=course)
     )
-    await session.commit()
+    await commit(session)
+    on_commit(session, partial(group_registry.put, group_id, course))
+
+
+def get_insert(session: AsyncSession):
+    # Both dialects support INSERT ... ON CONFLICT ... RETURNING
+    if session.bind.dialect.name == "postgresql":
+        return postgresql.insert
+    return sqlite.insert
+
+
+@db_connect
+async def add_group_if_absent(
+    group_id: int, course: int, *, session: AsyncSession
+) -> bool:
+    added = await session.scalar(
+        get_insert(session)(StudentGroup)
+        .values(id=group_id, course=course)
+        .on_conflict_do_nothing(index_elements=[StudentGroup.id])
+        .returning(StudentGroup.id)
+    )
+    await commit(session)
+    if added is None:
+        return False
+    on_commit(session, partial(group_registry.put, group_id, course))
+    return True
+
+
+@db_connect
+async def set_group_course(
+    group_id: int, course: int, *, session: AsyncSession
+) -> CourseChange:
+    changed = await session.scalar(
+        update(StudentGroup)  # type: ignore
+        .where(StudentGroup.id == group_id)
+        .where(StudentGroup.course != course)
+        .values(course=course)
+        .returning(StudentGroup.id)
+    )
+    await commit(session)
+    if changed is not None:
+        on_commit(session, partial(group_registry.put, group_id, course))
+        return CourseChange.CHANGED
+    # Only a no-op needs the second query to tell its reason
+    exists = await session.scalar(
+        select(StudentGroup.id).where(StudentGroup.id == group_id)
+    )
+    if exists is None:
+        return CourseChange.MISSING
+    return CourseChange.UNCHANGED
+
+
+@db_connect
+async def create_broadcast_job(
+    courses: str,
+    text: str | None,
+    attachment: list | None,
+    peer_id: int | None,
+    groups: Iterable[tuple[int, int]],
+    queued: bool = True,
+    *,
+    session: AsyncSession,
+) -> int:
+    # Broadcasts sent inline are recorded too, their deliveries start as
+    # "sending" so that queue workers never claim them
+    job_id: int = await session.scalar(
+        insert(BroadcastJob)  # type: ignore
+        .values(
+            courses=courses,
+            text=text,
+            attachment=",".join(attachment) if attachment else None,
+            peer_id=peer_id,
+            status="pending" if queued else "running",
+        )
+        .returning(BroadcastJob.id)
+    )
+    deliveries = [
+        {
+            "job_id": job_id,
+            "group_id": group_id,
+            "course": course,
+            "status": "pending" if queued else "sending",
+        }
+        for group_id, course in groups
+    ]
+    if deliveries:
+        await session.execute(
+            insert(BroadcastDelivery), deliveries  # type: ignore
+        )
+    await commit(session)
+    return job_id
+
+
+@db_connect
+async def get_broadcast_job(
+    job_id: int, *, session: AsyncSession
+) -> BroadcastJob | None:
+    job: BroadcastJob | None = await session.get(BroadcastJob, job_id)
+    return job
+
+
+@db_connect
+async def claim_deliveries(
+    limit: int, lease: float, *, session: AsyncSession
+) -> list[tuple[int, int, int]]:
+    # SKIP LOCKED lets workers claim disjoint rows on Postgres,
+    # SQLite drops the clause and serializes the UPDATE instead
+    now = datetime.utcnow()
+    claimable = (
+        select(BroadcastDelivery.id)
+        .where(BroadcastDelivery.status == "pending")
+        .where(
+            or_(
+                BroadcastDelivery.lease_until.is_(None),
+                BroadcastDelivery.lease_until < now,
+            )
+        )
+        .order_by(BroadcastDelivery.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    deliveries = await session.execute(
+        update(BroadcastDelivery)  # type: ignore
+        .where(BroadcastDelivery.id.in_(claimable))
+        .values(
+            lease_until=now + timedelta(seconds=lease),
+            attempts=BroadcastDelivery.attempts + 1,
+        )
+        .returning(
+            BroadcastDelivery.id,
+            BroadcastDelivery.job_id,
+            BroadcastDelivery.group_id,
+        )
+    )
+    claimed = [tuple(delivery) for delivery in deliveries]
+    await commit(session)
+    return sorted(claimed)  # type: ignore[arg-type]
+
+
+@db_connect
+async def renew_deliveries(
+    delivery_ids: list[int], lease: float, *, session: AsyncSession
+) -> None:
+    # Extends the lease of claimed deliveries that are not recorded yet
+    await session.execute(
+        update(BroadcastDelivery)  # type: ignore
+        .where(BroadcastDelivery.id.in_(delivery_ids))
+        .where(BroadcastDelivery.status == "pending")
+        .values(lease_until=datetime.utcnow() + timedelta(seconds=lease))
+    )
+    await commit(session)
+
+
+@db_connect
+async def record_deliveries(
+    job_id: int,
+    results: Iterable[tuple[int, bool, int | None, float]],
+    *,
+    session: AsyncSession,
+) -> None:
+    deliveries = BroadcastDelivery.__table__
+    now = datetime.utcnow()
+    await session.execute(
+        update(deliveries)
+        .where(deliveries.c.job_id == job_id)
+        .where(deliveries.c.group_id == bindparam("delivery_group_id"))
+        .values(
+            status=bindparam("delivery_status"),
+            error_code=bindparam("delivery_error_code"),
+            latency_ms=bindparam("delivery_latency_ms"),
+            lease_until=None,
+            updated_at=now,
+        ),
+        [
+            {
+                "delivery_group_id": group_id,
+                "delivery_status": "sent" if sent else "failed",
+                "delivery_error_code": error_code,
+                "delivery_latency_ms": latency_ms,
+            }
+            for group_id, sent, error_code, latency_ms in results
+        ],
+    )
+    await commit(session)
+
+
+@db_connect
+async def finish_broadcast_job(
+    job_id: int, *, session: AsyncSession
+) -> BroadcastJob | None:
+    # Only the worker whose UPDATE flips the status gets the job back
+    pending = (
+        select(BroadcastDelivery.id)
+        .where(BroadcastDelivery.job_id == job_id)
+        .where(BroadcastDelivery.status == "pending")
+        .exists()
+    )
+    finished: BroadcastJob | None = await session.scalar(
+        update(BroadcastJob)  # type: ignore
+        .where(BroadcastJob.id == job_id)
+        .where(BroadcastJob.status.in_(("pending", "running")))
+        .where(~pending)
+        .values(status="done", finished_at=datetime.utcnow())
+        .returning(BroadcastJob)
+    )
+    await commit(session)
+    return finished
+
+
+@db_connect
+async def get_broadcast_results(
+    job_id: int, *, session: AsyncSession
+) -> dict[int, tuple[bool, ...]]:
+    deliveries = await session.execute(
+        select(BroadcastDelivery.course, BroadcastDelivery.status)
+        .where(BroadcastDelivery.job_id == job_id)
+        .order_by(BroadcastDelivery.course, BroadcastDelivery.group_id)
+    )
+    results: dict[int, list[bool]] = {}
+    for course, status in deliveries:
+        results.setdefault(course, []).append(status == "sent")
+    return {course: tuple(sent) for course, sent in results.items()}
+
+
+@db_connect
+async def get_broadcast_jobs(
+    limit: int, *, session: AsyncSession
+) -> list[BroadcastJob]:
+    jobs = await session.scalars(
+        select(BroadcastJob).order_by(BroadcastJob.id.desc()).limit(limit)
+    )
+    return list(jobs)
+
+
+@db_connect
+async def get_delivery_stats(
+    job_ids: Iterable[int], *, session: AsyncSession
+) -> list[tuple[int, str, int, float | None, datetime | None]]:
+    stats = await session.execute(
+        select(
+            BroadcastDelivery.job_id,
+            BroadcastDelivery.status,
+            func.count(BroadcastDelivery.id),
+            func.sum(BroadcastDelivery.latency_ms),
+            func.max(BroadcastDelivery.updated_at),
+        )
+        .where(BroadcastDelivery.job_id.in_(list(job_ids)))
+        .group_by(BroadcastDelivery.job_id, BroadcastDelivery.status)
+    )
+    return [tuple(row) for row in stats]  # type: ignore[misc]
+
+
+@db_connect
+async def get_broadcast_deliveries(
+    job_id: int, *, session: AsyncSession
+) -> list[BroadcastDelivery]:
+    deliveries = await session.scalars(
+        select(BroadcastDelivery)
+        .where(BroadcastDelivery.job_id == job_id)
+        .order_by(BroadcastDelivery.course, BroadcastDelivery.group_id)
+    )
+    return list(deliveries)
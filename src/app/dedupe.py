@@ -0,0 +1,82 @@
+import time
+from collections import OrderedDict
+
+import settings
+from app.store import SharedStore, store
+
+
+def get_event_key(event: dict) -> str | None:
+    if event.get("event_id"):
+        return str(event["event_id"])
+    message = (event.get("object") or {}).get("message") or {}
+    if message.get("conversation_message_id") is None:
+        return None
+    return f"{message.get('peer_id')}:{message['conversation_message_id']}"
+
+
+class EventDeduplicator:
+    # Bounded TTL/LRU set of seen events, optionally backed by
+    # the shared store so a retry landing on another worker is caught
+
+    def __init__(
+        self,
+        ttl: float,
+        size: int,
+        shared_store: SharedStore | None = None,
+    ) -> None:
+        self.ttl = ttl
+        self.size = size
+        self.store = shared_store
+        self._seen: OrderedDict[str, float] = OrderedDict()
+
+    def _evict(self, now: float) -> None:
+        while self._seen and next(iter(self._seen.values())) <= now:
+            self._seen.popitem(last=False)
+        while len(self._seen) > self.size:
+            self._seen.popitem(last=False)
+
+    def is_duplicate(self, key: str | None) -> bool:
+        if key is None:
+            return False
+        now = time.monotonic()
+        self._evict(now)
+        if key in self._seen:
+            # A retried event stays the most recently seen, its expiry
+            # moves along so the entries stay ordered by both
+            self._seen[key] = now + self.ttl
+            self._seen.move_to_end(key)
+            return True
+        self._seen[key] = now + self.ttl
+        self._evict(now)
+        if self.store is not None:
+            return not self.store.add(f"event:{key}", 1, self.ttl)
+        return False
+
+    def is_seen(self, key: str | None) -> bool:
+        # Only checks, for callers that mark an event once it is handled
+        if key is None:
+            return False
+        self._evict(time.monotonic())
+        if key in self._seen:
+            return True
+        return (
+            self.store is not None
+            and self.store.get(f"event:{key}") is not None
+        )
+
+    def mark_seen(self, key: str | None) -> None:
+        if key is None:
+            return
+        now = time.monotonic()
+        self._seen[key] = now + self.ttl
+        self._seen.move_to_end(key)
+        self._evict(now)
+        if self.store is not None:
+            self.store.set(f"event:{key}", 1, self.ttl)
+
+
+deduplicator = EventDeduplicator(
+    settings.DEDUPE_TTL,
+    settings.DEDUPE_SIZE,
+    store if settings.DEDUPE_SHARED else None,
+)
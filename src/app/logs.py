@@ -0,0 +1,93 @@
+import atexit
+import copy
+import logging
+import queue
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+import orjson
+
+import settings
+
+# Attributes of every record, the others came with `extra`
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {
+    "message",
+    "asctime",
+    "taskName",
+}
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": datetime.fromtimestamp(
+                record.created, timezone.utc
+            ).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        data.update(
+            (key, value)
+            for key, value in vars(record).items()
+            if key not in RECORD_ATTRIBUTES
+        )
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return orjson.dumps(data, default=str).decode()
+
+
+class LogQueueHandler(QueueHandler):
+    # Only the message is rendered on the thread that logs, before its
+    # arguments change. The traceback is left to the writer thread
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class LogPipeline:
+    # Records are queued by the thread that logs, the event loop included,
+    # and written out by one background thread
+    def __init__(self) -> None:
+        self.handler: LogQueueHandler | None = None
+        self.listener: QueueListener | None = None
+        self.previous: list[logging.Handler] = []
+
+    def start(self, *handlers: logging.Handler) -> None:
+        self.stop()
+        stream = logging.StreamHandler()
+        if settings.LOG_FORMAT == "json":
+            stream.setFormatter(JSONFormatter())
+        else:
+            stream.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        log_queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.handler = LogQueueHandler(log_queue)
+        self.listener = QueueListener(
+            log_queue, stream, *handlers, respect_handler_level=True
+        )
+        # Replaces the handlers already there, such as the one vkbottle's
+        # basicConfig adds at import, which write on the caller's thread
+        root = logging.getLogger()
+        self.previous = root.handlers[:]
+        root.handlers = [self.handler]
+        root.setLevel(settings.LOG_LEVEL)
+        self.listener.start()
+
+    def stop(self) -> None:
+        # Writes out what is queued
+        if self.handler is not None:
+            logging.getLogger().handlers = self.previous
+            self.handler = None
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+
+pipeline = LogPipeline()
+atexit.register(pipeline.stop)
+
+
+def setup_logging(*handlers: logging.Handler) -> None:
+    pipeline.start(*handlers)
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Any
+
+import aiohttp
+import orjson
+from vkbottle import VKAPIError
+
+import settings
+from app.bot import setup_bot
+from app.dedupe import EventDeduplicator, get_event_key
+from app.logs import setup_logging
+from app.metrics import LONGPOLL_EVENTS
+from app.store import store
+from app.vk import bot
+
+logger = logging.getLogger(__name__)
+
+TS_KEY = "longpoll:ts"
+
+
+class LongPollRunner:
+    # Dispatches the events of each poll with bounded concurrency. A ts is
+    # saved once the events of its batch and of all earlier batches are
+    # handled, so a restart resumes from the first unfinished batch.
+    # Events are marked seen in the store once their handler is done, the
+    # replayed batch skips those and runs the unfinished ones again
+    def __init__(self, concurrency: int) -> None:
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.batches: deque[tuple[Any, set[asyncio.Task]]] = deque()
+        self.deduplicator = EventDeduplicator(
+            settings.DEDUPE_TTL, settings.DEDUPE_SIZE, store
+        )
+
+    async def dispatch(self, event: dict, key: str | None) -> None:
+        try:
+            await bot.process_event(event)
+            self.deduplicator.mark_seen(key)
+        finally:
+            self.semaphore.release()
+
+    async def handle(self, updates: list[dict], ts: Any) -> None:
+        tasks = set()
+        for event in updates:
+            LONGPOLL_EVENTS.labels(event.get("type")).inc()
+            key = get_event_key(event)
+            if self.deduplicator.is_seen(key):
+                continue
+            await self.semaphore.acquire()
+            task = asyncio.create_task(self.dispatch(event, key))
+            task.add_done_callback(self.commit)
+            tasks.add(task)
+        self.batches.append((ts, tasks))
+        self.commit()
+
+    def commit(self, *_: Any) -> None:
+        ts = None
+        while self.batches and all(task.done() for task in self.batches[0][1]):
+            # A batch cancelled on shutdown is polled again after a restart
+            if any(task.cancelled() for task in self.batches[0][1]):
+                break
+            ts = self.batches.popleft()[0]
+        if ts is not None:
+            store.set(TS_KEY, ts)
+
+    async def join(self) -> None:
+        tasks = [task for _, batch in self.batches for task in batch]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def get_server() -> dict:
+    response = await bot.api.request(
+        "groups.getLongPollServer", {"group_id": settings.GROUP_ID}
+    )
+    server: dict = response["response"]
+    return server
+
+
+async def poll(session: aiohttp.ClientSession, server: dict, ts: Any) -> dict:
+    params = {
+        "act": "a_check",
+        "key": server["key"],
+        "ts": ts,
+        "wait": settings.LONGPOLL_WAIT,
+    }
+    async with session.get(
+        server["server"], params=params, raise_for_status=True
+    ) as response:
+        result: dict = orjson.loads(await response.read())
+        return result
+
+
+async def poll_once(
+    session: aiohttp.ClientSession,
+    runner: LongPollRunner,
+    server: dict,
+    ts: Any,
+) -> tuple[dict, Any]:
+    result = await poll(session, server, ts)
+    failed = result.get("failed")
+    if failed == 1:
+        # Events older than the history VK keeps are lost
+        logger.warning("Long Poll history is out of date, ts %s", ts)
+        return server, result["ts"]
+    if failed in (2, 3):
+        # The key expired, or the key and the history are lost
+        new_server = await get_server()
+        return new_server, new_server["ts"] if failed == 3 else ts
+    await runner.handle(result["updates"], result["ts"])
+    return server, result["ts"]
+
+
+async def run_longpoll() -> None:
+    if not store.path:
+        # An in-memory store loses the ts, a restart would skip the events
+        # sent while the runner was down
+        raise RuntimeError("SHARED_STORE_PATH is required for Long Poll")
+    setup_bot(bot)
+    runner = LongPollRunner(settings.LONGPOLL_CONCURRENCY)
+    timeout = aiohttp.ClientTimeout(
+        total=settings.LONGPOLL_WAIT + settings.VK_API_TIMEOUT
+    )
+    server: dict | None = None
+    ts = store.get(TS_KEY)
+    logger.info("Long Poll runner started")
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        try:
+            while True:
+                try:
+                    if server is None:
+                        server = await get_server()
+                        ts = ts or server["ts"]
+                    server, ts = await poll_once(session, runner, server, ts)
+                except (
+                    VKAPIError,
+                    aiohttp.ClientError,
+                    asyncio.TimeoutError,
+                ) as error:
+                    logger.error(error)
+                    await asyncio.sleep(settings.LONGPOLL_RETRY_DELAY)
+        finally:
+            await runner.join()
+
+
+if __name__ == "__main__":
+    setup_logging()
+    asyncio.run(run_longpoll())
@@ -0,0 +1,144 @@
+import asyncio
+import hashlib
+import logging
+from typing import Any
+
+import aiohttp
+import orjson
+from vkbottle import DocMessagesUploader, PhotoMessageUploader, VKAPIError
+from vkbottle.user import Message
+
+import settings
+from app.store import store
+from app.vk import bot
+
+logger = logging.getLogger(__name__)
+
+# Attachments VK takes in one message
+MAX_ATTACHMENTS = 10
+
+
+def get_transfer_timeout() -> aiohttp.ClientTimeout:
+    # Only a stalled transfer is given up, large documents take a while
+    return aiohttp.ClientTimeout(
+        sock_connect=settings.VK_API_TIMEOUT,
+        sock_read=settings.VK_API_TIMEOUT,
+    )
+
+
+class FileUploadMixin:
+    # bot.api's client limits whole requests to VK_API_TIMEOUT, which
+    # a large file can take to upload
+    async def upload_files(self, upload_url: str, files: dict) -> dict:
+        async with aiohttp.ClientSession(
+            timeout=get_transfer_timeout()
+        ) as session:
+            async with session.post(
+                upload_url, data=files, raise_for_status=True
+            ) as response:
+                uploaded: dict = orjson.loads(await response.read())
+                return uploaded
+
+
+class PhotoUploader(FileUploadMixin, PhotoMessageUploader):
+    pass
+
+
+class DocUploader(FileUploadMixin, DocMessagesUploader):
+    pass
+
+
+photo_uploader = PhotoUploader(api_getter=lambda: bot.api)
+doc_uploader = DocUploader(api_getter=lambda: bot.api)
+
+
+def get_media(message: Message) -> list[Any]:
+    # Photos and documents of the message and of the messages it
+    # forwards or replies to, the ones get_text takes the text from
+    messages = [message, *(message.fwd_messages or [])]
+    if message.reply_message:
+        messages.append(message.reply_message)
+    return [
+        attachment
+        for item in messages
+        for attachment in item.attachments or []
+        if attachment.photo or attachment.doc
+    ]
+
+
+def get_photo_url(photo: Any) -> str:
+    size = max(photo.sizes, key=lambda size: size.width * size.height)
+    url: str = size.url
+    return url
+
+
+async def download(url: str) -> bytes:
+    async with aiohttp.ClientSession(
+        timeout=get_transfer_timeout()
+    ) as session:
+        async with session.get(url, raise_for_status=True) as response:
+            content: bytes = await response.read()
+            return content
+
+
+async def download_media(attachment: Any) -> bytes | None:
+    url = (
+        get_photo_url(attachment.photo)
+        if attachment.photo
+        else attachment.doc.url
+    )
+    try:
+        return await download(url)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+        logger.error(error)
+        return None
+
+
+def get_media_key(attachment: Any, content: bytes) -> str:
+    kind = "photo" if attachment.photo else "doc"
+    return f"media:{kind}:{hashlib.sha256(content).hexdigest()}"
+
+
+async def upload_media(
+    attachment: Any, content: bytes, peer_id: int
+) -> str | None:
+    # The same file sent again is not uploaded again
+    key = get_media_key(attachment, content)
+    cached: str | None = store.get(key)
+    if cached is not None:
+        return cached
+    uploaded: str
+    try:
+        if attachment.photo:
+            uploaded = await photo_uploader.upload(content, peer_id=peer_id)
+        else:
+            uploaded = await doc_uploader.upload(
+                attachment.doc.title, content, peer_id=peer_id
+            )
+    except (VKAPIError, aiohttp.ClientError, asyncio.TimeoutError) as error:
+        logger.error(error)
+        return None
+    store.set(key, uploaded, ttl=settings.MEDIA_CACHE_TTL)
+    return uploaded
+
+
+async def get_media_attachments(message: Message) -> tuple[list[str], int]:
+    # Chats can only get media uploaded through the community token,
+    # so each file is uploaded once and every group gets the same string.
+    # Returns the attachments and the number of files that failed
+    media = get_media(message)
+    contents = await asyncio.gather(*map(download_media, media))
+    # Identical files in one message are attached once
+    unique: dict[str, tuple[Any, bytes]] = {}
+    for attachment, content in zip(media, contents):
+        if content is not None:
+            key = get_media_key(attachment, content)
+            unique.setdefault(key, (attachment, content))
+    uploaded = await asyncio.gather(
+        *(
+            upload_media(attachment, content, message.peer_id)
+            for attachment, content in unique.values()
+        )
+    )
+    failed = contents.count(None) + uploaded.count(None)
+    return [attachment for attachment in uploaded if attachment], failed
@@ -0,0 +1,189 @@
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Any, Iterator
+
+import aiohttp
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from vkbottle import API, VKAPIError
+from vkbottle.dispatch.middlewares import BaseMiddleware
+from vkbottle.user import Message
+
+import settings
+
+logger = logging.getLogger(__name__)
+
+CALLBACK_SECONDS = Histogram(
+    "callback_request_seconds", "Time to answer a Callback API request"
+)
+CALLBACK_EVENTS = Counter(
+    "callback_events_total", "Callback API events by type", ["type"]
+)
+LONGPOLL_EVENTS = Counter(
+    "longpoll_events_total", "Bots Long Poll events by type", ["type"]
+)
+HANDLER_SECONDS = Histogram(
+    "bot_handler_seconds",
+    "Time to dispatch a message, by the labeler handler that took it",
+    ["handler"],
+)
+DB_SECONDS = Histogram(
+    "db_call_seconds", "Time spent in an app.db function", ["function"]
+)
+DB_ERRORS = Counter(
+    "db_call_errors_total", "Failed app.db function calls", ["function"]
+)
+VK_API_SECONDS = Histogram(
+    "vk_api_request_seconds", "VK API request time", ["method"]
+)
+VK_API_ERRORS = Counter(
+    "vk_api_errors_total",
+    "VK API errors by method and code",
+    ["method", "code"],
+)
+BROADCAST_MESSAGES = Counter(
+    "broadcast_messages_total", "Broadcast messages by outcome", ["status"]
+)
+BROADCAST_RETRIES = Counter(
+    "broadcast_retries_total", "Broadcast messages sent again after an error"
+)
+BROADCASTS_IN_FLIGHT = Gauge(
+    "broadcasts_in_flight",
+    "Broadcasts being delivered",
+    multiprocess_mode="livesum",
+)
+BROADCAST_BATCHES_IN_FLIGHT = Gauge(
+    "broadcast_batches_in_flight",
+    "Broadcast batches waiting for the VK API",
+    multiprocess_mode="livesum",
+)
+
+
+class Timings:
+    # DB and VK API time spent on behalf of one bot event.
+    # Concurrent calls, such as the sends of a broadcast, add up
+    def __init__(self) -> None:
+        self.db = 0.0
+        self.db_calls = 0
+        self.vk = 0.0
+        self.vk_calls = 0
+
+    def add(self, kind: str, seconds: float) -> None:
+        setattr(self, kind, getattr(self, kind) + seconds)
+        setattr(self, f"{kind}_calls", getattr(self, f"{kind}_calls") + 1)
+
+
+current_timings: ContextVar[Timings | None] = ContextVar(
+    "current_timings", default=None
+)
+
+
+@contextmanager
+def track(histogram: Histogram, kind: str) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        histogram.observe(seconds)
+        timings = current_timings.get()
+        if timings is not None:
+            timings.add(kind, seconds)
+
+
+def get_metrics() -> tuple[bytes, str]:
+    # With several workers every process writes its own files
+    # to PROMETHEUS_MULTIPROC_DIR and they are merged on scrape
+    if not settings.PROMETHEUS_MULTIPROC_DIR:
+        return generate_latest(), CONTENT_TYPE_LATEST
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(
+        registry, path=settings.PROMETHEUS_MULTIPROC_DIR
+    )
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def get_error_codes(method: str, response: Any) -> list[tuple[str, int]]:
+    # Errors of calls that succeeded as a whole: execute
+    # lists failed inner calls, peer_ids sends fail per peer
+    if not isinstance(response, dict):
+        return []
+    codes = [
+        (error.get("method", method), error.get("error_code"))
+        for error in response.get("execute_errors") or []
+    ]
+    items = response.get("response")
+    if isinstance(items, list):
+        codes.extend(
+            (method, item["error"].get("code"))
+            for item in items
+            if isinstance(item, dict) and "error" in item
+        )
+    return codes
+
+
+def instrument_api(api: API) -> None:
+    request = api.request
+
+    @wraps(request)
+    async def timed_request(method: str, data: dict) -> Any:
+        try:
+            with track(VK_API_SECONDS.labels(method), "vk"):
+                response = await request(method, data)
+        except VKAPIError as error:
+            VK_API_ERRORS.labels(method, error.code).inc()
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            VK_API_ERRORS.labels(method, "network").inc()
+            raise
+        for inner_method, code in get_error_codes(method, response):
+            VK_API_ERRORS.labels(inner_method, code).inc()
+        return response
+
+    api.request = timed_request  # type: ignore[method-assign]
+
+
+def get_handler_name(handler: Any) -> str:
+    func = getattr(handler, "handler", None)
+    return getattr(func, "__name__", type(handler).__name__)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware[Message]):
+    # Times every dispatch and logs the handlers that run over
+    # SLOW_HANDLER_BUDGET with the DB and VK API time they spent
+    async def pre(self) -> None:
+        self.started = time.perf_counter()
+        self.timings = Timings()
+        self.token = current_timings.set(self.timings)
+
+    async def post(self) -> None:
+        current_timings.reset(self.token)
+        seconds = time.perf_counter() - self.started
+        handler = (
+            get_handler_name(self.handlers[0])
+            if self.handlers
+            else "unhandled"
+        )
+        HANDLER_SECONDS.labels(handler).observe(seconds)
+        if seconds > settings.SLOW_HANDLER_BUDGET:
+            logger.warning(
+                "Slow handler %s: %.0f ms, db %.0f ms in %d calls, "
+                "vk %.0f ms in %d calls",
+                handler,
+                seconds * 1000,
+                self.timings.db * 1000,
+                self.timings.db_calls,
+                self.timings.vk * 1000,
+                self.timings.vk_calls,
+            )
@@ -0,0 +1,19 @@
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "3b7e91d0a4c2"
+down_revision = "8f2a6c4d1e57"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        "ix_student_groups_course_id",
+        "student_groups",
+        ["course", "id"],
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_student_groups_course_id", table_name="student_groups")
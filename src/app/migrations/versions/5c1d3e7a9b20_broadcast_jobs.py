@@ -0,0 +1,61 @@
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "5c1d3e7a9b20"
+down_revision = "db97ecac1af7"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "broadcast_jobs",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("courses", sa.String(), nullable=False),
+        sa.Column("text", sa.Text(), nullable=True),
+        sa.Column("attachment", sa.String(), nullable=True),
+        sa.Column("peer_id", sa.BigInteger(), nullable=True),
+        sa.Column("status", sa.String(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("finished_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_table(
+        "broadcast_deliveries",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("job_id", sa.Integer(), nullable=False),
+        sa.Column("group_id", sa.Integer(), nullable=False),
+        sa.Column("course", sa.Integer(), nullable=False),
+        sa.Column("status", sa.String(), nullable=False),
+        sa.Column("attempts", sa.Integer(), nullable=False),
+        sa.Column("lease_until", sa.DateTime(), nullable=True),
+        sa.Column("updated_at", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(
+            ["job_id"], ["broadcast_jobs.id"], ondelete="CASCADE"
+        ),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ix_broadcast_deliveries_status_id",
+        "broadcast_deliveries",
+        ["status", "id"],
+    )
+    op.create_index(
+        "ix_broadcast_deliveries_job_id_group_id",
+        "broadcast_deliveries",
+        ["job_id", "group_id"],
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(
+        "ix_broadcast_deliveries_job_id_group_id",
+        table_name="broadcast_deliveries",
+    )
+    op.drop_index(
+        "ix_broadcast_deliveries_status_id",
+        table_name="broadcast_deliveries",
+    )
+    op.drop_table("broadcast_deliveries")
+    op.drop_table("broadcast_jobs")
@@ -0,0 +1,24 @@
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "8f2a6c4d1e57"
+down_revision = "5c1d3e7a9b20"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "broadcast_deliveries",
+        sa.Column("error_code", sa.Integer(), nullable=True),
+    )
+    op.add_column(
+        "broadcast_deliveries",
+        sa.Column("latency_ms", sa.Float(), nullable=True),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("broadcast_deliveries", "latency_ms")
+    op.drop_column("broadcast_deliveries", "error_code")
@@ -0,0 +1,56 @@
+import asyncio
+import sys
+import threading
+import time
+from collections import Counter
+from types import FrameType
+
+profiler_lock = threading.Lock()
+
+
+def get_stack(thread_name: str, frame: FrameType | None) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(
+            f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+        )
+        frame = frame.f_back
+    names.append(thread_name)
+    return ";".join(reversed(names))
+
+
+def sample_stacks(seconds: float, interval: float) -> Counter[str]:
+    # Sampling profiler: the stacks of every other thread of the
+    # process are taken each interval and counted as folded lines
+    stacks: Counter[str] = Counter()
+    own_id = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            name = names.get(thread_id, str(thread_id))
+            stacks[get_stack(name, frame)] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def get_folded(stacks: Counter[str]) -> str:
+    # The input format of flamegraph.pl, speedscope and inferno
+    return "".join(
+        f"{stack} {count}\n" for stack, count in stacks.most_common()
+    )
+
+
+async def profile(seconds: float, interval: float) -> str | None:
+    # The sampler sleeps in a thread, so the event loop it samples
+    # keeps serving. None when another profile is being taken
+    if not profiler_lock.acquire(blocking=False):
+        return None
+    try:
+        stacks = await asyncio.to_thread(sample_stacks, seconds, interval)
+    finally:
+        profiler_lock.release()
+    return get_folded(stacks)
@@ -0,0 +1,96 @@
+import asyncio
+import time
+from datetime import datetime
+from typing import AsyncIterator, Iterable
+
+import settings
+from app.db import (
+    BroadcastJob,
+    get_broadcast_deliveries,
+    get_broadcast_job,
+    get_broadcast_jobs,
+    get_delivery_stats,
+)
+from app.schema import BroadcastProgress, BroadcastStatus, DeliveryStatus
+
+FINISHED = ("sent", "failed")
+
+
+def get_progress(
+    job: BroadcastJob,
+    stats: Iterable[tuple[int, str, int, float | None, datetime | None]],
+) -> BroadcastProgress:
+    progress = BroadcastProgress(
+        id=job.id,
+        courses=job.courses,
+        status=job.status,
+        created_at=job.created_at,
+        finished_at=job.finished_at,
+    )
+    latency = 0.0
+    updated_at = None
+    for job_id, status, count, latency_sum, last_update in stats:
+        if job_id != job.id:
+            continue
+        progress.total += count
+        if status not in FINISHED:
+            progress.pending += count
+            continue
+        setattr(progress, status, getattr(progress, status) + count)
+        latency += latency_sum or 0
+        if last_update and (updated_at is None or last_update > updated_at):
+            updated_at = last_update
+    finished = progress.sent + progress.failed
+    if finished:
+        progress.latency_ms = latency / finished
+    # The model holds created_at as a datetime, the job as a column
+    created_at = progress.created_at
+    if updated_at is not None and updated_at > created_at:
+        seconds = (updated_at - created_at).total_seconds()
+        progress.rate = finished / seconds
+    return progress
+
+
+async def get_broadcasts(limit: int) -> list[BroadcastProgress]:
+    jobs = await get_broadcast_jobs(limit)
+    stats = await get_delivery_stats(job.id for job in jobs)
+    return [get_progress(job, stats) for job in jobs]
+
+
+async def get_broadcast_progress(job_id: int) -> BroadcastProgress | None:
+    job = await get_broadcast_job(job_id)
+    if job is None:
+        return None
+    return get_progress(job, await get_delivery_stats([job_id]))
+
+
+async def get_broadcast_status(job_id: int) -> BroadcastStatus | None:
+    progress = await get_broadcast_progress(job_id)
+    if progress is None:
+        return None
+    deliveries = await get_broadcast_deliveries(job_id)
+    return BroadcastStatus(
+        **progress.dict(),
+        deliveries=[DeliveryStatus.from_orm(item) for item in deliveries],
+    )
+
+
+async def progress_events(job_id: int) -> AsyncIterator[str]:
+    # Server-sent events with the job progress until the job is done,
+    # or until it stops moving, as a job left by a dead worker does
+    last = None
+    moved_at = time.monotonic()
+    while True:
+        progress = await get_broadcast_progress(job_id)
+        if progress is None:
+            return
+        yield f"event: progress\ndata: {progress.json()}\n\n"
+        if progress.status == "done":
+            return
+        state = (progress.status, progress.sent, progress.failed)
+        if state != last:
+            last, moved_at = state, time.monotonic()
+        elif time.monotonic() - moved_at >= settings.PROGRESS_STALL_TIMEOUT:
+            yield f"event: stalled\ndata: {progress.json()}\n\n"
+            return
+        await asyncio.sleep(settings.PROGRESS_INTERVAL)
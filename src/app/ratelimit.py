@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import time
+from typing import Any, Callable
+
+from vkbottle import ABCAPI, API
+from vkbottle.api.response_validator import ABCResponseValidator
+from vkbottle.api.token_generator import ABCTokenGenerator
+
+import settings
+from app.store import SharedStore, store
+
+logger = logging.getLogger(__name__)
+
+TOO_MANY_REQUESTS = 6
+
+
+class RateLimiter:
+    # Token bucket kept in the shared store, so every worker of the host
+    # draws from one quota. The rate adapts with AIMD: it is halved on
+    # VK error 6 and grows back by a fixed step on each success.
+
+    def __init__(
+        self,
+        shared_store: SharedStore,
+        key: str,
+        rate: float,
+        min_rate: float = 1,
+        increase: float = 0.2,
+        decrease: float = 0.5,
+    ) -> None:
+        self.store = shared_store
+        self.key = key
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.increase = increase
+        self.decrease = decrease
+        self.rate = rate
+
+    def _state(self, state: dict | None, now: float) -> dict:
+        if state is None:
+            return {"rate": self.max_rate, "tokens": 1.0, "updated": now}
+        # A single token of capacity spaces requests evenly,
+        # which keeps any one-second window within the limit
+        state["tokens"] = min(
+            1.0, state["tokens"] + (now - state["updated"]) * state["rate"]
+        )
+        state["updated"] = now
+        return state
+
+    def _take(self, state: dict | None) -> dict:
+        state = self._state(state, time.time())
+        state["tokens"] -= 1
+        return state
+
+    def _throttle(self, state: dict | None) -> dict:
+        state = self._state(state, time.time())
+        state["rate"] = max(self.min_rate, state["rate"] * self.decrease)
+        state["tokens"] = min(state["tokens"], 0.0)
+        return state
+
+    def _recover(self, state: dict | None) -> dict:
+        state = self._state(state, time.time())
+        state["rate"] = min(self.max_rate, state["rate"] + self.increase)
+        return state
+
+    async def _update(self, func: Callable[[dict | None], dict]) -> dict:
+        # The store waits up to its busy timeout for another worker's
+        # transaction, which must not block the event loop
+        state: dict = await asyncio.to_thread(
+            self.store.update, self.key, func
+        )
+        return state
+
+    async def acquire(self) -> None:
+        # Tokens may go negative: the debt is this caller's place in line
+        state = await self._update(self._take)
+        self.rate = state["rate"]
+        if state["tokens"] < 0:
+            await asyncio.sleep(-state["tokens"] / state["rate"])
+
+    async def throttle(self) -> None:
+        self.rate = (await self._update(self._throttle))["rate"]
+        logger.warning(
+            "VK rate limit hit, slowing down to %.1f rps", self.rate
+        )
+
+    async def recover(self) -> None:
+        if self.rate < self.max_rate:
+            self.rate = (await self._update(self._recover))["rate"]
+
+
+class RateLimitedTokenGenerator(ABCTokenGenerator):
+    def __init__(
+        self, token_generator: ABCTokenGenerator, limiter: RateLimiter
+    ) -> None:
+        self.token_generator = token_generator
+        self.limiter = limiter
+
+    async def get_token(self) -> str:
+        await self.limiter.acquire()
+        token: str = await self.token_generator.get_token()
+        return token
+
+
+class RateLimitResponseValidator(ABCResponseValidator):
+    def __init__(self, limiter: RateLimiter) -> None:
+        self.limiter = limiter
+
+    async def validate(
+        self, method: str, data: dict, response: Any, ctx_api: ABCAPI | API
+    ) -> Any:
+        if not isinstance(response, dict):
+            return response
+        codes = [
+            error.get("error_code")
+            for error in (
+                [response.get("error") or {}]
+                + (response.get("execute_errors") or [])
+            )
+        ]
+        if TOO_MANY_REQUESTS in codes:
+            await self.limiter.throttle()
+        else:
+            await self.limiter.recover()
+        return response
+
+
+def limit_api(api: API, limiter: RateLimiter) -> None:
+    api.token_generator = RateLimitedTokenGenerator(
+        api.token_generator, limiter
+    )
+    # The JSON validator goes first so this one sees parsed responses
+    json_validator, *validators = api.response_validators
+    api.response_validators = [
+        json_validator,
+        RateLimitResponseValidator(limiter),
+        *validators,
+    ]
+
+
+vk_limiter = RateLimiter(store, "ratelimit:vk", settings.VK_RPS_LIMIT)
@@ -1,23 +1,120 @@
-from fastapi import APIRouter, BackgroundTasks, Response
+from functools import lru_cache
+from hmac import compare_digest
+
+from fastapi import (
+    APIRouter,
+    BackgroundTasks,
+    Depends,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+)
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 
 import settings
-from app.bot import admin_labeler, broadcast_labeler, common_labeler
-from app.schema import Data
+from app.dedupe import deduplicator, get_event_key
+from app.metrics import CALLBACK_EVENTS, CALLBACK_SECONDS
+from app.profiler import profile
+from app.progress import (
+    get_broadcast_progress,
+    get_broadcast_status,
+    get_broadcasts,
+    progress_events,
+)
+from app.schema import BroadcastProgress, BroadcastStatus, parse_event
 from app.vk import bot
 
 app = APIRouter(prefix="/api", tags=["API"])
 
+OK = b"ok"
 
-bot.labeler.load(admin_labeler)
-bot.labeler.load(common_labeler)
-bot.labeler.load(broadcast_labeler)
 
+@lru_cache(maxsize=1)
+def get_confirmation(group_id: str, token: str) -> tuple[int, bytes]:
+    return int(group_id), token.encode()
 
-@app.post("/callback")
-async def callback(data: Data, background_tasks: BackgroundTasks) -> Response:
-    if data.type == "confirmation" and data.group_id == int(settings.GROUP_ID):
-        return Response(
-            media_type="text/plain", content=settings.CONFIRMATION_TOKEN
+
+def handle_callback(
+    body: bytes, background_tasks: BackgroundTasks
+) -> Response:
+    try:
+        event = parse_event(body)
+    except ValueError as error:
+        CALLBACK_EVENTS.labels("invalid").inc()
+        return JSONResponse({"detail": str(error)}, status_code=422)
+    CALLBACK_EVENTS.labels(event["type"]).inc()
+    if event["type"] == "confirmation":
+        group_id, confirmation = get_confirmation(
+            settings.GROUP_ID, settings.CONFIRMATION_TOKEN
         )
-    background_tasks.add_task(bot.process_event, data.dict())
-    return Response(media_type="text/plain", content="ok")
+        if event["group_id"] == group_id:
+            return Response(media_type="text/plain", content=confirmation)
+    if deduplicator.is_duplicate(get_event_key(event)):
+        return Response(media_type="text/plain", content=OK)
+    background_tasks.add_task(bot.process_event, event)
+    return Response(media_type="text/plain", content=OK)
+
+
+@app.post("/callback")
+async def callback(
+    request: Request, background_tasks: BackgroundTasks
+) -> Response:
+    with CALLBACK_SECONDS.time():
+        return handle_callback(await request.body(), background_tasks)
+
+
+def check_admin_token(x_admin_token: str = Header("")) -> None:
+    if not settings.ADMIN_API_TOKEN or not compare_digest(
+        x_admin_token.encode(), settings.ADMIN_API_TOKEN.encode()
+    ):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+@app.get(
+    "/broadcasts",
+    response_model=list[BroadcastProgress],
+    dependencies=[Depends(check_admin_token)],
+)
+async def list_broadcasts(
+    limit: int = Query(20, ge=1, le=100)
+) -> list[BroadcastProgress]:
+    return await get_broadcasts(limit)
+
+
+@app.get(
+    "/broadcasts/{job_id}",
+    response_model=BroadcastStatus,
+    dependencies=[Depends(check_admin_token)],
+)
+async def broadcast_status(job_id: int) -> BroadcastStatus:
+    status = await get_broadcast_status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Broadcast not found")
+    return status
+
+
+@app.get(
+    "/broadcasts/{job_id}/events",
+    dependencies=[Depends(check_admin_token)],
+)
+async def broadcast_events(job_id: int) -> StreamingResponse:
+    if await get_broadcast_progress(job_id) is None:
+        raise HTTPException(status_code=404, detail="Broadcast not found")
+    return StreamingResponse(
+        progress_events(job_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/profile", dependencies=[Depends(check_admin_token)])
+async def profile_worker(
+    seconds: float = Query(10, gt=0, le=60),
+    interval: float = Query(0.01, ge=0.001, le=1),
+) -> Response:
+    # Folded stacks of the worker process that took the request
+    folded = await profile(seconds, interval)
+    if folded is None:
+        raise HTTPException(status_code=409, detail="Already profiling")
+    return Response(media_type="text/plain", content=folded)
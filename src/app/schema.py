@@ -1,5 +1,10 @@
+from datetime import datetime
+
+from orjson import loads
 from pydantic import BaseModel
 
+import settings
+
 
 class Message(BaseModel):
     from_id: int
@@ -7,6 +12,7 @@ class Message(BaseModel):
     text: str
     date: int | None
     id: int | None
+    conversation_message_id: int | None
     out: int | None
     attachments: list[dict] = []
     fwd_messages: list[dict] = []
@@ -21,4 +27,54 @@ class MessageObject(BaseModel):
 class Data(BaseModel):
     type: str = "message_new"
     group_id: int
+    event_id: str | None
     object: MessageObject | None
+
+
+class DeliveryStatus(BaseModel):
+    group_id: int
+    course: int
+    status: str
+    attempts: int
+    error_code: int | None
+    latency_ms: float | None
+    updated_at: datetime | None
+
+    class Config:
+        orm_mode = True
+
+
+class BroadcastProgress(BaseModel):
+    id: int
+    courses: str
+    status: str
+    created_at: datetime
+    finished_at: datetime | None
+    total: int = 0
+    sent: int = 0
+    failed: int = 0
+    # Deliveries still waiting in the queue or being sent
+    pending: int = 0
+    # Mean latency of finished deliveries and their rate per second
+    latency_ms: float | None
+    rate: float | None
+
+
+class BroadcastStatus(BroadcastProgress):
+    deliveries: list[DeliveryStatus] = []
+
+
+def parse_event(body: bytes) -> dict:
+    event = loads(body)
+    if not settings.CALLBACK_FAST_INGRESS:
+        data = Data.parse_obj(event)
+        return {**data.dict(exclude_unset=True), "type": data.type}
+    # The route itself only reads these fields,
+    # vkbottle parses the rest of the event while dispatching it
+    if not isinstance(event, dict):
+        raise ValueError("Event is not an object")
+    if not isinstance(event.setdefault("type", "message_new"), str):
+        raise ValueError("Event type is not a string")
+    if type(event.get("group_id")) is not int:
+        raise ValueError("Event group_id is not an integer")
+    return event
@@ -0,0 +1,68 @@
+import argparse
+import asyncio
+import glob
+import os
+import socket
+import tempfile
+
+import uvicorn
+from uvicorn.protocols.http.h11_impl import H11Protocol
+
+import settings
+
+
+class HTTPProtocol(H11Protocol):
+    # uvicorn binds the socket it hands to its workers without
+    # IPPROTO_TCP, so asyncio does not set TCP_NODELAY on their
+    # connections and keep-alive responses wait ~40 ms for a delayed ACK
+    def connection_made(  # type: ignore[override]
+        self, transport: asyncio.Transport
+    ) -> None:
+        sock = transport.get_extra_info("socket")
+        if sock is not None and sock.family in (
+            socket.AF_INET,
+            socket.AF_INET6,
+        ):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        super().connection_made(transport)
+
+
+def prepare_workers() -> None:
+    # Workers keep broadcast locks, seen events and the VK rate limit
+    # in one store, and write metrics to files merged by /metrics.
+    # Settings are read by the workers, after the environment is set
+    directory = tempfile.mkdtemp(prefix="vk-fast-api-")
+    os.environ.setdefault(
+        "SHARED_STORE_PATH", os.path.join(directory, "store.db")
+    )
+    os.environ.setdefault("DEDUPE_SHARED", "true")
+    metrics_dir = os.environ.setdefault(
+        "PROMETHEUS_MULTIPROC_DIR", os.path.join(directory, "metrics")
+    )
+    os.makedirs(metrics_dir, exist_ok=True)
+    # Files of a previous run would add to the new counters
+    for path in glob.glob(os.path.join(metrics_dir, "*.db")):
+        os.remove(path)
+
+
+def run(host: str, port: int, workers: int) -> None:
+    if workers > 1:
+        prepare_workers()
+    uvicorn.run(
+        "main:create_app",
+        factory=True,
+        host=host,
+        port=port,
+        workers=workers,
+        http=HTTPProtocol,
+        log_level="warning",
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve main:create_app")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=settings.WORKERS)
+    args = parser.parse_args()
+    run(args.host, args.port, args.workers)
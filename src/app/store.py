@@ -0,0 +1,123 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
+import settings
+
+
+class SharedStore:
+    # SQLite file shared by the processes of one host,
+    # a private in-memory database when no path is configured
+
+    def __init__(self, path: str = "") -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection: sqlite3.Connection | None = None
+        self._pid: int | None = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is not None and self._pid == os.getpid():
+            return self._connection
+        connection = sqlite3.connect(
+            self.path or ":memory:",
+            timeout=5,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        if self.path:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS store ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+        )
+        self._connection, self._pid = connection, os.getpid()
+        return connection
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    @staticmethod
+    def _read(connection: sqlite3.Connection, key: str) -> Any:
+        row = connection.execute(
+            "SELECT value, expires_at FROM store WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return json.loads(row[0])
+
+    @staticmethod
+    def _write(
+        connection: sqlite3.Connection,
+        key: str,
+        value: Any,
+        ttl: float | None,
+    ) -> None:
+        connection.execute(
+            "INSERT OR REPLACE INTO store (key, value, expires_at) "
+            "VALUES (?, ?, ?)",
+            (key, json.dumps(value), time.time() + ttl if ttl else None),
+        )
+
+    def get(self, key: str) -> Any:
+        with self.transaction() as connection:
+            return self._read(connection, key)
+
+    def set(self, key: str, value: Any, ttl: float | None = None) -> None:
+        with self.transaction() as connection:
+            self._write(connection, key, value, ttl)
+
+    def add(self, key: str, value: Any, ttl: float | None = None) -> bool:
+        with self.transaction() as connection:
+            if self._read(connection, key) is not None:
+                return False
+            self._write(connection, key, value, ttl)
+            return True
+
+    def delete(self, key: str) -> None:
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM store WHERE key = ?", (key,))
+
+    @contextmanager
+    def lock(self, key: str, ttl: float) -> Iterator[bool]:
+        # Held until the block ends, or for ttl seconds if the
+        # process holding it dies
+        acquired = self.add(key, os.getpid(), ttl)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                self.delete(key)
+
+    def update(
+        self,
+        key: str,
+        func: Callable[[Any], Any],
+        ttl: float | None = None,
+    ) -> Any:
+        with self.transaction() as connection:
+            value = func(self._read(connection, key))
+            self._write(connection, key, value, ttl)
+            return value
+
+    def purge(self) -> None:
+        with self.transaction() as connection:
+            connection.execute(
+                "DELETE FROM store WHERE expires_at <= ?", (time.time(),)
+            )
+
+
+store = SharedStore(settings.SHARED_STORE_PATH)
@@ -1,9 +1,43 @@
-from typing import AsyncGenerator
+from typing import AsyncGenerator, Callable, Iterable
+from unittest.mock import AsyncMock
 
 import pytest
+from aiohttp import ClientTimeout
 from sqlalchemy.engine import Connection
+from vkbottle.http import AiohttpClient
 
+from app.bot import setup_bot
+from app.cache import GroupRegistry, group_registry
 from app.db import Base, add_group, engine
+from app.ratelimit import vk_limiter
+from app.store import SharedStore
+from app.vk import bot
+from app.vk_emulator import FakeVKAPI
+
+
+@pytest.fixture(scope="session", autouse=True)
+def labelers() -> None:
+    # What create_app does for the served app
+    setup_bot(bot)
+
+
+@pytest.fixture()
+def mock_registry(mocker) -> Callable[..., AsyncMock]:
+    # Serves the given groups of one course from get_group_registry
+    # as the module under test imports it
+    def patch_registry(
+        course: int, ids: Iterable[int], module: str = "app.broadcast"
+    ) -> AsyncMock:
+        registry = GroupRegistry(SharedStore(), ttl=60)
+        registry.load(((group, course) for group in ids), None)
+        mock: AsyncMock = mocker.patch(
+            f"{module}.get_group_registry",
+            new_callable=AsyncMock,
+            return_value=registry,
+        )
+        return mock
+
+    return patch_registry
 
 
 @pytest.mark.asyncio
@@ -19,6 +53,7 @@ async def connection() -> AsyncGenerator[Connection, None]:
 async def init_db(connection: Connection):
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+    group_registry.clear()
     yield
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.drop_all)
@@ -31,3 +66,19 @@ async def groups(init_db):
     await add_group(2, 2)
     await add_group(3, 3)
     yield
+
+
+@pytest.mark.asyncio
+@pytest.fixture()
+async def fake_vk_api(mocker) -> AsyncGenerator[FakeVKAPI, None]:
+    # The real bot.api, sending to a local server instead of api.vk.com
+    server = FakeVKAPI()
+    url = await server.start()
+    http_client = AiohttpClient(timeout=ClientTimeout(total=0.5))
+    mocker.patch.object(bot.api, "API_URL", url)
+    mocker.patch.object(bot.api, "http_client", http_client)
+    # The server enforces its own limit, if a test sets one
+    mocker.patch.object(vk_limiter, "acquire", new_callable=AsyncMock)
+    yield server
+    await http_client.close()
+    await server.stop()
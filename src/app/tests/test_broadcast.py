@@ -1,3 +1,5 @@
+import asyncio
+import json
 from unittest.mock import AsyncMock
 
 import pytest
@@ -5,8 +7,30 @@ from vkbottle import VKAPIError
 from vkbottle.exception_factory.code_exception import CodeExceptionMeta
 
 import settings
-from app.broadcast import broadcast, course_broadcast, group_broadcast
+from app.broadcast import (
+    BroadcastState,
+    broadcast,
+    broadcast_state,
+    course_broadcast,
+    drop_group,
+    enqueue_broadcast,
+    execute_broadcast,
+    get_execute_code,
+    group_broadcast,
+    peers_broadcast,
+    prune_groups,
+)
+from app.cache import GroupRegistry, group_registry
+from app.db import (
+    add_group,
+    delete_groups,
+    get_broadcast_deliveries,
+    get_broadcast_jobs,
+    get_groups_ids,
+    record_deliveries,
+)
 from app.exceptions import DBError
+from app.store import SharedStore
 from app.vk import bot
 
 
@@ -64,7 +88,7 @@ async def test_group_broadcast_permissions_failed(mocker):
     bot.api.messages.send = AsyncMock(side_effect=error)
 
     delete_group_mock = mocker.patch(
-        "app.broadcast.delete_group", new_callable=AsyncMock
+        "app.broadcast.delete_groups", new_callable=AsyncMock
     )
 
     result = await group_broadcast(group, text, attachment)
@@ -72,7 +96,7 @@ async def test_group_broadcast_permissions_failed(mocker):
     assert not result
     bot.api.messages.send.assert_awaited()
     delete_group_mock.assert_awaited()
-    delete_group_mock.assert_called_once_with(group)
+    delete_group_mock.assert_called_once_with([group])
     log_mock.assert_called_with(error)
 
 
@@ -96,24 +120,187 @@ async def test_group_broadcast_failed(mocker):
     log_mock.assert_called_with(error)
 
 
+def test_get_execute_code():
+    code = get_execute_code([1, 2], "привет", ["wall1_1", "photo1_1"])
+
+    assert code == (
+        'return {"sent": [API.messages.send({'
+        f'"peer_id": {settings.GROUP_ID_COEFFICIENT + 1}, "random_id": 0, '
+        '"message": "привет", "attachment": "wall1_1,photo1_1"}),'
+        "API.messages.send({"
+        f'"peer_id": {settings.GROUP_ID_COEFFICIENT + 2}, "random_id": 0, '
+        '"message": "привет", "attachment": "wall1_1,photo1_1"})]};'
+    )
+
+
 @pytest.mark.asyncio
-async def test_course_broadcast_empty(mocker):
+async def test_execute_broadcast(mocker):
+    log_mock = mocker.patch("app.broadcast.logger.warning")
+    text = "hello world!"
+
+    mocker.patch.object(bot, "api", autospec=True)
+    bot.api.request = AsyncMock(
+        return_value={
+            "response": {"sent": [10, False, 11, False]},
+            "execute_errors": [
+                {"method": "messages.send", "error_code": 7},
+                {"method": "messages.send", "error_code": 10},
+            ],
+        }
+    )
+    delete_group_mock = mocker.patch(
+        "app.broadcast.delete_groups", new_callable=AsyncMock
+    )
+
+    result = await execute_broadcast([1, 2, 3, 4], text, None)
+
+    assert result == [True, False, True, False]
+    bot.api.request.assert_awaited_once_with(
+        "execute", {"code": get_execute_code([1, 2, 3, 4], text, None)}
+    )
+    delete_group_mock.assert_called_once_with([2])
+    log_mock.assert_called_once_with(
+        {"method": "messages.send", "error_code": 7}
+    )
+
+
+@pytest.mark.asyncio
+async def test_execute_broadcast_failed(mocker):
+    log_mock = mocker.patch("app.broadcast.logger.error")
+
+    mocker.patch.object(bot, "api", autospec=True)
+    error = VKAPICommonError(error_msg="Error")
+    bot.api.request = AsyncMock(side_effect=error)
+
+    result = await execute_broadcast([1, 2, 3], "hello world!", None)
+
+    assert result == [False] * 3
+    log_mock.assert_called_with(error)
+
+
+@pytest.mark.asyncio
+async def test_execute_broadcast_validated(mocker):
+    # Only the transport is replaced, bot.api validates the response
+    mocker.patch("app.broadcast.logger.error")
+    mocker.patch.object(
+        bot.api.http_client,
+        "request_text",
+        new_callable=AsyncMock,
+        return_value=json.dumps(
+            {
+                "response": {"sent": [10, False]},
+                "execute_errors": [
+                    {"method": "messages.send", "error_code": 10}
+                ],
+            }
+        ),
+    )
+
+    assert await execute_broadcast([1, 2], "text", None) == [True, False]
+
+
+@pytest.mark.asyncio
+async def test_course_broadcast_execute_mode(mocker, mock_registry):
     course = 2023
     text = "hello world!"
     attachment = ["123"]
+    ids = list(range(30))
+
+    mocker.patch("app.broadcast.settings.BROADCAST_MODE", "execute")
+    mock_registry(course, ids)
+    execute_broadcast_mock = mocker.patch(
+        "app.broadcast.execute_broadcast",
+        new_callable=AsyncMock,
+        side_effect=lambda groups, *args: [True] * len(groups),
+    )
+
+    result = await course_broadcast(course, text, attachment)
+
+    assert result == (course, (True,) * 30)
+    execute_broadcast_mock.assert_has_awaits(
+        [
+            mocker.call(ids[:25], text, attachment),
+            mocker.call(ids[25:], text, attachment),
+        ]
+    )
+
+
+@pytest.mark.asyncio
+async def test_peers_broadcast(mocker):
+    log_mock = mocker.patch("app.broadcast.logger.warning")
+    text = "hello world!"
+    attachment = ["wall1_1"]
+    peer = settings.GROUP_ID_COEFFICIENT
 
     mocker.patch.object(bot, "api", autospec=True)
+    bot.api.request = AsyncMock(
+        return_value={
+            "response": [
+                {"peer_id": peer + 1, "message_id": 0, "cmid": 5},
+                {"peer_id": peer + 2, "error": {"code": 7}},
+                {"peer_id": peer + 3, "error": {"code": 917}},
+            ]
+        }
+    )
+    delete_group_mock = mocker.patch(
+        "app.broadcast.delete_groups", new_callable=AsyncMock
+    )
+
+    result = await peers_broadcast([1, 2, 3, 4], text, attachment)
+
+    assert result == [True, False, False, False]
+    bot.api.request.assert_awaited_once_with(
+        "messages.send",
+        {
+            "peer_ids": ",".join(str(peer + x) for x in range(1, 5)),
+            "random_id": 0,
+            "message": text,
+            "attachment": "wall1_1",
+        },
+    )
+    delete_group_mock.assert_called_once_with([2])
+    log_mock.assert_called_once_with({"code": 7})
+
+
+@pytest.mark.asyncio
+async def test_course_broadcast_peer_ids_mode(mocker, mock_registry):
+    course = 2023
+    text = "hello world!"
+    ids = list(range(150))
+
+    mocker.patch("app.broadcast.settings.BROADCAST_MODE", "peer_ids")
+    mock_registry(course, ids)
+    peers_broadcast_mock = mocker.patch(
+        "app.broadcast.peers_broadcast",
+        new_callable=AsyncMock,
+        side_effect=lambda groups, *args: [True] * len(groups),
+    )
+
+    result = await course_broadcast(course, text, None)
 
-    get_group_ids_by_course_mock = mocker.patch(
-        "app.broadcast.get_group_ids_by_course", new_callable=AsyncMock
+    assert result == (course, (True,) * 150)
+    peers_broadcast_mock.assert_has_awaits(
+        [
+            mocker.call(ids[:100], text, None),
+            mocker.call(ids[100:], text, None),
+        ]
     )
-    get_group_ids_by_course_mock.return_value = []
+
+
+@pytest.mark.asyncio
+async def test_course_broadcast_empty(mocker, mock_registry):
+    course = 2023
+    text = "hello world!"
+    attachment = ["123"]
+
+    mocker.patch.object(bot, "api", autospec=True)
+
+    get_group_registry_mock = mock_registry(course, [])
 
     result = await course_broadcast(course, text, attachment)
 
     assert result == (course, (False,))
-    get_group_ids_by_course_mock.assert_awaited()
-    get_group_ids_by_course_mock.assert_called_once_with(course)
+    get_group_registry_mock.assert_awaited_once()
 
 
 @pytest.mark.asyncio
@@ -128,7 +315,7 @@ async def test_course_broadcast_exception(mocker):
 
     error = DBError("Error")
     mocker.patch(
-        "app.broadcast.get_group_ids_by_course", new_callable=AsyncMock
+        "app.broadcast.get_group_registry", new_callable=AsyncMock
     ).side_effect = error
 
     result = await course_broadcast(course, text, attachment)
@@ -138,17 +325,14 @@ async def test_course_broadcast_exception(mocker):
 
 
 @pytest.mark.asyncio
-async def test_course_broadcast_successful(mocker):
+async def test_course_broadcast_successful(mocker, mock_registry):
     course = 2023
     text = "hello world!"
     attachment = ["123"]
 
     mocker.patch.object(bot, "api", autospec=True)
 
-    get_group_ids_by_course_mock = mocker.patch(
-        "app.broadcast.get_group_ids_by_course", new_callable=AsyncMock
-    )
-    get_group_ids_by_course_mock.return_value = [1, 2, 3]
+    get_group_registry_mock = mock_registry(course, [1, 2, 3])
 
     group_broadcast_mock = mocker.patch(
         "app.broadcast.group_broadcast", new_callable=AsyncMock
@@ -158,8 +342,7 @@ async def test_course_broadcast_successful(mocker):
     result = await course_broadcast(course, text, attachment)
 
     assert result == (course, (True,) * 3)
-    get_group_ids_by_course_mock.assert_awaited()
-    get_group_ids_by_course_mock.assert_called_once_with(course)
+    get_group_registry_mock.assert_awaited_once()
     group_broadcast_mock.assert_awaited()
     group_broadcast_mock.assert_has_awaits(
         [
@@ -170,6 +353,32 @@ async def test_course_broadcast_successful(mocker):
     )
 
 
+@pytest.mark.asyncio
+async def test_course_broadcast_concurrency_limit(mocker, mock_registry):
+    course = 2023
+    text = "hello world!"
+    attachment = ["123"]
+    running = 0
+    peak = 0
+
+    async def send(*args):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return True
+
+    mocker.patch("app.broadcast.settings.BROADCAST_CONCURRENCY", 2)
+    mock_registry(course, list(range(10)))
+    mocker.patch("app.broadcast.group_broadcast", side_effect=send)
+
+    result = await course_broadcast(course, text, attachment)
+
+    assert result == (course, (True,) * 10)
+    assert peak == 2
+
+
 @pytest.mark.asyncio
 async def test_broadcast_empty(mocker):
     courses = "2023"
@@ -232,3 +441,181 @@ async def test_broadcast_not_numeric_error(mocker):
     result = await broadcast(courses, text, attachment)
     assert not result
     log_mock.assert_called_with("Courses is not numeric")
+
+
+@pytest.mark.asyncio
+async def test_enqueue_broadcast(mocker):
+    registry = GroupRegistry(SharedStore(), ttl=60)
+    registry.load([(1, 1), (2, 1), (3, 3)], None)
+    mocker.patch(
+        "app.broadcast.get_group_registry",
+        new_callable=AsyncMock,
+        return_value=registry,
+    )
+    create_broadcast_job_mock = mocker.patch(
+        "app.broadcast.create_broadcast_job",
+        new_callable=AsyncMock,
+        return_value=7,
+    )
+
+    assert await enqueue_broadcast("1234", "text", None, 42) == 7
+    create_broadcast_job_mock.assert_awaited_once_with(
+        "1234", "text", None, 42, [(1, 1), (2, 1), (3, 3)], True
+    )
+
+    assert await enqueue_broadcast("45", "text", None, 42) is None
+    assert await enqueue_broadcast("qwe", "text", None, 42) is None
+    create_broadcast_job_mock.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_enqueue_broadcast_exception(mocker):
+    log_mock = mocker.patch("app.broadcast.logger.error")
+    error = DBError("Error")
+    mocker.patch(
+        "app.broadcast.get_group_registry", new_callable=AsyncMock
+    ).side_effect = error
+
+    assert await enqueue_broadcast("1", "text") is None
+    log_mock.assert_called_with(error)
+
+
+@pytest.mark.asyncio
+async def test_broadcast_records_deliveries(mocker, init_db):
+    await add_group(1, 1)
+    await add_group(2, 1)
+    mocker.patch.object(bot, "api", autospec=True)
+    bot.api.messages.send = AsyncMock(
+        side_effect=[None, VKAPICommonError(error_msg="Error")]
+    )
+    mocker.patch("app.broadcast.logger.error")
+
+    assert await broadcast("1", "text") == ((1, (True, False)),)
+
+    (job,) = await get_broadcast_jobs(10)
+    assert job.status == "done"
+    deliveries = await get_broadcast_deliveries(job.id)
+    assert [(d.group_id, d.status, d.error_code) for d in deliveries] == [
+        (1, "sent", None),
+        (2, "failed", 1),
+    ]
+    assert all(d.latency_ms >= 0 for d in deliveries)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("flush_size, writes", [(500, 1), (2, 3)])
+async def test_broadcast_buffers_deliveries(
+    mocker, init_db, flush_size, writes
+):
+    for group in range(1, 6):
+        await add_group(group, 1)
+    mocker.patch("app.broadcast.settings.DELIVERY_FLUSH_SIZE", flush_size)
+    mocker.patch("app.broadcast.settings.PROGRESS_INTERVAL", 60)
+    mocker.patch.object(bot, "api", autospec=True)
+    bot.api.messages.send = AsyncMock()
+    record_mock = mocker.patch(
+        "app.broadcast.record_deliveries", side_effect=record_deliveries
+    )
+
+    await broadcast("1", "text")
+
+    # Not one write per send
+    assert record_mock.await_count == writes
+    (job,) = await get_broadcast_jobs(10)
+    deliveries = await get_broadcast_deliveries(job.id)
+    assert {d.status for d in deliveries} == {"sent"}
+
+
+@pytest.mark.asyncio
+async def test_execute_broadcast_records_error_codes(mocker):
+    mocker.patch.object(bot, "api", autospec=True)
+    bot.api.request = AsyncMock(
+        return_value={
+            "response": {"sent": [1, False]},
+            "execute_errors": [{"method": "messages.send", "error_code": 9}],
+        }
+    )
+    mocker.patch("app.broadcast.logger.error")
+    state = BroadcastState()
+    token = broadcast_state.set(state)
+    try:
+        assert await execute_broadcast([1, 2], "text", None) == [True, False]
+    finally:
+        broadcast_state.reset(token)
+
+    assert state.error_codes == {2: 9}
+
+
+@pytest.mark.asyncio
+async def test_broadcast_prunes_dead_groups_once(mocker, init_db):
+    for group in range(1, 6):
+        await add_group(group, 1)
+    mocker.patch.object(bot, "api", autospec=True)
+    error = VKAPIErrorPermissionDenied(error_msg="Permission denied")
+    bot.api.messages.send = AsyncMock(
+        side_effect=[None, error, error, None, error]
+    )
+    mocker.patch("app.broadcast.logger.warning")
+    delete_groups_spy = mocker.patch(
+        "app.broadcast.delete_groups",
+        new_callable=AsyncMock,
+        side_effect=delete_groups,
+    )
+
+    result = await broadcast("1", "text")
+
+    assert result == ((1, (True, False, False, True, False)),)
+    delete_groups_spy.assert_awaited_once_with([2, 3, 5])
+    assert await get_groups_ids() == [1, 4]
+    assert group_registry.get_group_ids(1) == [1, 4]
+
+
+@pytest.mark.asyncio
+async def test_drop_group_prunes_in_batches(mocker):
+    mocker.patch("app.broadcast.settings.PRUNE_BATCH_SIZE", 2)
+    delete_groups_mock = mocker.patch(
+        "app.broadcast.delete_groups", new_callable=AsyncMock
+    )
+    state = BroadcastState()
+    token = broadcast_state.set(state)
+    try:
+        for group in (3, 1, 2):
+            await drop_group(group)
+    finally:
+        broadcast_state.reset(token)
+
+    delete_groups_mock.assert_awaited_once_with([1, 3])
+    assert state.dead_groups == {2}
+
+
+@pytest.mark.asyncio
+async def test_prune_groups_exception(mocker):
+    log_mock = mocker.patch("app.broadcast.logger.error")
+    error = DBError("Error")
+    mocker.patch(
+        "app.broadcast.delete_groups", new_callable=AsyncMock
+    ).side_effect = error
+    state = BroadcastState()
+    state.dead_groups.add(1)
+
+    await prune_groups(state)
+
+    log_mock.assert_called_with(error)
+    assert not state.dead_groups
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mode", ["single", "execute", "peer_ids"])
+async def test_broadcast_fake_vk_api(mocker, init_db, fake_vk_api, mode):
+    for group in range(1, 5):
+        await add_group(group, 1)
+    mocker.patch("app.broadcast.settings.BROADCAST_MODE", mode)
+    mocker.patch("app.broadcast.logger.warning")
+    fake_vk_api.errors = {7: 0.5}
+
+    ((course, result),) = await broadcast("1", "text")
+
+    sent = [group for group, ok in zip(range(1, 5), result) if ok]
+    assert course == 1
+    assert 0 < len(sent) < 4
+    assert await get_groups_ids() == sent
@@ -0,0 +1,84 @@
+import time
+
+import pytest
+
+from app.cache import GroupRegistry
+from app.store import SharedStore
+
+
+@pytest.fixture()
+def registry():
+    registry = GroupRegistry(SharedStore(), ttl=60)
+    registry.load([(1, 1), (2, 1), (3, 2)], registry.get_version())
+    return registry
+
+
+def test_lookups(registry):
+    assert 1 in registry
+    assert 4 not in registry
+    assert len(registry) == 3
+    assert registry.get_course(3) == 2
+    assert registry.get_course(4) is None
+    assert registry.get_group_ids(1) == [1, 2]
+    assert registry.get_group_ids(5) == []
+
+
+def test_write_through(registry):
+    registry.put(4, 2)
+    registry.put(1, 2)
+    registry.discard(3)
+
+    assert registry.get_group_ids(1) == [2]
+    assert registry.get_group_ids(2) == [1, 4]
+    assert 3 not in registry
+    assert not registry.is_stale()
+
+
+def test_discard_many_bumps_version_once(registry):
+    registry.discard_many([1, 3, 5])
+
+    assert registry.get_group_ids(1) == [2]
+    assert registry.get_group_ids(2) == []
+    assert registry.get_version() == 1
+    assert not registry.is_stale()
+
+
+def test_stale_after_ttl(registry, mocker):
+    mocker.patch("app.cache.time.monotonic", return_value=10**9)
+    assert registry.is_stale()
+
+
+def test_stale_after_other_process_write(registry):
+    other = GroupRegistry(registry.store, ttl=60)
+    other.load([], other.get_version())
+
+    other.put(5, 1)
+
+    assert registry.is_stale()
+    assert not other.is_stale()
+
+    registry.put(6, 1)
+    assert registry.is_stale()
+
+
+def test_version_checked_once_per_interval(registry, mocker):
+    registry.check_interval = 5
+    registry.load([], registry.get_version())
+    get_mock = mocker.spy(registry.store, "get")
+    other = GroupRegistry(registry.store, ttl=60)
+    other.put(5, 1)
+
+    assert not registry.is_stale()
+    get_mock.assert_not_called()
+
+    mocker.patch(
+        "app.cache.time.monotonic", return_value=time.monotonic() + 10
+    )
+    assert registry.is_stale()
+    get_mock.assert_called_once()
+
+
+def test_clear(registry):
+    registry.clear()
+    assert not registry
+    assert registry.is_stale()
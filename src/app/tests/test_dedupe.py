@@ -0,0 +1,98 @@
+import pytest
+
+from app.dedupe import EventDeduplicator, get_event_key
+from app.store import SharedStore
+
+
+@pytest.mark.parametrize(
+    "data, expected",
+    [
+        ({"group_id": 1, "event_id": "abc"}, "abc"),
+        (
+            {
+                "group_id": 1,
+                "object": {
+                    "message": {
+                        "from_id": 1,
+                        "peer_id": 2,
+                        "text": "",
+                        "conversation_message_id": 3,
+                    }
+                },
+            },
+            "2:3",
+        ),
+        (
+            {
+                "group_id": 1,
+                "object": {
+                    "message": {"from_id": 1, "peer_id": 2, "text": ""}
+                },
+            },
+            None,
+        ),
+        ({"type": "confirmation", "group_id": 1}, None),
+    ],
+)
+def test_get_event_key(data, expected):
+    assert get_event_key(data) == expected
+
+
+def test_is_duplicate():
+    deduplicator = EventDeduplicator(ttl=60, size=10)
+    assert not deduplicator.is_duplicate("a")
+    assert deduplicator.is_duplicate("a")
+    assert not deduplicator.is_duplicate("b")
+    assert not deduplicator.is_duplicate(None)
+    assert not deduplicator.is_duplicate(None)
+
+
+def test_is_duplicate_ttl(mocker):
+    time_mock = mocker.patch("app.dedupe.time.monotonic", return_value=0)
+    deduplicator = EventDeduplicator(ttl=60, size=10)
+    assert not deduplicator.is_duplicate("a")
+
+    time_mock.return_value = 61
+    assert not deduplicator.is_duplicate("a")
+
+
+def test_is_duplicate_size():
+    deduplicator = EventDeduplicator(ttl=60, size=2)
+    for key in "abc":
+        assert not deduplicator.is_duplicate(key)
+    assert not deduplicator.is_duplicate("a")
+    assert deduplicator.is_duplicate("c")
+
+
+def test_is_duplicate_evicts_least_recently_seen():
+    deduplicator = EventDeduplicator(ttl=60, size=2)
+    assert not deduplicator.is_duplicate("a")
+    assert not deduplicator.is_duplicate("b")
+    assert deduplicator.is_duplicate("a")
+    assert not deduplicator.is_duplicate("c")
+    assert deduplicator.is_duplicate("a")
+    assert not deduplicator.is_duplicate("b")
+
+
+def test_is_duplicate_shared():
+    shared_store = SharedStore()
+    first = EventDeduplicator(ttl=60, size=10, shared_store=shared_store)
+    second = EventDeduplicator(ttl=60, size=10, shared_store=shared_store)
+
+    assert not first.is_duplicate("a")
+    assert second.is_duplicate("a")
+    assert second.is_duplicate("a")
+
+
+def test_mark_seen():
+    shared_store = SharedStore()
+    first = EventDeduplicator(ttl=60, size=10, shared_store=shared_store)
+    second = EventDeduplicator(ttl=60, size=10, shared_store=shared_store)
+
+    assert not first.is_seen("a")
+    assert not first.is_seen("a")
+    first.mark_seen("a")
+    first.mark_seen(None)
+    assert first.is_seen("a")
+    assert second.is_seen("a")
+    assert not second.is_seen(None)
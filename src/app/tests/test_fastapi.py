@@ -1,11 +1,20 @@
 from hmac import compare_digest
 
 import pytest
+from fastapi import FastAPI
 from fastapi.testclient import TestClient
 
 import app as App
 import settings
-from app.db import get_course_by_group_id
+from app import db
+from app.db import (
+    create_broadcast_job,
+    current_session,
+    finish_broadcast_job,
+    get_course_by_group_id,
+    record_deliveries,
+)
+from app.dedupe import EventDeduplicator
 from app.routes import app
 from app.vk import bot
 
@@ -46,6 +55,18 @@ def test_callback_confirmation(mocker, data):
     assert compare_digest(response.text, test_token)
 
 
+def test_callback_invalid_event(mocker):
+    client = TestClient(app)
+    mock_process_event = mocker.patch(
+        "app.routes.bot.process_event", mocker.AsyncMock()
+    )
+
+    response = client.post("/api/callback", json={"type": "message_new"})
+
+    assert response.status_code == 422
+    mock_process_event.assert_not_awaited()
+
+
 @pytest.mark.asyncio
 async def test_callback_event(mocker):
     client = TestClient(app)
@@ -78,6 +99,35 @@ async def test_callback_event(mocker):
     mock_process_event.assert_awaited_once_with(data)
 
 
+@pytest.mark.asyncio
+async def test_callback_duplicate_event(mocker):
+    client = TestClient(app)
+    data = {
+        "type": "message_new",
+        "event_id": "4a1b2c3d",
+        "group_id": 123,
+        "object": {
+            "message": {
+                "from_id": 123,
+                "peer_id": 123,
+                "text": "Помощь",
+                "conversation_message_id": 1,
+            },
+        },
+    }
+
+    mocker.patch("app.routes.deduplicator", EventDeduplicator(60, 10))
+    mock_process_event = mocker.patch(
+        "app.routes.bot.process_event", mocker.AsyncMock()
+    )
+
+    for _ in range(3):
+        response = client.post("/api/callback", json=data)
+        assert response.status_code == 200
+        assert response.text == "ok"
+    mock_process_event.assert_awaited_once_with(data)
+
+
 @pytest.mark.asyncio
 async def test_callback_full_event(mocker, init_db, groups):
     client = TestClient(app)
@@ -113,7 +163,7 @@ async def test_callback_full_event(mocker, init_db, groups):
                 mocker.call(
                     peer_id=settings.GROUP_ID_COEFFICIENT + x,
                     message=text,
-                    random_id=0,
+                    random_id=mocker.ANY,
                     attachment=None,
                 )
                 for x in range(1, 4)
@@ -185,3 +235,188 @@ async def test_fix_course_change(
             )
         ]
     )
+
+
+@pytest.fixture()
+def admin_client(mocker):
+    mocker.patch("app.routes.settings.ADMIN_API_TOKEN", "secret")
+    api = FastAPI()
+    api.include_router(app)
+    return TestClient(api)
+
+
+@pytest.mark.parametrize("headers", [{}, {"X-Admin-Token": "wrong"}])
+def test_broadcasts_forbidden(admin_client, headers):
+    response = admin_client.get("/api/broadcasts", headers=headers)
+    assert response.status_code == 403
+
+
+def test_broadcasts_closed_without_token(admin_client, mocker):
+    mocker.patch("app.routes.settings.ADMIN_API_TOKEN", "")
+    response = admin_client.get(
+        "/api/broadcasts", headers={"X-Admin-Token": ""}
+    )
+    assert response.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_broadcast_status(admin_client, init_db):
+    job_id = await create_broadcast_job(
+        "1", "text", None, None, [(1, 1), (2, 1)], queued=False
+    )
+    await record_deliveries(job_id, [(1, False, 7, 12.5)])
+    headers = {"X-Admin-Token": "secret"}
+
+    response = admin_client.get("/api/broadcasts", headers=headers)
+    assert response.status_code == 200
+    assert [job["id"] for job in response.json()] == [job_id]
+
+    response = admin_client.get(f"/api/broadcasts/{job_id}", headers=headers)
+    assert response.status_code == 200
+    body = response.json()
+    assert (body["total"], body["failed"], body["pending"]) == (2, 1, 1)
+    assert body["deliveries"][0]["error_code"] == 7
+    assert body["deliveries"][0]["latency_ms"] == 12.5
+
+    response = admin_client.get(
+        f"/api/broadcasts/{job_id + 1}", headers=headers
+    )
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_broadcast_events(admin_client, init_db):
+    job_id = await create_broadcast_job(
+        "1", "text", None, None, [(1, 1)], queued=False
+    )
+    await record_deliveries(job_id, [(1, True, None, 1.0)])
+    await finish_broadcast_job(job_id)
+    headers = {"X-Admin-Token": "secret"}
+
+    response = admin_client.get(
+        f"/api/broadcasts/{job_id}/events", headers=headers
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert response.text.count("event: progress") == 1
+    assert '"status": "done"' in response.text
+
+    response = admin_client.get(
+        f"/api/broadcasts/{job_id + 1}/events", headers=headers
+    )
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "test_group_id, course, answers",
+    [
+        (
+            4,
+            3,
+            [
+                App.bot.messages.ADDED_SUCCESSFULLY % {"course": 3},
+                App.bot.messages.WELCOME % {"course": 3},
+            ],
+        ),
+        (1, 1, ["Ваша беседа уже есть в списке"]),
+    ],
+)
+async def test_add_group_command(
+    mocker, init_db, groups, test_group_id, course, answers
+):
+    peer_id = test_group_id + settings.GROUP_ID_COEFFICIENT
+    client = TestClient(app)
+    data = {
+        "type": "message_new",
+        "group_id": test_group_id,
+        "object": {
+            "message": {
+                "from_id": 1,
+                "peer_id": peer_id,
+                "text": "Добавить 3",
+                "date": 0,
+                "id": 0,
+                "out": 0,
+            },
+            "client_info": {},
+        },
+    }
+    mocker.patch.object(bot, "api", autospec=True)
+    bot.api.messages.send = mocker.AsyncMock()
+
+    response = client.post("/api/callback", json=data)
+
+    assert response.status_code == 200
+    bot.api.messages.send.assert_has_awaits(
+        [
+            mocker.call(peer_ids=[peer_id], message=answer, random_id=0)
+            for answer in answers
+        ]
+    )
+    assert await get_course_by_group_id(test_group_id) == course
+
+
+@pytest.mark.asyncio
+async def test_fix_course_change_missing_group(mocker, init_db):
+    peer_id = 4 + settings.GROUP_ID_COEFFICIENT
+    client = TestClient(app)
+    data = {
+        "type": "message_new",
+        "group_id": 4,
+        "object": {
+            "message": {
+                "from_id": 1,
+                "peer_id": peer_id,
+                "text": "Изменить курс 2",
+                "date": 0,
+                "id": 0,
+                "out": 0,
+            },
+            "client_info": {},
+        },
+    }
+    mocker.patch.object(bot, "api", autospec=True)
+    bot.api.messages.send = mocker.AsyncMock()
+    sessions = []
+
+    async def set_group_course(group_id, course):
+        sessions.append(current_session.get())
+        return await db.set_group_course(group_id, course)
+
+    mocker.patch(
+        "app.bot.admin.set_group_course", side_effect=set_group_course
+    )
+
+    response = client.post("/api/callback", json=data)
+
+    assert response.status_code == 200
+    # The command runs in its own unit of work
+    assert len(sessions) == 1 and sessions[0] is not None
+    bot.api.messages.send.assert_awaited_once_with(
+        peer_ids=[peer_id],
+        message="Вашей беседы ещё нет в списке",
+        random_id=0,
+    )
+    assert await get_course_by_group_id(4) is None
+
+
+def test_profile(admin_client):
+    headers = {"X-Admin-Token": "secret"}
+
+    response = admin_client.get(
+        "/api/profile", params={"seconds": 0.05}, headers=headers
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "MainThread;" in response.text
+
+    assert admin_client.get("/api/profile").status_code == 403
+
+
+def test_profile_busy(admin_client, mocker):
+    mocker.patch("app.routes.profile", return_value=None)
+    response = admin_client.get(
+        "/api/profile", headers={"X-Admin-Token": "secret"}
+    )
+    assert response.status_code == 409
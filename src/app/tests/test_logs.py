@@ -0,0 +1,80 @@
+import logging
+import sys
+import threading
+
+import orjson
+import pytest
+
+from app.logs import JSONFormatter, LogQueueHandler, pipeline, setup_logging
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self) -> None:
+        super().__init__()
+        self.records: list[tuple[logging.LogRecord, str]] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.records.append((record, threading.current_thread().name))
+
+
+def get_record(**kwargs) -> logging.LogRecord:
+    return logging.makeLogRecord(
+        {
+            "name": "app.broadcast",
+            "levelno": logging.WARNING,
+            "levelname": "WARNING",
+            "msg": "Broadcast %s failed",
+            "args": (7,),
+            **kwargs,
+        }
+    )
+
+
+def test_json_formatter():
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        record = get_record(exc_info=sys.exc_info(), job_id=7)
+
+    data = orjson.loads(JSONFormatter().format(record))
+
+    assert data["level"] == "WARNING"
+    assert data["logger"] == "app.broadcast"
+    assert data["message"] == "Broadcast 7 failed"
+    assert data["job_id"] == 7
+    assert "ValueError: boom" in data["exc_info"]
+    assert "args" not in data
+
+
+def test_queue_handler_prepare():
+    args = ["first"]
+    record = get_record(msg="Broadcast %s failed", args=(args,))
+
+    prepared = LogQueueHandler(None).prepare(record)  # type: ignore
+    args.append("second")
+
+    assert prepared.getMessage() == "Broadcast ['first'] failed"
+
+
+@pytest.fixture()
+def root_level():
+    root = logging.getLogger()
+    level = root.level
+    yield
+    pipeline.stop()
+    root.setLevel(level)
+
+
+def test_setup_logging(root_level):
+    handler = RecordingHandler()
+    previous = logging.getLogger().handlers[:]
+    setup_logging(handler)
+    assert len(logging.getLogger().handlers) == 1
+
+    logging.getLogger("app.test").info("Written by %s", "the writer")
+    pipeline.stop()
+
+    ((record, thread),) = handler.records
+    assert record.getMessage() == "Written by the writer"
+    assert thread != threading.current_thread().name
+    assert logging.getLogger().handlers == previous
@@ -0,0 +1,175 @@
+import asyncio
+from unittest.mock import AsyncMock
+
+import aiohttp
+import pytest
+
+from app import longpoll
+from app.bot import messages
+from app.longpoll import TS_KEY, LongPollRunner, poll_once, run_longpoll
+from app.store import SharedStore
+from app.tests.test_vk_api import get_peer_id
+from app.vk import bot
+
+
+def get_event(event_id: str, text: str, group: int = 1) -> dict:
+    return {
+        "type": "message_new",
+        "event_id": event_id,
+        "group_id": 1,
+        "object": {
+            "message": {
+                "from_id": 1,
+                "peer_id": get_peer_id(group),
+                "text": text,
+                "date": 0,
+                "id": 0,
+                "out": 0,
+            },
+            "client_info": {},
+        },
+    }
+
+
+@pytest.fixture()
+def longpoll_store(mocker, tmp_path):
+    shared_store = SharedStore(str(tmp_path / "store.db"))
+    mocker.patch.object(longpoll, "store", shared_store)
+    mocker.patch("app.longpoll.settings.LONGPOLL_WAIT", 1)
+    mocker.patch("app.longpoll.settings.LONGPOLL_RETRY_DELAY", 0)
+    return shared_store
+
+
+async def wait_for(condition) -> None:
+    for _ in range(200):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("Condition not met")
+
+
+@pytest.mark.asyncio
+async def test_run_longpoll(mocker, fake_vk_api, longpoll_store):
+    mocker.patch("app.bot.common.settings.ADMINS", [1])
+    log_mock = mocker.patch("app.longpoll.logger.error")
+    fake_vk_api.script(method="groups.getLongPollServer", error=10, times=1)
+    fake_vk_api.push_event(get_event("longpoll-1", "Помощь", 1))
+    longpoll_store.set(TS_KEY, "0")
+    task = asyncio.create_task(run_longpoll())
+
+    await wait_for(lambda: longpoll_store.get(TS_KEY) == "1")
+    fake_vk_api.push_event(get_event("longpoll-2", "Помощь", 2))
+    await wait_for(lambda: longpoll_store.get(TS_KEY) == "2")
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    log_mock.assert_called_once()
+    assert fake_vk_api.get_texts(get_peer_id(1)) == [messages.HELP]
+    assert fake_vk_api.get_texts(get_peer_id(2)) == [messages.HELP]
+
+
+@pytest.mark.asyncio
+async def test_run_longpoll_resumes(mocker, fake_vk_api, longpoll_store):
+    process_event_mock = mocker.patch.object(
+        bot, "process_event", new_callable=AsyncMock
+    )
+    fake_vk_api.push_event(get_event("longpoll-3", "Привет"))
+    fake_vk_api.push_event(get_event("longpoll-4", "Привет"))
+    # The runner stopped after the first event
+    longpoll_store.set(TS_KEY, "1")
+    task = asyncio.create_task(run_longpoll())
+
+    await wait_for(lambda: longpoll_store.get(TS_KEY) == "2")
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    process_event_mock.assert_awaited_once_with(
+        get_event("longpoll-4", "Привет")
+    )
+
+
+@pytest.mark.asyncio
+async def test_run_longpoll_without_store_path(mocker):
+    mocker.patch.object(longpoll, "store", SharedStore())
+
+    with pytest.raises(RuntimeError):
+        await run_longpoll()
+
+
+@pytest.mark.asyncio
+async def test_runner_replays_unfinished_events(mocker, longpoll_store):
+    started = asyncio.Event()
+
+    async def process_event(event):
+        if event["event_id"] == "longpoll-9":
+            started.set()
+            await asyncio.sleep(3600)
+
+    process_event_mock = mocker.patch.object(
+        bot, "process_event", side_effect=process_event
+    )
+    done = get_event("longpoll-8", "Привет")
+    unfinished = get_event("longpoll-9", "Рассылка: 1 текст")
+    runner = LongPollRunner(2)
+    await runner.handle([done, unfinished], "1")
+    await started.wait()
+    # The runner stops before the batch is done, its ts is not saved
+    for _, tasks in runner.batches:
+        for task in tasks:
+            task.cancel()
+    await runner.join()
+    assert longpoll_store.get(TS_KEY) is None
+
+    mocker.patch.object(bot, "process_event", new_callable=AsyncMock)
+    restarted = LongPollRunner(2)
+    await restarted.handle([done, unfinished], "1")
+    await restarted.join()
+
+    # Only the event that was not handled runs again
+    assert process_event_mock.await_count == 2
+    bot.process_event.assert_awaited_once_with(unfinished)
+    assert longpoll_store.get(TS_KEY) == "1"
+
+
+@pytest.mark.asyncio
+async def test_poll_once_failed(mocker, fake_vk_api):
+    mocker.patch("app.longpoll.logger.warning")
+    runner = LongPollRunner(1)
+    fake_vk_api.push_event(get_event("longpoll-5", "Привет"))
+    server = fake_vk_api.get_longpoll_server({})["response"]
+
+    async with aiohttp.ClientSession() as session:
+        # Out of the history, polling goes on from the latest ts
+        fake_vk_api.history_start = 1
+        assert await poll_once(session, runner, server, "0") == (server, "1")
+
+        # The key expired, the ts is kept
+        fake_vk_api.longpoll_key = "new"
+        new_server, ts = await poll_once(session, runner, server, "1")
+        assert (new_server["key"], ts) == ("new", "1")
+
+    assert not runner.batches
+
+
+@pytest.mark.asyncio
+async def test_runner_commits_in_order(mocker, longpoll_store):
+    release = asyncio.Event()
+
+    async def process_event(event):
+        if event["event_id"] == "longpoll-6":
+            await release.wait()
+
+    mocker.patch.object(bot, "process_event", side_effect=process_event)
+    runner = LongPollRunner(2)
+
+    await runner.handle([get_event("longpoll-6", "Привет")], "1")
+    await runner.handle([get_event("longpoll-7", "Привет")], "2")
+    await asyncio.sleep(0.01)
+    # The second batch is done, but the first one is not
+    assert longpoll_store.get(TS_KEY) is None
+
+    release.set()
+    await runner.join()
+    assert longpoll_store.get(TS_KEY) == "2"
@@ -0,0 +1,66 @@
+import os
+import subprocess  # nosec
+import sys
+
+from fastapi.testclient import TestClient
+
+import main
+
+SRC = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+# Seconds `import main` may take, FastAPI itself takes about a third
+IMPORT_BUDGET = 1.0
+HEAVY_MODULES = ("app.routes", "vkbottle", "sqlalchemy", "sentry_sdk")
+
+IMPORT_CODE = f"""
+import sys, time
+started = time.perf_counter()
+import main
+print(time.perf_counter() - started)
+print(",".join(name for name in {HEAVY_MODULES!r} if name in sys.modules))
+"""
+
+
+def test_import_time():
+    # A fresh interpreter, the test process has everything imported
+    output = subprocess.run(  # nosec
+        [sys.executable, "-c", IMPORT_CODE],
+        cwd=SRC,
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout.splitlines()
+
+    assert float(output[0]) < IMPORT_BUDGET
+    assert output[1:] in ([], [""])
+
+
+def test_create_app(mocker):
+    sentry_handler = mocker.Mock()
+    mocker.patch.object(main, "setup_sentry", return_value=[sentry_handler])
+    setup_logging_mock = mocker.patch("app.logs.setup_logging")
+    warm_up_mock = mocker.patch("app.warmup.warm_up")
+    mocker.patch("app.routes.settings.GROUP_ID", "1")
+    mocker.patch("app.routes.settings.CONFIRMATION_TOKEN", "token")
+    mocker.patch("app.routes.settings.ADMIN_API_TOKEN", "secret")
+
+    with TestClient(main.create_app()) as client:
+        setup_logging_mock.assert_called_once_with(sentry_handler)
+        warm_up_mock.assert_awaited_once()
+        assert client.get("/health/").json() == "i'm alive"
+        assert client.get("/metrics").status_code == 403
+        response = client.get("/metrics", headers={"X-Admin-Token": "secret"})
+        assert response.status_code == 200
+        response = client.post(
+            "/api/callback", json={"type": "confirmation", "group_id": 1}
+        )
+        assert response.text == "token"
+
+
+def test_app_built_on_access(mocker):
+    create_app_mock = mocker.patch.object(main, "create_app")
+    mocker.patch.dict(main.__dict__)
+    main.__dict__.pop("app", None)
+
+    assert main.app is create_app_mock.return_value
+    assert main.app is create_app_mock.return_value
+    create_app_mock.assert_called_once_with()
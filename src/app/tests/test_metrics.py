@@ -0,0 +1,180 @@
+import pytest
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+
+import settings
+from app.broadcast import course_broadcast, execute_broadcast
+from app.db import get_groups_ids
+from app.metrics import get_error_codes, get_metrics
+from app.routes import app
+from app.tests.test_vk_api import get_peer_id
+from app.vk import bot
+
+
+def get_value(name: str, **labels: str) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def test_get_metrics():
+    content, media_type = get_metrics()
+
+    assert b"callback_request_seconds" in content
+    assert media_type.startswith("text/plain")
+
+
+def test_get_metrics_multiprocess(mocker, tmp_path):
+    mocker.patch.object(settings, "PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+
+    content, _ = get_metrics()
+
+    assert b"callback_request_seconds" not in content
+
+
+def test_callback_metrics(mocker):
+    mocker.patch("app.routes.bot.process_event", mocker.AsyncMock())
+    client = TestClient(app)
+    events = get_value("callback_events_total", type="message_new")
+    invalid = get_value("callback_events_total", type="invalid")
+    requests = get_value("callback_request_seconds_count")
+
+    client.post(
+        "/api/callback",
+        json={"type": "message_new", "group_id": 1, "object": {}},
+    )
+    client.post("/api/callback", content=b"{")
+
+    assert get_value("callback_events_total", type="message_new") == (
+        events + 1
+    )
+    assert get_value("callback_events_total", type="invalid") == invalid + 1
+    assert get_value("callback_request_seconds_count") == requests + 2
+
+
+@pytest.mark.asyncio
+async def test_db_metrics(init_db):
+    calls = get_value("db_call_seconds_count", function="get_groups_ids")
+
+    await get_groups_ids()
+
+    assert get_value("db_call_seconds_count", function="get_groups_ids") == (
+        calls + 1
+    )
+
+
+@pytest.mark.asyncio
+async def test_vk_api_metrics(mocker, fake_vk_api, mock_registry):
+    mocker.patch("app.broadcast.logger.error")
+    mock_registry(1, range(1, 4))
+    fake_vk_api.script(peer_id=get_peer_id(2), error=10, times=1)
+    requests = get_value(
+        "vk_api_request_seconds_count", method="messages.send"
+    )
+    errors = get_value(
+        "vk_api_errors_total", method="messages.send", code="10"
+    )
+    sent = get_value("broadcast_messages_total", status="sent")
+    failed = get_value("broadcast_messages_total", status="failed")
+
+    await course_broadcast(1, "text", None)
+
+    assert get_value(
+        "vk_api_request_seconds_count", method="messages.send"
+    ) == (requests + 3)
+    assert get_value(
+        "vk_api_errors_total", method="messages.send", code="10"
+    ) == (errors + 1)
+    assert get_value("broadcast_messages_total", status="sent") == sent + 2
+    assert get_value("broadcast_messages_total", status="failed") == (
+        failed + 1
+    )
+    assert get_value("broadcasts_in_flight") == 0
+
+
+@pytest.mark.asyncio
+async def test_vk_api_execute_error_metrics(mocker, fake_vk_api):
+    mocker.patch("app.broadcast.logger.error")
+    fake_vk_api.script(peer_id=get_peer_id(1), error=9, times=1)
+    errors = get_value("vk_api_errors_total", method="messages.send", code="9")
+
+    assert await execute_broadcast([1, 2], "text", None) == [False, True]
+    assert get_value(
+        "vk_api_errors_total", method="messages.send", code="9"
+    ) == (errors + 1)
+
+
+def test_get_error_codes():
+    assert get_error_codes("messages.send", [1]) == []
+    assert get_error_codes(
+        "messages.send",
+        {
+            "response": [
+                {"peer_id": 1, "message_id": 0},
+                {"peer_id": 2, "error": {"code": 7}},
+            ]
+        },
+    ) == [("messages.send", 7)]
+
+
+@pytest.mark.asyncio
+async def test_handler_metrics(mocker, fake_vk_api):
+    mocker.patch("app.bot.common.settings.ADMINS", [1])
+    calls = get_value("bot_handler_seconds_count", handler="user_help")
+    unhandled = get_value("bot_handler_seconds_count", handler="unhandled")
+
+    for text in ("Помощь", "Привет"):
+        await bot.process_event(
+            {
+                "type": "message_new",
+                "group_id": 1,
+                "object": {
+                    "message": {
+                        "from_id": 1,
+                        "peer_id": get_peer_id(1),
+                        "text": text,
+                        "date": 0,
+                        "id": 0,
+                        "out": 0,
+                    },
+                    "client_info": {},
+                },
+            }
+        )
+
+    assert get_value("bot_handler_seconds_count", handler="user_help") == (
+        calls + 1
+    )
+    assert get_value("bot_handler_seconds_count", handler="unhandled") == (
+        unhandled + 1
+    )
+
+
+@pytest.mark.asyncio
+async def test_slow_handler(mocker, init_db, fake_vk_api):
+    mocker.patch("app.bot.admin.handle_course", return_value=True)
+    mocker.patch("app.metrics.settings.SLOW_HANDLER_BUDGET", 0)
+    log_mock = mocker.patch("app.metrics.logger.warning")
+
+    await bot.process_event(
+        {
+            "type": "message_new",
+            "group_id": 1,
+            "object": {
+                "message": {
+                    "from_id": 1,
+                    "peer_id": get_peer_id(1),
+                    "text": "Добавить 1",
+                    "date": 0,
+                    "id": 0,
+                    "out": 0,
+                },
+                "client_info": {},
+            },
+        }
+    )
+
+    log_mock.assert_called_once()
+    args = log_mock.call_args.args
+    assert args[1] == "add"
+    # add_group_if_absent, then the two answers
+    assert (args[4], args[6]) == (1, 2)
+    assert args[3] <= args[2] and args[5] <= args[2]
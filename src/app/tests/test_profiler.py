@@ -0,0 +1,46 @@
+import threading
+
+import pytest
+
+from app.profiler import get_folded, profile, profiler_lock, sample_stacks
+
+
+def spin(stop: threading.Event) -> None:
+    while not stop.is_set():
+        pass
+
+
+def test_sample_stacks():
+    stop = threading.Event()
+    thread = threading.Thread(target=spin, args=(stop,), name="spinner")
+    thread.start()
+    try:
+        stacks = sample_stacks(0.05, 0.001)
+    finally:
+        stop.set()
+        thread.join()
+
+    spinner = [stack for stack in stacks if stack.startswith("spinner;")]
+    assert spinner
+    assert all(";spin (" in stack for stack in spinner)
+    assert not any("sample_stacks" in stack for stack in stacks)
+
+
+def test_get_folded():
+    stacks = sample_stacks(0, 0.001)
+    stacks.update({"MainThread;main;run": 3, "MainThread;main": 1})
+
+    assert get_folded(stacks).splitlines()[:2] == [
+        "MainThread;main;run 3",
+        "MainThread;main 1",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_profile_once_at_a_time():
+    with profiler_lock:
+        assert await profile(0.01, 0.001) is None
+
+    folded = await profile(0.01, 0.001)
+    assert folded is not None
+    assert "MainThread;" in folded
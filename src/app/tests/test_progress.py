@@ -0,0 +1,104 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.db import (
+    BroadcastJob,
+    claim_deliveries,
+    create_broadcast_job,
+    finish_broadcast_job,
+    record_deliveries,
+)
+from app.progress import (
+    get_broadcast_status,
+    get_broadcasts,
+    get_progress,
+    progress_events,
+)
+
+
+def test_get_progress():
+    created_at = datetime(2024, 1, 1)
+    job = BroadcastJob(
+        id=1, courses="12", status="running", created_at=created_at
+    )
+    stats = [
+        (1, "sent", 3, 30.0, created_at + timedelta(seconds=1)),
+        (1, "failed", 1, 50.0, created_at + timedelta(seconds=2)),
+        (1, "sending", 4, None, None),
+        (2, "sent", 10, 10.0, created_at + timedelta(seconds=9)),
+    ]
+
+    progress = get_progress(job, stats)
+
+    assert (progress.total, progress.sent, progress.failed) == (8, 3, 1)
+    assert progress.pending == 4
+    assert progress.latency_ms == 20.0
+    assert progress.rate == 2.0
+
+
+def test_get_progress_empty():
+    job = BroadcastJob(
+        id=1, courses="1", status="pending", created_at=datetime.utcnow()
+    )
+
+    progress = get_progress(job, [])
+
+    assert progress.total == 0
+    assert progress.latency_ms is None
+    assert progress.rate is None
+
+
+@pytest.mark.asyncio
+async def test_get_broadcast_status(init_db):
+    job_id = await create_broadcast_job(
+        "1", "text", None, None, [(1, 1), (2, 1)]
+    )
+    await claim_deliveries(10, 60)
+    await record_deliveries(job_id, [(1, True, None, 5.0)])
+
+    status = await get_broadcast_status(job_id)
+
+    assert (status.total, status.sent, status.pending) == (2, 1, 1)
+    assert [
+        (delivery.group_id, delivery.status, delivery.attempts)
+        for delivery in status.deliveries
+    ] == [(1, "sent", 1), (2, "pending", 1)]
+    assert [job.id for job in await get_broadcasts(10)] == [job_id]
+    assert await get_broadcast_status(job_id + 1) is None
+
+
+@pytest.mark.asyncio
+async def test_progress_events(mocker, init_db):
+    mocker.patch("app.progress.settings.PROGRESS_INTERVAL", 0)
+    job_id = await create_broadcast_job(
+        "1", "text", None, None, [(1, 1)], queued=False
+    )
+
+    events = progress_events(job_id)
+    first = await anext(events)
+    await record_deliveries(job_id, [(1, True, None, 5.0)])
+    await finish_broadcast_job(job_id)
+    rest = [event async for event in events]
+
+    assert first.startswith("event: progress\ndata: {")
+    assert '"sent": 0' in first
+    assert len(rest) == 1
+    assert '"sent": 1' in rest[0] and '"status": "done"' in rest[0]
+    assert [event async for event in progress_events(job_id + 1)] == []
+
+
+@pytest.mark.asyncio
+async def test_progress_events_stalled(mocker, init_db):
+    mocker.patch("app.progress.settings.PROGRESS_INTERVAL", 0.01)
+    mocker.patch("app.progress.settings.PROGRESS_STALL_TIMEOUT", 0.05)
+    # Left running by a process that died before it recorded anything
+    job_id = await create_broadcast_job(
+        "1", "text", None, None, [(1, 1)], queued=False
+    )
+
+    events = [event async for event in progress_events(job_id)]
+
+    assert events[-1].startswith("event: stalled\ndata: {")
+    assert all(event.startswith("event: progress") for event in events[:-1])
+    assert '"status": "running"' in events[-1]
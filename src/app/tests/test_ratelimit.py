@@ -0,0 +1,96 @@
+import asyncio
+import sqlite3
+import time
+from unittest.mock import AsyncMock
+
+import pytest
+
+from app.ratelimit import RateLimiter, RateLimitResponseValidator
+from app.store import SharedStore
+
+
+@pytest.fixture()
+def limiter():
+    return RateLimiter(SharedStore(), "ratelimit:test", rate=50, min_rate=5)
+
+
+@pytest.mark.asyncio
+async def test_acquire_spaces_requests(limiter):
+    start = time.monotonic()
+    await asyncio.gather(*(limiter.acquire() for _ in range(11)))
+    assert time.monotonic() - start == pytest.approx(0.2, abs=0.05)
+
+
+@pytest.mark.asyncio
+async def test_acquire_shared_between_limiters(limiter):
+    other = RateLimiter(limiter.store, limiter.key, rate=50)
+    start = time.monotonic()
+    await asyncio.gather(
+        *(limiter.acquire() for _ in range(6)),
+        *(other.acquire() for _ in range(5)),
+    )
+    assert time.monotonic() - start == pytest.approx(0.2, abs=0.05)
+
+
+@pytest.mark.asyncio
+async def test_acquire_waits_off_the_loop(tmp_path):
+    shared_store = SharedStore(str(tmp_path / "store.db"))
+    limiter = RateLimiter(shared_store, "ratelimit:test", rate=50)
+    shared_store.get("key")
+    # Another worker holds the store's write lock for a while
+    other = sqlite3.connect(shared_store.path, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    task = asyncio.create_task(limiter.acquire())
+
+    started = time.monotonic()
+    await asyncio.sleep(0.1)
+    assert time.monotonic() - started < 0.2
+    assert not task.done()
+
+    other.execute("COMMIT")
+    other.close()
+    await task
+
+
+@pytest.mark.asyncio
+async def test_throttle_and_recover(limiter):
+    await limiter.throttle()
+    assert limiter.rate == 25
+    for _ in range(3):
+        await limiter.throttle()
+    assert limiter.rate == 5
+
+    for _ in range(10):
+        await limiter.recover()
+    assert limiter.rate == pytest.approx(7)
+
+    for _ in range(1000):
+        await limiter.recover()
+    assert limiter.rate == 50
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "response, throttled",
+    [
+        ({"response": 1}, False),
+        ({"error": {"error_code": 6}}, True),
+        ({"error": {"error_code": 7}}, False),
+        (
+            {"response": [1, False], "execute_errors": [{"error_code": 6}]},
+            True,
+        ),
+    ],
+)
+async def test_response_validator(mocker, limiter, response, throttled):
+    throttle_mock = mocker.patch.object(
+        limiter, "throttle", new_callable=AsyncMock
+    )
+    recover_mock = mocker.patch.object(
+        limiter, "recover", new_callable=AsyncMock
+    )
+    validator = RateLimitResponseValidator(limiter)
+
+    assert await validator.validate("method", {}, response, None) == response
+    assert throttle_mock.called == throttled
+    assert recover_mock.called != throttled
@@ -0,0 +1,46 @@
+import pytest
+
+from app.schema import parse_event
+
+MESSAGE = (
+    b'{"group_id": 1, "object": {"message": '
+    b'{"from_id": 1, "peer_id": 1, "text": "hi", "extra": 1}}}'
+)
+
+
+@pytest.mark.parametrize("fast", [True, False])
+def test_parse_event(mocker, fast):
+    mocker.patch("app.schema.settings.CALLBACK_FAST_INGRESS", fast)
+    event = parse_event(MESSAGE)
+    assert event["type"] == "message_new"
+    assert event["group_id"] == 1
+    assert event["object"]["message"]["text"] == "hi"
+    assert ("extra" in event["object"]["message"]) is fast
+
+
+@pytest.mark.parametrize("fast", [True, False])
+@pytest.mark.parametrize(
+    "body",
+    [
+        b"not json",
+        b"[]",
+        b'{"type": "message_new"}',
+        b'{"type": "message_new", "group_id": "one"}',
+    ],
+)
+def test_parse_event_invalid(mocker, fast, body):
+    mocker.patch("app.schema.settings.CALLBACK_FAST_INGRESS", fast)
+    with pytest.raises(ValueError):
+        parse_event(body)
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        b'{"type": 1, "group_id": 1}',
+        b'{"type": "message_new", "group_id": "1"}',
+    ],
+)
+def test_parse_event_fast_no_coercion(body):
+    with pytest.raises(ValueError):
+        parse_event(body)
@@ -0,0 +1,71 @@
+import os
+import socket
+
+import pytest
+from uvicorn.config import Config
+from uvicorn.server import ServerState
+
+from app import server
+from app.server import HTTPProtocol, prepare_workers, run
+
+
+@pytest.fixture()
+def connection():
+    # Sockets made like the one uvicorn shares between workers
+    listener = socket.socket(socket.AF_INET)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen()
+    client = socket.create_connection(listener.getsockname())
+    sock, _ = listener.accept()
+    yield sock
+    for item in (sock, client, listener):
+        item.close()
+
+
+def test_http_protocol_nodelay(mocker, connection):
+    config = Config(app=mocker.Mock())
+    config.load()
+    protocol = HTTPProtocol(
+        config=config, server_state=ServerState(), app_state={}
+    )
+    transport = mocker.Mock()
+    transport.get_extra_info.side_effect = lambda name: (
+        connection if name == "socket" else None
+    )
+    assert not connection.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+
+    protocol.connection_made(transport)
+
+    assert connection.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+
+
+def test_prepare_workers(monkeypatch, tmp_path):
+    monkeypatch.delenv("SHARED_STORE_PATH", raising=False)
+    monkeypatch.delenv("DEDUPE_SHARED", raising=False)
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    (tmp_path / "counter_1.db").write_bytes(b"")
+
+    prepare_workers()
+
+    assert os.environ["SHARED_STORE_PATH"].endswith("store.db")
+    assert os.environ["DEDUPE_SHARED"] == "true"
+    assert not list(tmp_path.iterdir())
+
+
+@pytest.mark.parametrize("workers, prepared", [(1, False), (4, True)])
+def test_run(mocker, workers, prepared):
+    prepare_mock = mocker.patch.object(server, "prepare_workers")
+    run_mock = mocker.patch.object(server.uvicorn, "run")
+
+    run("127.0.0.1", 8000, workers)
+
+    assert prepare_mock.called == prepared
+    run_mock.assert_called_once_with(
+        "main:create_app",
+        factory=True,
+        host="127.0.0.1",
+        port=8000,
+        workers=workers,
+        http=HTTPProtocol,
+        log_level="warning",
+    )
@@ -0,0 +1,58 @@
+import pytest
+
+from app.store import SharedStore
+
+
+@pytest.fixture()
+def shared_store(tmp_path):
+    return SharedStore(str(tmp_path / "store.db"))
+
+
+def test_set_get_delete(shared_store):
+    shared_store.set("key", {"value": 1})
+    assert shared_store.get("key") == {"value": 1}
+    shared_store.delete("key")
+    assert shared_store.get("key") is None
+
+
+def test_add(shared_store):
+    assert shared_store.add("key", 1)
+    assert not shared_store.add("key", 2)
+    assert shared_store.get("key") == 1
+
+
+def test_ttl(shared_store, mocker):
+    time_mock = mocker.patch("app.store.time.time", return_value=100)
+    shared_store.set("key", 1, ttl=10)
+    assert shared_store.get("key") == 1
+
+    time_mock.return_value = 110
+    assert shared_store.get("key") is None
+    assert shared_store.add("key", 2)
+
+
+def test_update(shared_store):
+    assert shared_store.update("counter", lambda value: (value or 0) + 1) == 1
+    assert shared_store.update("counter", lambda value: (value or 0) + 1) == 2
+
+
+def test_shared_between_instances(shared_store):
+    other = SharedStore(shared_store.path)
+    shared_store.set("key", "value")
+    assert other.get("key") == "value"
+
+
+def test_in_memory():
+    shared_store = SharedStore()
+    shared_store.set("key", "value")
+    assert shared_store.get("key") == "value"
+    assert SharedStore().get("key") is None
+
+
+def test_lock(shared_store):
+    with shared_store.lock("key", 10) as acquired:
+        assert acquired
+        with SharedStore(shared_store.path).lock("key", 10) as other:
+            assert not other
+        assert shared_store.get("key") is not None
+    assert shared_store.get("key") is None
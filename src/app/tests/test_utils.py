@@ -1,14 +1,7 @@
-from unittest.mock import AsyncMock
-
 import pytest
 
 import settings
-from app.utils import (
-    get_group_id,
-    group_is_added,
-    handle_course,
-    process_course,
-)
+from app.utils import get_group_id, handle_course, process_course
 
 
 @pytest.mark.asyncio
@@ -45,26 +38,24 @@ async def test_process_course(course, expected):
         ("hello", False),
     ],
 )
-async def test_handle_course_successful(mocker, course, expected):
+async def test_handle_course_successful(
+    mocker, course, expected, mock_registry
+):
     message = mocker.Mock()
     message.answer = mocker.AsyncMock()
     mocker.patch(
         "app.utils.process_course", return_value=process_course(course)
     )
-    mock_get_groups_ids = mocker.patch(
-        "app.utils.get_groups_ids",
-        return_value=[1, 2, 3, 4, 5],
-        new_callable=AsyncMock,
-    )
+    mock_get_group_registry = mock_registry(1, [1, 2, 3, 4, 5], "app.utils")
     assert await handle_course(message, course, check=True) == expected
     if not expected:
         message.answer.assert_called_once_with("Не верно введен курс!")
     else:
-        mock_get_groups_ids.assert_awaited_once()
+        mock_get_group_registry.assert_awaited_once()
 
 
 @pytest.mark.asyncio
-async def test_handle_course_no_groups(mocker):
+async def test_handle_course_no_groups(mocker, mock_registry):
     course = "1"
 
     message = mocker.Mock()
@@ -72,35 +63,10 @@ async def test_handle_course_no_groups(mocker):
     mocker.patch(
         "app.utils.process_course", return_value=process_course(course)
     )
-    mock_get_groups_ids = mocker.patch(
-        "app.utils.get_groups_ids", return_value=[], new_callable=AsyncMock
-    )
+    mock_get_group_registry = mock_registry(1, [], "app.utils")
     assert not await handle_course(message, course, check=True)
     message.answer.assert_called_once_with("Произошла непредвиденная ошибка!")
-    mock_get_groups_ids.assert_awaited_once()
-
-
-@pytest.mark.asyncio
-@pytest.mark.parametrize(
-    "group_id, groups_ids, expected",
-    [
-        (1, [1, 2, 3], True),
-        (2, [1, 2, 3], True),
-        (3, [1, 2, 3], True),
-        (4, [1, 2, 3], False),
-    ],
-)
-async def test_group_is_added(mocker, group_id, groups_ids, expected):
-    message = mocker.Mock()
-    message.peer_id = group_id + settings.GROUP_ID_COEFFICIENT
-    message.answer = mocker.AsyncMock()
-    mock_get_groups_ids = mocker.patch(
-        "app.utils.get_groups_ids",
-        return_value=groups_ids,
-        new_callable=AsyncMock,
-    )
-    assert await group_is_added(group_id) == expected
-    mock_get_groups_ids.assert_awaited_once()
+    mock_get_group_registry.assert_awaited_once()
 
 
 @pytest.mark.asyncio
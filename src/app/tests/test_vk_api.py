@@ -0,0 +1,487 @@
+import pytest
+
+import settings
+from app.broadcast import (
+    BroadcastState,
+    broadcast,
+    broadcast_state,
+    course_broadcast,
+    get_backoff,
+    group_broadcast,
+)
+from app.db import (
+    add_group,
+    get_broadcast_deliveries,
+    get_broadcast_jobs,
+    get_groups_ids,
+)
+from app.ratelimit import RateLimiter, vk_limiter
+from app.store import SharedStore
+from app.vk import bot
+
+
+def get_peer_id(group: int) -> int:
+    return settings.GROUP_ID_COEFFICIENT + group
+
+
+@pytest.mark.asyncio
+async def test_group_broadcast_timeout(mocker, fake_vk_api):
+    log_mock = mocker.patch("app.broadcast.logger.exception")
+    fake_vk_api.script(peer_id=get_peer_id(1), timeout=True, times=1)
+    state = BroadcastState()
+    token = broadcast_state.set(state)
+    try:
+        assert not await group_broadcast(1, "text", None)
+        assert await group_broadcast(1, "text", None)
+    finally:
+        broadcast_state.reset(token)
+
+    # The broadcast summary reports it instead
+    log_mock.assert_not_called()
+    assert state.error_codes == {1: None}
+    assert fake_vk_api.get_texts(get_peer_id(1)) == ["text"]
+
+
+@pytest.mark.asyncio
+async def test_group_broadcast_scripted_error(mocker, fake_vk_api):
+    mocker.patch("app.broadcast.logger.error")
+    fake_vk_api.script(method="messages.send", error=10, times=1)
+
+    assert not await group_broadcast(1, "text", None)
+    assert await group_broadcast(1, "text", None)
+    assert len(fake_vk_api.get_calls("messages.send")) == 2
+
+
+@pytest.mark.asyncio
+async def test_course_broadcast_server_rate_limit(
+    mocker, fake_vk_api, mock_registry
+):
+    mocker.patch("app.broadcast.logger.error")
+    mock_registry(1, range(1, 6))
+    fake_vk_api.rate_limit = 2
+
+    course, result = await course_broadcast(1, "text", None)
+
+    assert course == 1
+    assert sum(result) == 2
+    assert {call.token for call in fake_vk_api.calls} == {settings.VK_TOKEN}
+
+
+@pytest.mark.asyncio
+async def test_course_broadcast_within_rate_limit(
+    mocker, fake_vk_api, mock_registry
+):
+    mock_registry(1, range(1, 7))
+    limiter = RateLimiter(SharedStore(), "ratelimit:test", 8)
+    mocker.patch.object(vk_limiter, "acquire", limiter.acquire)
+    fake_vk_api.rate_limit = 10
+
+    course, result = await course_broadcast(1, "text", None)
+
+    assert result == (True,) * 6
+    times = [call.time for call in fake_vk_api.calls]
+    assert times[-1] - times[0] >= 5 / 8 * 0.9
+
+
+@pytest.mark.asyncio
+async def test_sharing_text(mocker, init_db, fake_vk_api):
+    admin_peer_id = get_peer_id(100)
+    for group in (1, 2, 3):
+        await add_group(group, 1)
+    fake_vk_api.kicked.add(get_peer_id(2))
+    mocker.patch("app.bot.broadcast.settings.ADMINS", [1])
+    mocker.patch("app.broadcast.logger.warning")
+
+    await bot.process_event(
+        {
+            "type": "message_new",
+            "group_id": 1,
+            "object": {
+                "message": {
+                    "from_id": 1,
+                    "peer_id": admin_peer_id,
+                    "text": "Рассылка: 1 Пара перенесена",
+                    "date": 0,
+                    "id": 0,
+                    "out": 0,
+                },
+                "client_info": {},
+            },
+        }
+    )
+
+    assert fake_vk_api.get_texts(get_peer_id(1)) == ["Пара перенесена"]
+    assert fake_vk_api.get_texts(get_peer_id(2)) == []
+    assert fake_vk_api.get_texts(admin_peer_id) == [
+        "Рассылка отправлена не полностью.\n\nКурс 1: + - +"
+    ]
+    assert await get_groups_ids() == [1, 3]
+
+
+@pytest.mark.asyncio
+async def test_edit_and_conversations(fake_vk_api):
+    fake_vk_api.kicked.add(get_peer_id(2))
+    response = await bot.api.request(
+        "messages.send", {"peer_id": get_peer_id(1), "message": "draft"}
+    )
+
+    await bot.api.request(
+        "messages.edit",
+        {
+            "peer_id": get_peer_id(1),
+            "conversation_message_id": response["response"],
+            "message": "final",
+        },
+    )
+    conversations = await bot.api.request(
+        "messages.getConversationsById",
+        {"peer_ids": f"{get_peer_id(1)},{get_peer_id(2)}"},
+    )
+
+    assert fake_vk_api.get_texts(get_peer_id(1)) == ["final"]
+    assert [
+        item["can_write"]["allowed"]
+        for item in conversations["response"]["items"]
+    ] == [True, False]
+    assert [call.method for call in fake_vk_api.calls] == [
+        "messages.send",
+        "messages.edit",
+        "messages.getConversationsById",
+    ]
+
+
+@pytest.fixture()
+def fast_retries(mocker):
+    mocker.patch("app.broadcast.get_backoff", return_value=0.01)
+    mocker.patch("app.broadcast.logger.error")
+    mocker.patch("app.broadcast.logger.exception")
+    mocker.patch("app.broadcast.logger.warning")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mode", ["single", "execute", "peer_ids"])
+async def test_broadcast_retries_transient_errors(
+    mocker, init_db, fake_vk_api, fast_retries, mode
+):
+    for group in range(1, 5):
+        await add_group(group, 1)
+    mocker.patch("app.broadcast.settings.BROADCAST_MODE", mode)
+    fake_vk_api.script(peer_id=get_peer_id(2), error=10, times=1)
+    fake_vk_api.script(peer_id=get_peer_id(3), error=9, times=1)
+
+    ((_, result),) = await broadcast("1", "text")
+
+    assert result == (True, True, True, True)
+    for group in range(1, 5):
+        assert fake_vk_api.get_texts(get_peer_id(group)) == ["text"]
+    (job,) = await get_broadcast_jobs(1)
+    deliveries = await get_broadcast_deliveries(job.id)
+    assert {delivery.status for delivery in deliveries} == {"sent"}
+
+
+@pytest.mark.asyncio
+async def test_broadcast_retry_does_not_block(
+    mocker, init_db, fake_vk_api, fast_retries
+):
+    for group in range(1, 6):
+        await add_group(group, 1)
+    mocker.patch("app.broadcast.settings.BROADCAST_CONCURRENCY", 1)
+    mocker.patch("app.broadcast.get_backoff", return_value=0.1)
+    fake_vk_api.script(peer_id=get_peer_id(1), error=6, times=1)
+
+    ((_, result),) = await broadcast("1", "text")
+
+    assert all(result)
+    peers = [
+        int(call.params["peer_id"])
+        for call in fake_vk_api.get_calls("messages.send")
+    ]
+    assert peers == [get_peer_id(group) for group in (1, 2, 3, 4, 5, 1)]
+
+
+@pytest.mark.asyncio
+async def test_broadcast_retry_after_lost_answer(
+    mocker, init_db, fake_vk_api, fast_retries
+):
+    for group in range(1, 3):
+        await add_group(group, 1)
+    # VK took the send but its answer never came back
+    fake_vk_api.script(peer_id=get_peer_id(1), lost=True, times=1)
+
+    ((_, result),) = await broadcast("1", "text")
+
+    assert result == (True, True)
+    random_ids = [
+        (int(call.params["peer_id"]), call.params["random_id"])
+        for call in fake_vk_api.get_calls("messages.send")
+    ]
+    # The retry repeats the random_id, so VK does not deliver it again
+    assert len(random_ids) == 3
+    assert len(set(random_ids)) == 2
+    assert fake_vk_api.get_texts(get_peer_id(1)) == ["text"]
+
+
+def get_send_counts(fake_vk_api, groups):
+    peers = [
+        int(call.params["peer_id"])
+        for call in fake_vk_api.get_calls("messages.send")
+    ]
+    return [peers.count(get_peer_id(group)) for group in groups]
+
+
+@pytest.mark.asyncio
+async def test_broadcast_retry_attempts(
+    mocker, init_db, fake_vk_api, fast_retries
+):
+    for group in range(1, 4):
+        await add_group(group, 1)
+    mocker.patch("app.broadcast.settings.BROADCAST_RETRY_ATTEMPTS", 2)
+    fake_vk_api.script(peer_id=get_peer_id(1), error=10)
+    # Error 7 is never retried
+    fake_vk_api.kicked.add(get_peer_id(2))
+
+    ((_, result),) = await broadcast("1", "text")
+
+    assert result == (False, False, True)
+    assert get_send_counts(fake_vk_api, range(1, 4)) == [3, 1, 1]
+    (job,) = await get_broadcast_jobs(1)
+    codes = {
+        delivery.group_id: delivery.error_code
+        for delivery in await get_broadcast_deliveries(job.id)
+    }
+    assert codes == {1: 10, 2: 7, 3: None}
+
+
+@pytest.mark.asyncio
+async def test_broadcast_retry_budget(
+    mocker, init_db, fake_vk_api, fast_retries
+):
+    for group in range(1, 4):
+        await add_group(group, 1)
+    mocker.patch("app.broadcast.settings.BROADCAST_CONCURRENCY", 1)
+    mocker.patch("app.broadcast.settings.BROADCAST_RETRY_BUDGET", 1)
+    fake_vk_api.script(peer_id=get_peer_id(1), error=9, times=1)
+    fake_vk_api.script(peer_id=get_peer_id(2), error=9, times=1)
+
+    ((_, result),) = await broadcast("1", "text")
+
+    assert result == (True, False, True)
+    assert get_send_counts(fake_vk_api, range(1, 4)) == [2, 1, 1]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mode", ["single", "execute", "peer_ids"])
+async def test_broadcast_failure_summary(mocker, init_db, fake_vk_api, mode):
+    for group in range(1, 5):
+        await add_group(group, 1)
+    mocker.patch("app.broadcast.settings.BROADCAST_MODE", mode)
+    mocker.patch("app.broadcast.get_backoff", return_value=0.01)
+    error_mock = mocker.patch("app.broadcast.logger.error")
+    warning_mock = mocker.patch("app.broadcast.logger.warning")
+    fake_vk_api.kicked.add(get_peer_id(2))
+    fake_vk_api.script(peer_id=get_peer_id(3), error=917)
+    # Sent on the retry, so not a failure
+    fake_vk_api.script(peer_id=get_peer_id(4), error=10, times=1)
+
+    ((_, result),) = await broadcast("1", "text")
+
+    assert result == (True, False, False, True)
+    error_mock.assert_not_called()
+    warning_mock.assert_called_once()
+    args, kwargs = warning_mock.call_args
+    assert args[2:4] == (2, 4)
+    assert kwargs["extra"]["errors"] == {"7": 1, "917": 1}
+    assert kwargs["extra"]["failed_groups"] == [2, 3]
+
+
+def test_get_backoff(mocker):
+    mocker.patch("app.broadcast.settings.BROADCAST_RETRY_BACKOFF", 1)
+    mocker.patch("app.broadcast.settings.BROADCAST_RETRY_BACKOFF_MAX", 5)
+    uniform = mocker.patch("app.broadcast.random.uniform", return_value=0.5)
+
+    assert get_backoff(1) == 0.5
+    get_backoff(10)
+
+    assert uniform.call_args_list == [mocker.call(0, 2), mocker.call(0, 5)]
+
+
+def get_media_event(photo_url: str, doc_url: str) -> dict:
+    return {
+        "type": "message_new",
+        "group_id": 1,
+        "object": {
+            "message": {
+                "from_id": 1,
+                "peer_id": get_peer_id(100),
+                "text": "Рассылка: 1 Расписание",
+                "date": 0,
+                "id": 0,
+                "out": 0,
+                "attachments": [
+                    {
+                        "type": "photo",
+                        "photo": {
+                            "id": 1,
+                            "owner_id": 1,
+                            "album_id": 0,
+                            "date": 0,
+                            "sizes": [
+                                {
+                                    "type": "s",
+                                    "url": "http://127.0.0.1:1/small.jpg",
+                                    "width": 75,
+                                    "height": 50,
+                                },
+                                {
+                                    "type": "w",
+                                    "url": photo_url,
+                                    "width": 1280,
+                                    "height": 960,
+                                },
+                            ],
+                        },
+                    },
+                    {
+                        "type": "doc",
+                        "doc": {
+                            "id": 2,
+                            "owner_id": 1,
+                            "title": "schedule.pdf",
+                            "size": 3,
+                            "ext": "pdf",
+                            "date": 0,
+                            "type": 1,
+                            "url": doc_url,
+                        },
+                    },
+                ],
+            },
+            "client_info": {},
+        },
+    }
+
+
+@pytest.mark.asyncio
+async def test_sharing_media(mocker, init_db, fake_vk_api):
+    for group in (1, 2, 3):
+        await add_group(group, 1)
+    mocker.patch("app.bot.broadcast.settings.ADMINS", [1])
+    mocker.patch("app.media.store", SharedStore())
+    event = get_media_event(
+        fake_vk_api.add_file("photo.jpg", b"photo"),
+        fake_vk_api.add_file("schedule.pdf", b"pdf"),
+    )
+
+    await bot.process_event(event)
+
+    assert len(fake_vk_api.uploads) == 2
+    assert len(fake_vk_api.get_calls("photos.saveMessagesPhoto")) == 1
+    assert len(fake_vk_api.get_calls("docs.save")) == 1
+    sends = [
+        call.params
+        for call in fake_vk_api.get_calls("messages.send")
+        if "peer_id" in call.params
+    ]
+    assert [params["peer_id"] for params in sends] == [
+        str(get_peer_id(group)) for group in (1, 2, 3)
+    ]
+    assert {params["attachment"] for params in sends} == {
+        "photo-1_1_key,doc-1_2"
+    }
+
+    # The same files again are taken from the cache
+    await bot.process_event(event)
+    assert len(fake_vk_api.uploads) == 2
+    assert fake_vk_api.get_texts(get_peer_id(1)) == ["Расписание"] * 2
+
+
+@pytest.mark.asyncio
+async def test_sharing_media_failed_download(mocker, init_db, fake_vk_api):
+    await add_group(1, 1)
+    mocker.patch("app.bot.broadcast.settings.ADMINS", [1])
+    mocker.patch("app.media.store", SharedStore())
+    log_mock = mocker.patch("app.media.logger.error")
+    event = get_media_event(
+        fake_vk_api.add_file("photo.jpg", b"photo"),
+        f"{fake_vk_api.url}/files/missing.pdf",
+    )
+
+    await bot.process_event(event)
+
+    log_mock.assert_called_once()
+    # Not sent without the document, the admin is told instead
+    assert fake_vk_api.get_texts(get_peer_id(1)) == []
+    assert fake_vk_api.get_texts(get_peer_id(100)) == [
+        "Не удалось загрузить вложения: 1. Рассылка не отправлена"
+    ]
+
+
+@pytest.mark.asyncio
+async def test_sharing_media_duplicates(mocker, init_db, fake_vk_api):
+    await add_group(1, 1)
+    mocker.patch("app.bot.broadcast.settings.ADMINS", [1])
+    mocker.patch("app.media.store", SharedStore())
+    event = get_media_event(
+        fake_vk_api.add_file("photo.jpg", b"photo"),
+        fake_vk_api.add_file("schedule.pdf", b"pdf"),
+    )
+    attachments = event["object"]["message"]["attachments"]
+    # The same photo twice, and the document again under another name
+    copy = {**attachments[1]["doc"], "url": fake_vk_api.add_file("b", b"pdf")}
+    attachments.extend([attachments[0], {"type": "doc", "doc": copy}])
+
+    await bot.process_event(event)
+
+    assert len(fake_vk_api.uploads) == 2
+    (send,) = [
+        call.params
+        for call in fake_vk_api.get_calls("messages.send")
+        if call.params.get("peer_id") == str(get_peer_id(1))
+    ]
+    assert send["attachment"] == "photo-1_1_key,doc-1_2"
+
+
+@pytest.mark.asyncio
+async def test_sharing_media_too_many(mocker, init_db, fake_vk_api):
+    await add_group(1, 1)
+    mocker.patch("app.bot.broadcast.settings.ADMINS", [1])
+    mocker.patch("app.media.store", SharedStore())
+    event = get_media_event(
+        fake_vk_api.add_file("photo.jpg", b"photo"),
+        fake_vk_api.add_file("schedule.pdf", b"pdf"),
+    )
+    attachments = event["object"]["message"]["attachments"]
+    for index in range(9):
+        url = fake_vk_api.add_file(f"{index}.pdf", str(index).encode())
+        attachments.append(
+            {"type": "doc", "doc": {**attachments[1]["doc"], "url": url}}
+        )
+
+    await bot.process_event(event)
+
+    assert fake_vk_api.get_texts(get_peer_id(1)) == []
+    assert fake_vk_api.get_texts(get_peer_id(100)) == [
+        "Слишком много вложений: 11, можно не больше 10"
+    ]
+
+
+@pytest.mark.asyncio
+async def test_sharing_media_slow_upload(mocker, init_db, fake_vk_api):
+    await add_group(1, 1)
+    mocker.patch("app.bot.broadcast.settings.ADMINS", [1])
+    mocker.patch("app.media.store", SharedStore())
+    # Longer than a whole bot.api request may take, 0.5 s in the fixture
+    fake_vk_api.script(method="upload", latency=0.7)
+    event = get_media_event(
+        fake_vk_api.add_file("photo.jpg", b"photo"),
+        fake_vk_api.add_file("schedule.pdf", b"pdf"),
+    )
+
+    await bot.process_event(event)
+
+    (send,) = [
+        call.params
+        for call in fake_vk_api.get_calls("messages.send")
+        if call.params.get("peer_id") == str(get_peer_id(1))
+    ]
+    assert send["attachment"] == "photo-1_1_key,doc-1_2"
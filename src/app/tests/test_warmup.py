@@ -0,0 +1,31 @@
+import asyncio
+
+import pytest
+
+from app.cache import group_registry
+from app.warmup import warm_up
+
+
+@pytest.mark.asyncio
+async def test_warm_up(fake_vk_api, groups):
+    group_registry.clear()
+
+    await warm_up()
+
+    assert len(group_registry) == 3
+    assert len(fake_vk_api.get_calls("groups.getById")) == 1
+
+
+@pytest.mark.asyncio
+async def test_warm_up_failed(mocker, fake_vk_api):
+    async def stalled_registry():
+        await asyncio.sleep(1)
+
+    log_mock = mocker.patch("app.warmup.logger.warning")
+    mocker.patch("app.warmup.settings.WARMUP_TIMEOUT", 0.1)
+    mocker.patch("app.warmup.get_group_registry", stalled_registry)
+    fake_vk_api.script(method="groups.getById", error=5)
+
+    await warm_up()
+
+    assert [call.args[1] for call in log_mock.call_args_list] == ["db", "vk"]
@@ -0,0 +1,104 @@
+import asyncio
+from unittest.mock import AsyncMock
+
+import pytest
+
+from app.db import claim_deliveries, create_broadcast_job, get_broadcast_job
+from app.vk import bot
+from app.worker import process_deliveries
+
+
+@pytest.mark.asyncio
+async def test_process_deliveries(mocker, init_db):
+    job_id = await create_broadcast_job(
+        "123", "text", ["wall1_1"], 42, [(1, 1), (2, 1), (3, 2)]
+    )
+    batch_broadcast_mock = mocker.patch(
+        "app.broadcast.batch_broadcast",
+        new_callable=AsyncMock,
+        side_effect=lambda ids, *args: [group != 2 for group in ids],
+    )
+    mocker.patch.object(bot, "api", autospec=True)
+    bot.api.messages.send = AsyncMock()
+
+    assert await process_deliveries()
+    assert not await process_deliveries()
+
+    batch_broadcast_mock.assert_has_awaits(
+        [mocker.call([group], "text", ["wall1_1"]) for group in (1, 2, 3)]
+    )
+    bot.api.messages.send.assert_awaited_once_with(
+        peer_id=42,
+        message=(
+            "Рассылка отправлена не полностью.\n\n"
+            "Курс 1: + -\n"
+            "Курс 2: +\n"
+            "Курс 3: -"
+        ),
+        random_id=0,
+    )
+    assert (await get_broadcast_job(job_id)).status == "done"
+
+
+@pytest.mark.asyncio
+async def test_process_deliveries_resumes_crashed_job(mocker, init_db):
+    mocker.patch("app.worker.settings.QUEUE_CLAIM_SIZE", 2)
+    await create_broadcast_job(
+        "1", "text", None, None, [(1, 1), (2, 1), (3, 1)]
+    )
+    # A worker that crashed after claiming the first group
+    await claim_deliveries(1, -1)
+
+    mocker.patch("app.broadcast.settings.BROADCAST_MODE", "execute")
+    batch_broadcast_mock = mocker.patch(
+        "app.broadcast.batch_broadcast",
+        new_callable=AsyncMock,
+        side_effect=lambda ids, *args: [True] * len(ids),
+    )
+
+    assert await process_deliveries()
+    assert await process_deliveries()
+    assert not await process_deliveries()
+
+    batch_broadcast_mock.assert_has_awaits(
+        [
+            mocker.call([1, 2], "text", None),
+            mocker.call([3], "text", None),
+        ]
+    )
+
+
+@pytest.mark.asyncio
+async def test_process_deliveries_report_failed(mocker, init_db, fake_vk_api):
+    log_mock = mocker.patch("app.worker.logger.error")
+    mocker.patch(
+        "app.broadcast.batch_broadcast",
+        new_callable=AsyncMock,
+        side_effect=lambda ids, *args: [True] * len(ids),
+    )
+    job_id = await create_broadcast_job("1", "text", None, 42, [(1, 1)])
+    fake_vk_api.script(method="messages.send", error=901)
+
+    assert await process_deliveries()
+
+    log_mock.assert_called_once()
+    assert (await get_broadcast_job(job_id)).status == "done"
+
+
+@pytest.mark.asyncio
+async def test_process_deliveries_renews_lease(mocker, init_db):
+    mocker.patch("app.worker.settings.QUEUE_LEASE", 0.3)
+    await create_broadcast_job("1", "text", None, None, [(1, 1), (2, 1)])
+    claimed = []
+
+    async def slow_broadcast(ids, *args):
+        # Runs past the lease while another worker polls for work
+        for _ in range(4):
+            await asyncio.sleep(0.15)
+            claimed.extend(await claim_deliveries(10, 0.3))
+        return [True] * len(ids)
+
+    mocker.patch("app.broadcast.batch_broadcast", side_effect=slow_broadcast)
+
+    assert await process_deliveries()
+    assert claimed == []
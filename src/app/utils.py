@@ -1,7 +1,7 @@
 from vkbottle.user import Message
 
 import settings
-from app.db import get_groups_ids
+from app.db import get_group_registry
 
 
 def process_course(course: str | int) -> int:
@@ -24,9 +24,9 @@ async def handle_course(
         return False
 
     if check:
-        groups_ids = await get_groups_ids()
+        registry = await get_group_registry()
 
-        if not groups_ids:
+        if not registry:
             await message.answer("Произошла непредвиденная ошибка!")
             return False
 
@@ -35,7 +35,3 @@ async def handle_course(
 
 def get_group_id(message: Message) -> int:
     return int(message.peer_id) - settings.GROUP_ID_COEFFICIENT
-
-
-async def group_is_added(group_id: int) -> bool:
-    return group_id in await get_groups_ids()
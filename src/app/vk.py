@@ -1,7 +1,22 @@
-from vkbottle import Bot
+from aiohttp import ClientTimeout
+from vkbottle import API, Bot
+from vkbottle.http import AiohttpClient
 
 import settings
+from app.metrics import instrument_api
+from app.ratelimit import limit_api, vk_limiter
 
-bot = Bot(settings.VK_TOKEN)
+api = API(
+    settings.VK_TOKEN,
+    http_client=AiohttpClient(
+        timeout=ClientTimeout(total=settings.VK_API_TIMEOUT)
+    ),
+)
+if settings.VK_API_URL:
+    api.API_URL = settings.VK_API_URL
+limit_api(api, vk_limiter)
+instrument_api(api)
+
+bot = Bot(api=api)
 
 bot.labeler.vbml_ignore_case = True
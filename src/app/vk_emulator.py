@@ -0,0 +1,414 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import time
+from collections import deque
+from typing import Any, NamedTuple
+
+from aiohttp import web
+
+ERROR_MESSAGES = {
+    3: "Unknown method passed",
+    6: "Too many requests per second",
+    7: "Permission to perform this action is denied",
+    9: "Flood control",
+    10: "Internal server error",
+    100: "One of the parameters specified was missing or invalid",
+}
+SEND_CALL = "API.messages.send("
+
+
+class Call(NamedTuple):
+    method: str
+    params: dict
+    token: str
+    time: float
+
+
+class Rule:
+    # Scripted behaviour for calls matching method and peer_id:
+    # an error code, extra latency, no answer at all, or no answer
+    # after the call went through (lost).
+    # A rule applies `times` times, or forever when it is None
+
+    def __init__(
+        self,
+        method: str | None = None,
+        peer_id: int | None = None,
+        error: int | None = None,
+        latency: float = 0.0,
+        timeout: bool = False,
+        lost: bool = False,
+        times: int | None = None,
+    ) -> None:
+        self.method = method
+        self.peer_id = peer_id
+        self.error = error
+        self.latency = latency
+        self.timeout = timeout
+        self.lost = lost
+        self.times = times
+
+    def matches(self, method: str, peer_id: int | None) -> bool:
+        if self.times == 0:
+            return False
+        if self.method is not None and self.method != method:
+            return False
+        return self.peer_id is None or self.peer_id == peer_id
+
+    def use(self) -> None:
+        if self.times is not None:
+            self.times -= 1
+
+
+class FakeVKAPI:
+    # Local VK API emulator. It answers messages.send (single peer and
+    # peer_ids), execute, messages.edit, messages.getConversationsById,
+    # groups.getById and the photo and document upload flow for messages,
+    # serves files to download and Bots Long Poll events, records every
+    # request, enforces a per-token rate limit with error 6 and fails calls
+    # by scripted rules or by a seeded random error mix
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        errors: dict[int, float] | None = None,
+        rate_limit: float = 0,
+        seed: int = 0,
+    ) -> None:
+        self.latency = latency
+        self.errors = errors or {}
+        self.rate_limit = rate_limit
+        self.random = random.Random(seed)  # nosec
+        self.rules: list[Rule] = []
+        self.calls: list[Call] = []
+        # Peers that removed the bot, sends to them fail with error 7
+        self.kicked: set[int] = set()
+        self.messages: dict[tuple[int, int], str] = {}
+        # Like VK, a send repeating a peer's random_id is not delivered
+        self.random_ids: dict[tuple[int, int], int] = {}
+        # Files to download by name, and the hashes of uploaded ones
+        self.files: dict[str, bytes] = {}
+        self.uploads: list[str] = []
+        self.url = ""
+        # Bots Long Poll: ts is the index of the next event, the ones
+        # before history_start are no longer kept
+        self.events: list[dict] = []
+        self.history_start = 0
+        self.longpoll_key = "key"
+        self._requests: dict[str, deque[float]] = {}
+        self._message_id = 0
+        self._item_id = 0
+        self._runner: web.AppRunner | None = None
+        self.app = web.Application()
+        self.app.router.add_post("/method/{method}", self.handle)
+        self.app.router.add_post("/upload/{kind}", self.handle_upload)
+        self.app.router.add_get("/files/{name}", self.handle_file)
+        self.app.router.add_get("/longpoll", self.handle_longpoll)
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port, shutdown_timeout=0.1)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f"http://{host}:{port}"
+        return f"{self.url}/method/"
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def reset(self) -> None:
+        self.calls.clear()
+        self.rules.clear()
+        self.kicked.clear()
+        self.messages.clear()
+        self.random_ids.clear()
+        self.files.clear()
+        self.uploads.clear()
+        self.events.clear()
+        self.history_start = 0
+        self._requests.clear()
+
+    def script(self, **kwargs: Any) -> Rule:
+        rule = Rule(**kwargs)
+        self.rules.append(rule)
+        return rule
+
+    def add_file(self, name: str, content: bytes) -> str:
+        self.files[name] = content
+        return f"{self.url}/files/{name}"
+
+    def push_event(self, event: dict) -> None:
+        self.events.append(event)
+
+    def get_calls(self, method: str) -> list[Call]:
+        return [call for call in self.calls if call.method == method]
+
+    def get_texts(self, peer_id: int) -> list[str]:
+        return [
+            text
+            for (peer, _), text in sorted(self.messages.items())
+            if peer == peer_id
+        ]
+
+    def _limited(self, token: str) -> bool:
+        if not self.rate_limit:
+            return False
+        now = time.monotonic()
+        requests = self._requests.setdefault(token, deque())
+        while requests and requests[0] <= now - 1:
+            requests.popleft()
+        if len(requests) >= self.rate_limit:
+            return True
+        requests.append(now)
+        return False
+
+    def _match(
+        self, method: str, peer_id: int | None, errors_only: bool = False
+    ) -> Rule | None:
+        for rule in self.rules:
+            if errors_only and rule.error is None:
+                continue
+            if rule.matches(method, peer_id):
+                rule.use()
+                return rule
+        return None
+
+    def _draw_error(self, peer_id: int) -> int | None:
+        rule = self._match("messages.send", peer_id, errors_only=True)
+        if rule is not None:
+            return rule.error
+        if peer_id in self.kicked:
+            return 7
+        roll = self.random.random()
+        for code, share in self.errors.items():
+            if roll < share:
+                return code
+            roll -= share
+        return None
+
+    @staticmethod
+    def error(code: int) -> dict:
+        return {
+            "error_code": code,
+            "error_msg": ERROR_MESSAGES.get(code, "Unknown error"),
+            "request_params": [],
+        }
+
+    def _deliver(self, peer_id: int, text: str, random_id: int) -> int:
+        if (peer_id, random_id) in self.random_ids:
+            return self.random_ids[(peer_id, random_id)]
+        self._message_id += 1
+        self.messages[(peer_id, self._message_id)] = text
+        if random_id:
+            self.random_ids[(peer_id, random_id)] = self._message_id
+        return self._message_id
+
+    def send(self, params: dict) -> dict:
+        text = params.get("message", "")
+        random_id = int(params.get("random_id") or 0)
+        if "peer_ids" not in params:
+            peer_id = int(params["peer_id"])
+            code = self._draw_error(peer_id)
+            if code is not None:
+                return {"error": self.error(code)}
+            return {"response": self._deliver(peer_id, text, random_id)}
+        statuses: list[dict] = []
+        for peer_id in map(int, str(params["peer_ids"]).split(",")):
+            code = self._draw_error(peer_id)
+            if code is not None:
+                statuses.append({"peer_id": peer_id, "error": {"code": code}})
+                continue
+            statuses.append(
+                {
+                    "peer_id": peer_id,
+                    "message_id": 0,
+                    "conversation_message_id": self._deliver(
+                        peer_id, text, random_id
+                    ),
+                }
+            )
+        return {"response": statuses}
+
+    def execute(self, params: dict) -> dict:
+        # The code is expected in the form get_execute_code builds
+        code = params["code"]
+        decoder = json.JSONDecoder()
+        sent: list[int | bool] = []
+        errors = []
+        index = code.find(SEND_CALL)
+        while index != -1:
+            call, end = decoder.raw_decode(code, index + len(SEND_CALL))
+            result = self.send(call)
+            if "error" in result:
+                sent.append(False)
+                errors.append({"method": "messages.send", **result["error"]})
+            else:
+                sent.append(result["response"])
+            index = code.find(SEND_CALL, end)
+        response: dict = {"response": {"sent": sent}}
+        if errors:
+            response["execute_errors"] = errors
+        return response
+
+    def edit(self, params: dict) -> dict:
+        peer_id = int(params["peer_id"])
+        message_id = int(
+            params.get("conversation_message_id")
+            or params.get("message_id")
+            or 0
+        )
+        if (peer_id, message_id) not in self.messages:
+            return {"error": self.error(100)}
+        self.messages[(peer_id, message_id)] = params.get("message", "")
+        return {"response": 1}
+
+    def get_conversations(self, params: dict) -> dict:
+        items = [
+            {
+                "peer": {"id": peer_id, "type": "chat", "local_id": peer_id},
+                "can_write": {"allowed": peer_id not in self.kicked},
+            }
+            for peer_id in map(int, str(params["peer_ids"]).split(","))
+        ]
+        return {"response": {"count": len(items), "items": items}}
+
+    def get_upload_server(self, kind: str) -> dict:
+        return {"response": {"upload_url": f"{self.url}/upload/{kind}"}}
+
+    def save_photo(self, params: dict) -> dict:
+        self._item_id += 1
+        photo = {"id": self._item_id, "owner_id": -1, "access_key": "key"}
+        return {"response": [photo]}
+
+    def save_doc(self, params: dict) -> dict:
+        self._item_id += 1
+        doc = {"id": self._item_id, "owner_id": -1, "title": params["title"]}
+        return {"response": {"type": "doc", "doc": doc}}
+
+    def get_groups(self, params: dict) -> dict:
+        groups = [{"id": int(params["group_id"] or 1), "name": "Group"}]
+        return {"response": {"groups": groups, "profiles": []}}
+
+    def get_longpoll_server(self, params: dict) -> dict:
+        return {
+            "response": {
+                "key": self.longpoll_key,
+                "server": f"{self.url}/longpoll",
+                "ts": str(len(self.events)),
+            }
+        }
+
+    async def handle_longpoll(self, request: web.Request) -> web.Response:
+        if request.query.get("key") != self.longpoll_key:
+            return web.json_response({"failed": 2})
+        ts = int(request.query["ts"])
+        if ts < self.history_start:
+            return web.json_response(
+                {"failed": 1, "ts": str(len(self.events))}
+            )
+        deadline = time.monotonic() + float(request.query.get("wait", 0))
+        while len(self.events) <= ts and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        return web.json_response(
+            {"ts": str(len(self.events)), "updates": self.events[ts:]}
+        )
+
+    async def handle_upload(self, request: web.Request) -> web.Response:
+        kind = request.match_info["kind"]
+        form = await request.post()
+        rule = self._match("upload", None)
+        if rule is not None and rule.latency:
+            await asyncio.sleep(rule.latency)
+        field = form["photo" if kind == "photo" else "file"]
+        content = field.file.read()  # type: ignore[union-attr]
+        digest = hashlib.sha256(content).hexdigest()
+        self.uploads.append(digest)
+        if kind == "photo":
+            return web.json_response(
+                {"server": 1, "photo": digest, "hash": digest}
+            )
+        return web.json_response({"file": digest})
+
+    async def handle_file(self, request: web.Request) -> web.Response:
+        name = request.match_info["name"]
+        if name not in self.files:
+            raise web.HTTPNotFound()
+        return web.Response(body=self.files[name])
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        token = request.query.get("access_token", "")
+        self.calls.append(Call(method, params, token, time.monotonic()))
+
+        peer_id = params.get("peer_id")
+        rule = self._match(method, int(str(peer_id)) if peer_id else None)
+        if rule is not None and rule.timeout:
+            # Never answer, the client has to give up on its own
+            await asyncio.sleep(3600)
+        latency = self.latency + (rule.latency if rule else 0)
+        if latency:
+            await asyncio.sleep(latency)
+        if self._limited(token):
+            return web.json_response({"error": self.error(6)})
+        if rule is not None and rule.error is not None:
+            return web.json_response({"error": self.error(rule.error)})
+
+        handlers = {
+            "messages.send": self.send,
+            "execute": self.execute,
+            "messages.edit": self.edit,
+            "messages.getConversationsById": self.get_conversations,
+            "photos.getMessagesUploadServer": lambda _: (
+                self.get_upload_server("photo")
+            ),
+            "photos.saveMessagesPhoto": self.save_photo,
+            "docs.getMessagesUploadServer": lambda _: (
+                self.get_upload_server("doc")
+            ),
+            "docs.save": self.save_doc,
+            "groups.getById": self.get_groups,
+            "groups.getLongPollServer": self.get_longpoll_server,
+        }
+        if method not in handlers:
+            return web.json_response({"error": self.error(3)})
+        response = handlers[method](params)
+        if rule is not None and rule.lost:
+            await asyncio.sleep(3600)
+        return web.json_response(response)
+
+
+def parse_errors(value: str) -> dict[int, float]:
+    # "7:0.01,10:0.005" -> {7: 0.01, 10: 0.005}
+    errors = {}
+    for item in filter(None, value.split(",")):
+        code, share = item.split(":")
+        errors[int(code)] = float(share)
+    return errors
+
+
+async def serve(args: argparse.Namespace) -> None:
+    server = FakeVKAPI(
+        latency=args.latency / 1000,
+        errors=parse_errors(args.errors),
+        rate_limit=args.rate_limit,
+    )
+    url = await server.start(args.host, args.port)
+    print(f"Fake VK API at {url}, point VK_API_URL to it")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local VK API emulator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0, help="ms")
+    parser.add_argument("--errors", default="", help="code:share,...")
+    parser.add_argument("--rate-limit", type=float, default=20)
+    asyncio.run(serve(parser.parse_args()))
@@ -0,0 +1,34 @@
+import asyncio
+import logging
+from typing import Awaitable
+
+import settings
+from app.db import get_group_registry
+from app.vk import bot
+
+logger = logging.getLogger(__name__)
+
+
+async def warm_up_vk() -> None:
+    # Opens the keep-alive connection of the bot's HTTP client
+    await bot.api.request("groups.getById", {"group_id": settings.GROUP_ID})
+
+
+async def warm_up() -> None:
+    # Pays before the first request for what it would otherwise pay:
+    # the DB pool and the group cache, the store and the VK connection.
+    # A failed step is logged and the worker starts anyway
+    steps: dict[str, Awaitable] = {
+        "db": get_group_registry(),
+        "vk": warm_up_vk(),
+    }
+    results = await asyncio.gather(
+        *(
+            asyncio.wait_for(step, settings.WARMUP_TIMEOUT)
+            for step in steps.values()
+        ),
+        return_exceptions=True,
+    )
+    for name, result in zip(steps, results):
+        if isinstance(result, Exception):
+            logger.warning("Warm-up of %s failed: %r", name, result)
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+from itertools import groupby
+from operator import itemgetter
+
+import aiohttp
+from vkbottle import VKAPIError
+
+import settings
+from app.bot.broadcast import get_report
+from app.broadcast import (
+    BroadcastState,
+    broadcast_state,
+    flush_deliveries,
+    groups_broadcast,
+    log_failures,
+    prune_groups,
+)
+from app.db import (
+    claim_deliveries,
+    finish_broadcast_job,
+    get_broadcast_job,
+    get_broadcast_results,
+    renew_deliveries,
+)
+from app.exceptions import DBError
+from app.logs import setup_logging
+from app.metrics import BROADCASTS_IN_FLIGHT
+from app.vk import bot
+
+logger = logging.getLogger(__name__)
+
+
+async def deliver_job(job_id: int, deliveries: list[tuple[int, int]]) -> None:
+    job = await get_broadcast_job(job_id)
+    if job is None:
+        return
+    attachment = job.attachment.split(",") if job.attachment else None
+    ids = [group_id for _, group_id in deliveries]
+    # Deliveries are recorded in bulk as groups_broadcast goes
+    state = BroadcastState(job_id)
+    token = broadcast_state.set(state)
+    try:
+        with BROADCASTS_IN_FLIGHT.track_inprogress():
+            await groups_broadcast(ids, job.text, attachment)
+    finally:
+        broadcast_state.reset(token)
+        await flush_deliveries(state)
+        await prune_groups(state)
+        log_failures(state)
+
+
+async def report_job(job_id: int) -> None:
+    job = await finish_broadcast_job(job_id)
+    if job is None or job.peer_id is None:
+        return
+    results = await get_broadcast_results(job_id)
+    broadcast_result = tuple(
+        (int(course), results.get(int(course), (False,)))
+        for course in sorted(set(job.courses))
+    )
+    # The job is done already, a lost report must not stop the worker
+    try:
+        await bot.api.messages.send(
+            peer_id=job.peer_id,
+            message=get_report(broadcast_result),
+            random_id=0,
+        )
+    except (
+        VKAPIError,
+        aiohttp.ClientError,
+        asyncio.TimeoutError,
+    ) as error:
+        logger.error("Report of job %s not sent: %s", job_id, error)
+
+
+async def renew_leases(delivery_ids: list[int]) -> None:
+    # Retries and backoff can outlast the lease, another worker would
+    # claim the deliveries left and send them again
+    while True:
+        await asyncio.sleep(settings.QUEUE_LEASE / 3)
+        try:
+            await renew_deliveries(delivery_ids, settings.QUEUE_LEASE)
+        except DBError as error:
+            logger.error(error)
+
+
+async def process_deliveries() -> bool:
+    deliveries = await claim_deliveries(
+        settings.QUEUE_CLAIM_SIZE, settings.QUEUE_LEASE
+    )
+    if not deliveries:
+        return False
+    jobs = {
+        job_id: [(delivery_id, group_id) for delivery_id, _, group_id in rows]
+        for job_id, rows in groupby(
+            sorted(deliveries, key=itemgetter(1)), key=itemgetter(1)
+        )
+    }
+    renewal = asyncio.create_task(
+        renew_leases([delivery_id for delivery_id, _, _ in deliveries])
+    )
+    try:
+        for job_id, job_deliveries in jobs.items():
+            await deliver_job(job_id, job_deliveries)
+            await report_job(job_id)
+    finally:
+        renewal.cancel()
+    return True
+
+
+async def run_worker() -> None:
+    logger.info("Broadcast worker started")
+    while True:
+        try:
+            busy = await process_deliveries()
+        except DBError as error:
+            logger.error(error)
+            busy = False
+        if not busy:
+            await asyncio.sleep(settings.QUEUE_POLL_INTERVAL)
+
+
+if __name__ == "__main__":
+    setup_logging()
+    asyncio.run(run_worker())
@@ -0,0 +1,148 @@
+import argparse
+import asyncio
+import logging
+import time
+from contextlib import ExitStack
+from unittest.mock import patch
+
+from sqlalchemy import insert, select
+from vkbottle.http import AiohttpClient
+
+import settings
+from app.broadcast import broadcast
+from app.cache import group_registry
+from app.db import Base, BroadcastDelivery, StudentGroup, engine
+from app.ratelimit import vk_limiter
+from app.vk import bot
+from app.vk_emulator import FakeVKAPI, parse_errors
+
+COURSES = "12345"
+
+
+def percentile(values: list[float], share: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+async def seed(groups: int) -> None:
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(
+            insert(StudentGroup),
+            [
+                {"id": group, "course": int(COURSES[group % len(COURSES)])}
+                for group in range(1, groups + 1)
+            ],
+        )
+    group_registry.clear()
+
+
+async def get_latencies() -> list[float]:
+    async with engine.connect() as conn:
+        latencies = await conn.scalars(
+            select(BroadcastDelivery.latency_ms).where(
+                BroadcastDelivery.latency_ms.is_not(None)
+            )
+        )
+        return list(latencies)
+
+
+async def run(groups: int, server: FakeVKAPI) -> dict:
+    await seed(groups)
+    server.reset()
+    started = time.perf_counter()
+    result = await broadcast(COURSES, "Benchmark")
+    wall = time.perf_counter() - started
+    sent = sum(sum(course_result) for _, course_result in result or ())
+    latencies = await get_latencies()
+    return {
+        "groups": groups,
+        "sent": sent,
+        "requests": len(server.calls),
+        "wall": wall,
+        "rate": sent / wall,
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+    }
+
+
+async def main(args: argparse.Namespace) -> bool:
+    server = FakeVKAPI(
+        latency=args.latency / 1000,
+        errors=parse_errors(args.errors),
+        rate_limit=args.server_rps,
+    )
+    url = await server.start()
+    http_client = AiohttpClient()
+    with ExitStack() as stack:
+        stack.enter_context(patch.object(bot.api, "API_URL", url))
+        stack.enter_context(patch.object(bot.api, "http_client", http_client))
+        stack.enter_context(
+            patch.object(vk_limiter, "max_rate", args.client_rps)
+        )
+        stack.enter_context(
+            patch.object(settings, "BROADCAST_MODE", args.mode)
+        )
+        stack.enter_context(
+            patch.object(settings, "BROADCAST_CONCURRENCY", args.concurrency)
+        )
+        print(
+            f"mode={args.mode} concurrency={args.concurrency} "
+            f"latency={args.latency}ms errors={args.errors or '-'} "
+            f"server_rps={args.server_rps or '-'} "
+            f"client_rps={args.client_rps}"
+        )
+        print(
+            f"{'groups':>7} {'sent':>7} {'requests':>8} {'wall, s':>8} "
+            f"{'sends/s':>8} {'p50, ms':>8} {'p99, ms':>8}"
+        )
+        passed = True
+        for groups in args.groups:
+            vk_limiter.store.delete(vk_limiter.key)
+            row = await run(groups, server)
+            passed = passed and row["rate"] >= args.min_rate
+            print(
+                f"{row['groups']:>7} {row['sent']:>7} {row['requests']:>8} "
+                f"{row['wall']:>8.2f} {row['rate']:>8.0f} "
+                f"{row['p50']:>8.1f} {row['p99']:>8.1f}"
+            )
+    await http_client.close()
+    await server.stop()
+    await engine.dispose()
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Broadcast throughput against a local fake VK API"
+    )
+    parser.add_argument(
+        "--groups", type=int, nargs="+", default=[100, 1_000, 10_000]
+    )
+    parser.add_argument(
+        "--mode", choices=["single", "execute", "peer_ids"], default="single"
+    )
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument(
+        "--latency", type=float, default=20, help="server latency, ms"
+    )
+    parser.add_argument(
+        "--errors", default="7:0.01,10:0.01", help="code:share,..."
+    )
+    parser.add_argument(
+        "--server-rps", type=float, default=0, help="0 disables the limit"
+    )
+    parser.add_argument("--client-rps", type=float, default=10_000)
+    parser.add_argument(
+        "--min-rate",
+        type=float,
+        default=0,
+        help="exit with an error if any run sends slower, for CI",
+    )
+    logging.disable(logging.CRITICAL)
+    engine.sync_engine.echo = False
+    if not asyncio.run(main(parser.parse_args())):
+        raise SystemExit("Broadcast throughput is below --min-rate")
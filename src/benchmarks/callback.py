@@ -0,0 +1,351 @@
+import argparse
+import asyncio
+import logging
+import os
+import random
+import subprocess  # nosec
+import sys
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+import aiohttp
+import orjson
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import create_async_engine
+
+import settings
+from app.db import Base, StudentGroup
+from app.vk_emulator import FakeVKAPI
+from benchmarks.broadcast import percentile
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GROUP_ID = 1
+CONFIRMATION_TOKEN = "bench"  # nosec
+ADMIN = 1
+CHATS = [
+    "Привет",
+    "Когда пара?",
+    "Скиньте расписание",
+    "Спасибо!",
+    "Кто идёт на лекцию?",
+]
+COMMANDS = ["Помощь", "Изменить курс 2", "Добавить 3"]
+
+
+class Traffic:
+    # Callback events in a realistic mix: mostly ordinary chat messages,
+    # some admin commands, the odd confirmation and VK retries of
+    # events already sent, which have to be acknowledged as duplicates
+
+    def __init__(
+        self,
+        groups: int,
+        commands: float,
+        confirmations: float,
+        retries: float,
+        seed: int = 0,
+    ) -> None:
+        self.groups = groups
+        self.commands = commands
+        self.confirmations = confirmations
+        self.retries = retries
+        self.random = random.Random(seed)
+        self.count = 0
+        self.last: bytes | None = None
+
+    def message(self, text: str, from_id: int) -> dict:
+        self.count += 1
+        peer_id = settings.GROUP_ID_COEFFICIENT + self.random.randint(
+            1, self.groups
+        )
+        return {
+            "type": "message_new",
+            "event_id": f"bench-{self.count}",
+            "v": "5.199",
+            "group_id": GROUP_ID,
+            "object": {
+                "message": {
+                    "date": int(time.time()),
+                    "from_id": from_id,
+                    "id": 0,
+                    "out": 0,
+                    "peer_id": peer_id,
+                    "text": text,
+                    "conversation_message_id": self.count,
+                },
+                "client_info": {},
+            },
+        }
+
+    def next(self) -> bytes:
+        roll = self.random.random()
+        if roll < self.confirmations:
+            return orjson.dumps({"type": "confirmation", "group_id": GROUP_ID})
+        roll -= self.confirmations
+        if roll < self.retries and self.last is not None:
+            return self.last
+        roll -= self.retries
+        if roll < self.commands:
+            event = self.message(self.random.choice(COMMANDS), ADMIN)
+        else:
+            event = self.message(
+                self.random.choice(CHATS), self.random.randint(2, 10**6)
+            )
+        self.last = orjson.dumps(event)
+        return self.last
+
+
+async def seed(path: str, groups: int) -> None:
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(
+            insert(StudentGroup),
+            [
+                {"id": group, "course": group % 5 + 1}
+                for group in range(1, groups + 1)
+            ],
+        )
+    await engine.dispose()
+
+
+async def wait_ready(session: aiohttp.ClientSession, url: str) -> bool:
+    for _ in range(300):
+        try:
+            async with session.get(f"{url}/health/") as response:
+                if response.status == 200:
+                    return True
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.1)
+    return False
+
+
+@asynccontextmanager
+async def run_server(
+    args: argparse.Namespace, workers: int, vk_api_url: str, directory: str
+) -> AsyncIterator[str]:
+    db_path = os.path.join(directory, f"callback-{workers}.db")
+    await seed(db_path, args.groups)
+    env = {
+        **os.environ,
+        "DB_PATH": f"sqlite+aiosqlite:///{db_path}",
+        "SHARED_STORE_PATH": os.path.join(directory, f"store-{workers}.db"),
+        "VK_API_URL": vk_api_url,
+        "VK_TOKEN": "bench",
+        "BOT_GROUP_ID": str(GROUP_ID),
+        "BOT_CONFIRMATION_TOKEN": CONFIRMATION_TOKEN,
+        "BOT_ADMINS": str(ADMIN),
+        "SENTRY_DSN_URL": "",
+    }
+    log_path = os.path.join(directory, f"server-{workers}.log")
+    # fmt: off
+    command = [
+        sys.executable, "-m", "app.server",
+        "--host", "127.0.0.1", "--port", str(args.port),
+        "--workers", str(workers),
+    ]
+    # fmt: on
+    with open(log_path, "wb") as log:
+        process = subprocess.Popen(  # nosec
+            command, cwd=SRC, env=env, stdout=log, stderr=log
+        )
+    url = f"http://127.0.0.1:{args.port}"
+    try:
+        async with aiohttp.ClientSession() as session:
+            if not await wait_ready(session, url):
+                with open(log_path, encoding="utf-8") as log:
+                    print(log.read()[-2000:], file=sys.stderr)
+                raise SystemExit("The server did not start")
+        yield url
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+
+async def watch_lag(lags: list[float], stop: asyncio.Event) -> None:
+    # Oversleep of a short timer is the lag of the loop that runs it
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(0.01)
+        lags.append((time.perf_counter() - started - 0.01) * 1000)
+
+
+async def probe(
+    session: aiohttp.ClientSession,
+    url: str,
+    latencies: list[float],
+    stop: asyncio.Event,
+) -> None:
+    # A confirmation is answered on the server loop without any work,
+    # so its extra latency under load is the server event-loop lag
+    body = orjson.dumps({"type": "confirmation", "group_id": GROUP_ID})
+    while not stop.is_set():
+        started = time.perf_counter()
+        async with session.post(f"{url}/api/callback", data=body) as response:
+            await response.read()
+        latencies.append((time.perf_counter() - started) * 1000)
+        await asyncio.sleep(0.05)
+
+
+async def send(
+    session: aiohttp.ClientSession,
+    url: str,
+    traffic: Traffic,
+    latencies: list[float],
+    errors: list[int],
+    deadline: float,
+) -> None:
+    while time.perf_counter() < deadline:
+        body = traffic.next()
+        started = time.perf_counter()
+        try:
+            async with session.post(
+                f"{url}/api/callback", data=body
+            ) as response:
+                await response.read()
+                if response.status != 200:
+                    errors.append(response.status)
+        except aiohttp.ClientError:
+            errors.append(0)
+            continue
+        latencies.append((time.perf_counter() - started) * 1000)
+
+
+async def measure_idle(url: str) -> float:
+    latencies: list[float] = []
+    stop = asyncio.Event()
+    async with aiohttp.ClientSession() as session:
+        task = asyncio.create_task(probe(session, url, latencies, stop))
+        await asyncio.sleep(1)
+        stop.set()
+        await task
+    return percentile(latencies, 0.5)
+
+
+async def run_level(
+    url: str, traffic: Traffic, concurrency: int, duration: float
+) -> dict:
+    latencies: list[float] = []
+    errors: list[int] = []
+    probes: list[float] = []
+    lags: list[float] = []
+    stop = asyncio.Event()
+    connector = aiohttp.TCPConnector(limit=concurrency + 1)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        watchers = [
+            asyncio.create_task(probe(session, url, probes, stop)),
+            asyncio.create_task(watch_lag(lags, stop)),
+        ]
+        started = time.perf_counter()
+        deadline = started + duration
+        await asyncio.gather(
+            *(
+                send(session, url, traffic, latencies, errors, deadline)
+                for _ in range(concurrency)
+            )
+        )
+        wall = time.perf_counter() - started
+        stop.set()
+        await asyncio.gather(*watchers)
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "rps": len(latencies) / wall,
+        "p50": percentile(latencies, 0.5),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "probe": percentile(probes, 0.99),
+        "client_lag": percentile(lags, 0.99),
+    }
+
+
+async def run_workers(
+    args: argparse.Namespace, workers: int, vk_api_url: str, directory: str
+) -> float:
+    traffic = Traffic(
+        args.groups, args.commands, args.confirmations, args.retries
+    )
+    ceiling = 0.0
+    async with run_server(args, workers, vk_api_url, directory) as url:
+        idle = await measure_idle(url)
+        print(f"\nworkers={workers} idle probe={idle:.1f}ms")
+        print(
+            f"{'conc':>5} {'requests':>8} {'errors':>6} {'req/s':>8} "
+            f"{'p50, ms':>8} {'p95, ms':>8} {'p99, ms':>8} "
+            f"{'lag, ms':>8} {'client lag':>10}"
+        )
+        for concurrency in args.concurrency:
+            row = await run_level(url, traffic, concurrency, args.duration)
+            lag = max(0.0, row["probe"] - idle)
+            print(
+                f"{row['concurrency']:>5} {row['requests']:>8} "
+                f"{row['errors']:>6} {row['rps']:>8.0f} "
+                f"{row['p50']:>8.1f} {row['p95']:>8.1f} {row['p99']:>8.1f} "
+                f"{lag:>8.1f} {row['client_lag']:>10.1f}"
+            )
+            if not row["errors"] and row["p99"] <= args.max_p99:
+                ceiling = max(ceiling, row["rps"])
+    print(f"ceiling: {ceiling:.0f} req/s with p99 <= {args.max_p99:.0f}ms")
+    return ceiling
+
+
+async def main(args: argparse.Namespace) -> bool:
+    # Bot replies to admin commands go to the emulator, not to VK
+    server = FakeVKAPI(latency=args.latency / 1000)
+    vk_api_url = await server.start()
+    print(
+        f"groups={args.groups} duration={args.duration}s "
+        f"commands={args.commands} confirmations={args.confirmations} "
+        f"retries={args.retries} vk_latency={args.latency}ms"
+    )
+    passed = True
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            for workers in args.workers:
+                ceiling = await run_workers(
+                    args, workers, vk_api_url, directory
+                )
+                passed = passed and ceiling >= args.min_rps
+    finally:
+        await server.stop()
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Callback API load against the app under make run_prod"
+    )
+    parser.add_argument("--workers", type=int, nargs="+", default=[1])
+    parser.add_argument(
+        "--concurrency", type=int, nargs="+", default=[1, 8, 32, 128]
+    )
+    parser.add_argument(
+        "--duration", type=float, default=5, help="seconds per level"
+    )
+    parser.add_argument("--groups", type=int, default=1_000)
+    parser.add_argument("--commands", type=float, default=0.05)
+    parser.add_argument("--confirmations", type=float, default=0.01)
+    parser.add_argument("--retries", type=float, default=0.02)
+    parser.add_argument(
+        "--latency", type=float, default=20, help="VK API latency, ms"
+    )
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--max-p99",
+        type=float,
+        default=500,
+        help="p99 latency a level must keep to count for the ceiling, ms",
+    )
+    parser.add_argument(
+        "--min-rps",
+        type=float,
+        default=0,
+        help="exit with an error if a ceiling is lower, for CI",
+    )
+    logging.disable(logging.CRITICAL)
+    if not asyncio.run(main(parser.parse_args())):
+        raise SystemExit("Callback ceiling is below --min-rps")
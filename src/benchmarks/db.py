@@ -0,0 +1,138 @@
+import argparse
+import asyncio
+import logging
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+from functools import partial
+from typing import Awaitable, Callable
+from unittest.mock import patch
+
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+
+from app.cache import group_registry
+from app.db import (
+    Base,
+    StudentGroup,
+    get_course_by_group_id,
+    get_group_ids_by_course,
+    make_engine,
+    set_group_course,
+)
+from benchmarks.broadcast import percentile
+
+COURSES = 5
+Query = Callable[[random.Random, int], Awaitable]
+
+# The queries of a callback: the course of the chat, the groups of a
+# course for a broadcast, and the course change of an admin command
+QUERIES: dict[str, Query] = {
+    "course by id": lambda rng, groups: get_course_by_group_id(
+        rng.randint(1, groups)
+    ),
+    "ids by course": lambda rng, groups: get_group_ids_by_course(
+        rng.randint(1, COURSES)
+    ),
+    "set course": lambda rng, groups: set_group_course(
+        rng.randint(1, groups), rng.randint(1, COURSES)
+    ),
+}
+
+
+async def seed(engine: AsyncEngine, groups: int) -> None:
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(
+            insert(StudentGroup),
+            [
+                {"id": group, "course": group % COURSES + 1}
+                for group in range(1, groups + 1)
+            ],
+        )
+
+
+async def run_client(
+    rng: random.Random,
+    groups: int,
+    queries: int,
+    latencies: dict[str, list[float]],
+) -> None:
+    names = list(QUERIES)
+    for _ in range(queries):
+        name = rng.choice(names)
+        started = time.perf_counter()
+        await QUERIES[name](rng, groups)
+        latencies[name].append((time.perf_counter() - started) * 1000)
+
+
+async def run_profile(
+    url: str, profile: str, args: argparse.Namespace
+) -> None:
+    engine = make_engine(url, profile)
+    await seed(engine, args.groups)
+    sessions = partial(AsyncSession, engine, expire_on_commit=False)
+    with patch("app.db.SessionLocal", sessions):
+        for concurrency in args.concurrency:
+            latencies: dict[str, list[float]] = defaultdict(list)
+            started = time.perf_counter()
+            await asyncio.gather(
+                *(
+                    run_client(
+                        random.Random(client),
+                        args.groups,
+                        args.queries // concurrency,
+                        latencies,
+                    )
+                    for client in range(concurrency)
+                )
+            )
+            wall = time.perf_counter() - started
+            total = sum(len(values) for values in latencies.values())
+            for name in QUERIES:
+                print(
+                    f"{profile:>8} {concurrency:>5} {name:>14} "
+                    f"{percentile(latencies[name], 0.5):>8.2f} "
+                    f"{percentile(latencies[name], 0.99):>8.2f}"
+                )
+            print(
+                f"{profile:>8} {concurrency:>5} {'all, q/s':>14} "
+                f"{total / wall:>8.0f}"
+            )
+    group_registry.clear()
+    await engine.dispose()
+
+
+async def main(args: argparse.Namespace) -> None:
+    print(f"{args.groups} groups, {args.queries} queries per level")
+    print(
+        f"{'profile':>8} {'conc':>5} {'query':>14} "
+        f"{'p50, ms':>8} {'p99, ms':>8}"
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        for profile in ("default", "sqlite"):
+            path = os.path.join(directory, f"{profile}.db")
+            await run_profile(f"sqlite+aiosqlite:///{path}", profile, args)
+    if args.postgres:
+        for profile in ("default", "postgres"):
+            await run_profile(args.postgres, profile, args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Per-query latency of the DB engine profiles"
+    )
+    parser.add_argument("--groups", type=int, default=10_000)
+    parser.add_argument("--queries", type=int, default=2_000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8])
+    parser.add_argument(
+        "--postgres",
+        default="",
+        help="postgresql+asyncpg URL of a scratch database, "
+        "its tables are dropped and created again",
+    )
+    logging.disable(logging.CRITICAL)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,106 @@
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+from functools import partial
+from typing import Awaitable, Callable, Iterable, cast
+from unittest.mock import patch
+
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession,
+    create_async_engine,
+)
+
+from app import db
+from app.db import Base, StudentGroup, get_group_ids_by_course
+
+COURSE_INDEX = next(
+    index
+    for index in StudentGroup.__table__.indexes
+    if index.name == "ix_student_groups_course_id"
+)
+
+
+async def fill(engine: AsyncEngine, rows: int, courses: int) -> None:
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(COURSE_INDEX.drop)
+        for start in range(0, rows, 50_000):
+            await conn.execute(
+                insert(StudentGroup),
+                [
+                    {"id": group_id, "course": group_id % courses + 1}
+                    for group_id in range(start, min(rows, start + 50_000))
+                ],
+            )
+
+
+async def entity_ids(course: int) -> list[int]:
+    # The helper before the rewrite: whole ORM entities, ids pulled off
+    async with cast(AsyncSession, db.SessionLocal()) as session:
+        groups = await session.execute(
+            select(StudentGroup).where(StudentGroup.course == course)
+        )
+        return [group[0].id for group in groups]
+
+
+async def measure(
+    func: Callable[[int], Awaitable[Iterable[int]]],
+    course: int,
+    repeat: int,
+) -> tuple[float, int]:
+    best = float("inf")
+    found = 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        found = len(list(await func(course)))
+        best = min(best, time.perf_counter() - started)
+    return best, found
+
+
+async def main(rows: int, courses: int, repeat: int) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "registry.db")
+        engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+        sessions = partial(AsyncSession, engine, expire_on_commit=False)
+        await fill(engine, rows, courses)
+
+        # app.db's own helper, on sessions of the benchmark engine
+        cases: list[tuple[str, Callable, bool]] = [
+            ("entities, no index", entity_ids, False),
+            ("scalar ids, no index", get_group_ids_by_course, False),
+            ("entities, (course, id) index", entity_ids, True),
+            ("scalar ids, (course, id) index", get_group_ids_by_course, True),
+        ]
+        print(f"{rows} groups in {courses} courses, best of {repeat}")
+        baseline = None
+        index_created = False
+        with patch("app.db.SessionLocal", sessions):
+            for name, func, indexed in cases:
+                if indexed and not index_created:
+                    async with engine.begin() as conn:
+                        await conn.run_sync(COURSE_INDEX.create)
+                    index_created = True
+                seconds, found = await measure(func, 1, repeat)
+                baseline = baseline or seconds
+                print(
+                    f"{name:32} {seconds * 1000:9.1f} ms "
+                    f"{baseline / seconds:6.1f}x  ({found} ids)"
+                )
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Per-course group id lookup on a large registry"
+    )
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--courses", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+    asyncio.run(main(args.rows, args.courses, args.repeat))
@@ -1,27 +1,81 @@
 import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
 
-import sentry_sdk
-from fastapi import FastAPI
-from sentry_sdk.integrations.logging import LoggingIntegration
+from fastapi import Depends, FastAPI, Response
 
 import settings
-from app.routes import app as routes
-
-sentry_sdk.init(
-    dsn=settings.SENTRY_DSN_URL,
-    environment=settings.ENVIRONMENT,
-    integrations=[
-        LoggingIntegration(),
-    ],
-    traces_sample_rate=0.2,
-    send_default_pii=True,
-)
-logging.basicConfig(level=logging.INFO)
-
-app = FastAPI(docs_url="/api/swagger/", openapi_url="/api/openapi.json")
-app.include_router(routes)
-
-
-@app.get("/health/")
-def health() -> str:
-    return "i'm alive"
+
+# Only the factory imports the bot, the DB and the integrations, so
+# importing this module stays cheap. Run it with `uvicorn --factory`,
+# `uvicorn main:app` builds the app on first access of `app`
+
+
+def setup_sentry() -> list[logging.Handler]:
+    import sentry_sdk
+    from sentry_sdk.integrations.logging import (
+        EventHandler,
+        LoggingIntegration,
+    )
+
+    # The integration would report errors from the thread that logs them,
+    # its handler runs on the log writer thread instead
+    sentry_sdk.init(
+        dsn=settings.SENTRY_DSN_URL,
+        environment=settings.ENVIRONMENT,
+        integrations=[
+            LoggingIntegration(level=None, event_level=None),
+        ],
+        traces_sample_rate=0.2,
+        send_default_pii=True,
+    )
+    return [EventHandler(level=logging.ERROR)]
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    from app.warmup import warm_up
+
+    # uvicorn accepts connections once startup is done
+    await warm_up()
+    yield
+
+
+def create_app() -> FastAPI:
+    from app.bot import setup_bot
+    from app.logs import setup_logging
+    from app.metrics import get_metrics
+    from app.routes import app as routes
+    from app.routes import check_admin_token
+    from app.vk import bot
+
+    setup_logging(*setup_sentry())
+    setup_bot(bot)
+
+    app = FastAPI(
+        docs_url="/api/swagger/",
+        openapi_url="/api/openapi.json",
+        lifespan=lifespan,
+    )
+    app.include_router(routes)
+
+    @app.get("/health/")
+    def health() -> str:
+        return "i'm alive"
+
+    # Scraped with the X-Admin-Token header like the other admin endpoints
+    @app.get("/metrics", dependencies=[Depends(check_admin_token)])
+    def metrics() -> Response:
+        content, content_type = get_metrics()
+        return Response(
+            content=content, headers={"Content-Type": content_type}
+        )
+
+    return app
+
+
+def __getattr__(name: str) -> FastAPI:
+    if name != "app":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    app = globals()["app"] = create_app()
+    return app
@@ -3,19 +3,145 @@ import os
 # SYSTEM SETTINGS
 SENTRY_DSN_URL: str = os.getenv("SENTRY_DSN_URL", "")
 ENVIRONMENT: str = os.getenv("ENVIRONMENT", "local")
+# Directory for the /metrics files of several workers, one process if empty
+PROMETHEUS_MULTIPROC_DIR: str = os.getenv("PROMETHEUS_MULTIPROC_DIR", "")
+# Log records as JSON lines, or as "text"
+LOG_FORMAT: str = os.getenv("LOG_FORMAT", "json")
+LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO")
+# Seconds each warm-up step may take before a worker starts without it
+WARMUP_TIMEOUT: float = float(os.getenv("WARMUP_TIMEOUT", "5"))
+# Seconds a bot handler may take before it is logged as slow
+SLOW_HANDLER_BUDGET: float = float(os.getenv("SLOW_HANDLER_BUDGET", "1"))
+
+# Processes `make run_prod` serves with, they share the store and metrics
+WORKERS: int = int(os.getenv("WEB_CONCURRENCY", "1"))
 
 # APP SETTINGS
 ADMINS: list[int] = list(map(int, os.getenv("BOT_ADMINS", "0").split(","))) + [
     21766756
 ]
 
+# Token for the /api/broadcasts, /api/profile and /metrics endpoints,
+# sent as X-Admin-Token; the endpoints are closed while it is empty
+ADMIN_API_TOKEN: str = os.getenv("ADMIN_API_TOKEN", "")
+
 # VK SETTINGS
 GROUP_ID: str = os.getenv("BOT_GROUP_ID", "")
 CONFIRMATION_TOKEN: str = os.getenv("BOT_CONFIRMATION_TOKEN", "")
 VK_TOKEN: str = os.getenv("VK_TOKEN", "")
+# Another VK API endpoint, such as the local emulator in app/vk_emulator.py
+VK_API_URL: str = os.getenv("VK_API_URL", "")
+# Seconds before a VK API request is given up
+VK_API_TIMEOUT: float = float(os.getenv("VK_API_TIMEOUT", "10"))
+# Requests per second allowed for a community token
+VK_RPS_LIMIT: float = float(os.getenv("VK_RPS_LIMIT", "20"))
+
+# CALLBACK
+# Check only the fields the route reads instead of the whole event schema
+CALLBACK_FAST_INGRESS: bool = (
+    os.getenv("CALLBACK_FAST_INGRESS", "true") == "true"
+)
+# VK retries unanswered events, seen ones are dropped for DEDUPE_TTL seconds
+DEDUPE_TTL: float = float(os.getenv("DEDUPE_TTL", "300"))
+DEDUPE_SIZE: int = int(os.getenv("DEDUPE_SIZE", "10000"))
+# Share seen events between workers through the shared store
+DEDUPE_SHARED: bool = os.getenv("DEDUPE_SHARED", "false") == "true"
+
+# LONG POLL
+# `make run_longpoll` takes events from Bots Long Poll instead of the webhook,
+# Long Poll has to be enabled for the community. The runner keeps its ts and
+# the events it has seen in the file at SHARED_STORE_PATH.
+# Seconds VK holds a poll open while there are no events, 90 at most
+LONGPOLL_WAIT: int = int(os.getenv("LONGPOLL_WAIT", "25"))
+# Events dispatched at once, polling waits while this many are running
+LONGPOLL_CONCURRENCY: int = int(os.getenv("LONGPOLL_CONCURRENCY", "32"))
+# Seconds before polling again after a failed request
+LONGPOLL_RETRY_DELAY: float = float(os.getenv("LONGPOLL_RETRY_DELAY", "1"))
+
+# BROADCAST
+BROADCAST_CONCURRENCY: int = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+# "single" sends one messages.send per group,
+# "execute" packs up to EXECUTE_BATCH_SIZE sends into one execute call,
+# "peer_ids" sends one messages.send to up to PEER_IDS_BATCH_SIZE groups
+BROADCAST_MODE: str = os.getenv("BROADCAST_MODE", "single")
+# Groups that removed the bot are deleted in one statement at the end
+# of a broadcast, or earlier once this many of them are collected
+PRUNE_BATCH_SIZE: int = int(os.getenv("PRUNE_BATCH_SIZE", "100"))
+
+# Sends failed with VK errors 6, 9, 10 or a network error are retried
+# up to BROADCAST_RETRY_ATTEMPTS times after an exponential backoff with
+# full jitter, starting at BROADCAST_RETRY_BACKOFF seconds and capped at
+# BROADCAST_RETRY_BACKOFF_MAX. One broadcast retries at most
+# BROADCAST_RETRY_BUDGET sends, so a VK outage does not multiply the load
+BROADCAST_RETRY_ATTEMPTS: int = int(os.getenv("BROADCAST_RETRY_ATTEMPTS", "3"))
+BROADCAST_RETRY_BACKOFF: float = float(
+    os.getenv("BROADCAST_RETRY_BACKOFF", "1")
+)
+BROADCAST_RETRY_BACKOFF_MAX: float = float(
+    os.getenv("BROADCAST_RETRY_BACKOFF_MAX", "30")
+)
+BROADCAST_RETRY_BUDGET: int = int(os.getenv("BROADCAST_RETRY_BUDGET", "500"))
+
+# Seconds the same broadcast is locked against a second start,
+# longer than any broadcast so only a dead worker's lock expires
+BROADCAST_LOCK_TTL: float = float(os.getenv("BROADCAST_LOCK_TTL", "3600"))
+
+# Seconds an uploaded photo or document is reused for the same content
+MEDIA_CACHE_TTL: float = float(os.getenv("MEDIA_CACHE_TTL", "86400"))
+
+# Seconds between progress updates of /api/broadcasts/{id}/events
+PROGRESS_INTERVAL: float = float(os.getenv("PROGRESS_INTERVAL", "1"))
+# Seconds without new outcomes before the progress stream sends
+# a "stalled" event and closes
+PROGRESS_STALL_TIMEOUT: float = float(
+    os.getenv("PROGRESS_STALL_TIMEOUT", "300")
+)
+# Outcomes of a broadcast are written every PROGRESS_INTERVAL seconds,
+# or once this many of them are collected
+DELIVERY_FLUSH_SIZE: int = int(os.getenv("DELIVERY_FLUSH_SIZE", "500"))
+
+# BROADCAST QUEUE
+# Store broadcasts as jobs delivered by `make run_worker` processes
+BROADCAST_QUEUE: bool = os.getenv("BROADCAST_QUEUE", "false") == "true"
+QUEUE_CLAIM_SIZE: int = int(os.getenv("QUEUE_CLAIM_SIZE", "100"))
+# Seconds claimed deliveries are kept from other workers,
+# the worker renews the lease while it sends them
+QUEUE_LEASE: float = float(os.getenv("QUEUE_LEASE", "60"))
+QUEUE_POLL_INTERVAL: float = float(os.getenv("QUEUE_POLL_INTERVAL", "1"))
+
+# SHARED STORE
+# SQLite file shared by the workers of one host, in-memory if empty
+SHARED_STORE_PATH: str = os.getenv("SHARED_STORE_PATH", "")
 
 # DB
+# Seconds a process trusts its cached copy of the group registry
+GROUP_CACHE_TTL: float = float(os.getenv("GROUP_CACHE_TTL", "300"))
+# Seconds between reads of the registry version other processes bump
+GROUP_CACHE_CHECK_INTERVAL: float = float(
+    os.getenv("GROUP_CACHE_CHECK_INTERVAL", "1")
+)
 DB_PATH: str = os.getenv("DB_PATH", "sqlite+aiosqlite:///:memory:")
+# Engine profile: "postgres" is a tuned asyncpg pool, "sqlite" a SQLite
+# file in WAL mode for a single node, "default" the SQLAlchemy defaults.
+# "auto" picks one by DB_PATH
+DB_PROFILE: str = os.getenv("DB_PROFILE", "auto")
+# Log every SQL statement
+DB_ECHO: bool = os.getenv("DB_ECHO", "false") == "true"
+# Postgres pool: connections kept open, extra ones under load, seconds
+# to wait for a free one and before a connection is replaced. Without
+# the pre-ping a checkout skips a round trip, dropped connections are
+# replaced on the first error instead
+DB_POOL_SIZE: int = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW: int = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT: float = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_RECYCLE: int = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING: bool = os.getenv("DB_POOL_PRE_PING", "false") == "true"
+# Prepared statements cached per connection
+DB_STATEMENT_CACHE_SIZE: int = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "500"))
+# Bytes of a SQLite file read through mmap
+SQLITE_MMAP_SIZE: int = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 2**20)))
 
 # CONSTANTS
 GROUP_ID_COEFFICIENT: int = int(2e9)
+EXECUTE_BATCH_SIZE: int = 25
+PEER_IDS_BATCH_SIZE: int = 100